@@ -5,16 +5,28 @@ Webhook handler для Bitrix24
 """
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse as BaseJSONResponse
 import logging
 import asyncio
+from contextlib import asynccontextmanager
+from bitrix_client import bitrix
+from rate_limit import background_priority
+from shared_state import watch_loop
+from config import SHARED_STATE_POLL_INTERVAL, LOOP_LAG_INTERVAL
+import codec
+import metrics
 from bot import (
     bot,
     notify_stage_change,
     send_invoice_to_client,
     send_warehouse_photos,
     get_deal_details,
-    user_phones,
+    refresh_deal,
+    on_shared_change,
+    users,
+    deal_stages,
+    documents,
+    blobs,
     bitrix_request
 )
 
@@ -22,11 +34,44 @@ from bot import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class JSONResponse(BaseJSONResponse):
+    """JSON ответ через общий кодек (orjson, если установлен)"""
+
+    def render(self, content) -> bytes:
+        return codec.dumps(content)
+
+
+async def read_json(request: Request):
+    """Тело запроса как JSON через общий кодек"""
+    return codec.loads(await request.body())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Жизненный цикл приложения: сверяем манифест документов с диском, следим
+    за сделками, обновленными другими воркерами, и закрываем пул соединений
+    к Битрикс при остановке
+    """
+    await documents.reconcile()
+    shared_watch = asyncio.create_task(watch_loop(deal_stages, SHARED_STATE_POLL_INTERVAL, on_shared_change))
+    loop_lag = asyncio.create_task(metrics.watch_loop_lag(LOOP_LAG_INTERVAL))
+    yield
+    shared_watch.cancel()
+    loop_lag.cancel()
+    await blobs.close()
+    await bitrix.close()
+
+
 # Создаем FastAPI приложение
-app = FastAPI(title="Sunway24 Webhook Handler")
+app = FastAPI(title="Sunway24 Webhook Handler", lifespan=lifespan, default_response_class=JSONResponse)
 
-# Словарь для хранения последних статусов сделок (чтобы отслеживать изменения)
-deal_stages = {}
+
+@app.middleware("http")
+async def background_bitrix_priority(request: Request, call_next):
+    """Запросы к Битрикс из вебхуков - фоновые, нажатия кнопок клиентов идут первыми"""
+    with background_priority():
+        return await call_next(request)
 
 
 @app.post("/webhook/deal_update")
@@ -37,7 +82,7 @@ async def handle_deal_update(request: Request):
     """
     try:
         # Получаем данные из запроса
-        data = await request.json()
+        data = await read_json(request)
         logger.info(f"Received webhook data: {data}")
 
         # Извлекаем информацию о сделке
@@ -49,34 +94,29 @@ async def handle_deal_update(request: Request):
             logger.error("No deal ID in webhook data")
             return JSONResponse({"status": "error", "message": "No deal ID"}, status_code=400)
 
-        # Получаем полные данные сделки из Битрикс
-        deal = await get_deal_details(deal_id)
+        # Получаем свежие данные сделки из Битрикс и обновляем кэш
+        deal = await refresh_deal(deal_id)
         if not deal:
             logger.error(f"Could not fetch deal {deal_id} details")
             return JSONResponse({"status": "error", "message": "Deal not found"}, status_code=404)
 
-        new_stage = deal.get('STAGE_ID')
-        contact_id = deal.get('CONTACT_ID')
+        new_stage = deal.stage_id
+        contact_id = deal.contact_id
 
         if not new_stage or not contact_id:
             logger.error(f"Missing stage or contact for deal {deal_id}")
             return JSONResponse({"status": "error", "message": "Missing data"}, status_code=400)
 
-        # Проверяем, изменился ли статус
-        old_stage = deal_stages.get(deal_id)
+        # Проверяем, изменился ли статус (стадии общие для всех процессов)
+        old_stage = await deal_stages.record(deal_id, contact_id, new_stage)
 
         if old_stage != new_stage:
             logger.info(f"Deal {deal_id} stage changed: {old_stage} -> {new_stage}")
-            deal_stages[deal_id] = new_stage
 
             # Находим telegram_id клиента
-            client_telegram_id = None
-            for user_id, user_data in user_phones.items():
-                if user_data.get('client_id') == str(contact_id):
-                    client_telegram_id = user_id
-                    break
+            client_telegram_ids = users.telegram_ids(contact_id)
 
-            if client_telegram_id:
+            if client_telegram_ids:
                 # Отправляем уведомление о смене статуса
                 await notify_stage_change(deal_id, new_stage)
 
@@ -84,17 +124,19 @@ async def handle_deal_update(request: Request):
                 if new_stage == 'UC_EWKB0I':
                     logger.info(f"Auto-sending invoice for deal {deal_id}")
                     await asyncio.sleep(2)  # Небольшая задержка
-                    invoice_sent = await send_invoice_to_client(deal_id, client_telegram_id)
-                    if invoice_sent:
-                        logger.info(f"Invoice sent successfully for deal {deal_id}")
+                    for client_telegram_id in client_telegram_ids:
+                        invoice_sent = await send_invoice_to_client(deal_id, client_telegram_id)
+                        if invoice_sent:
+                            logger.info(f"Invoice sent successfully for deal {deal_id} to {client_telegram_id}")
 
                 # Автоматически отправляем фото при переходе на стадию "Товар на складе"
                 elif new_stage == 'UC_Y5IE8J':
                     logger.info(f"Auto-sending photos for deal {deal_id}")
                     await asyncio.sleep(2)  # Небольшая задержка
-                    photos_sent = await send_warehouse_photos(deal_id, client_telegram_id)
-                    if photos_sent:
-                        logger.info(f"Photos sent successfully for deal {deal_id}")
+                    for client_telegram_id in client_telegram_ids:
+                        photos_sent = await send_warehouse_photos(deal_id, client_telegram_id)
+                        if photos_sent:
+                            logger.info(f"Photos sent successfully for deal {deal_id} to {client_telegram_id}")
 
                 return JSONResponse({
                     "status": "success",
@@ -129,7 +171,7 @@ async def handle_invoice_upload(request: Request):
     Срабатывает когда в поле накладной добавляется файл
     """
     try:
-        data = await request.json()
+        data = await read_json(request)
         logger.info(f"Invoice upload webhook: {data}")
 
         deal_id = data.get('deal_id') or data.get('FIELDS', {}).get('ID')
@@ -141,29 +183,29 @@ async def handle_invoice_upload(request: Request):
         if not deal:
             return JSONResponse({"status": "error", "message": "Deal not found"}, status_code=404)
 
-        contact_id = deal.get('CONTACT_ID')
+        contact_id = deal.contact_id
 
         # Находим telegram_id клиента
-        client_telegram_id = None
-        for user_id, user_data in user_phones.items():
-            if user_data.get('client_id') == str(contact_id):
-                client_telegram_id = user_id
-                break
+        client_telegram_ids = users.telegram_ids(contact_id)
 
-        if client_telegram_id:
-            # Отправляем накладную клиенту
-            invoice_sent = await send_invoice_to_client(deal_id, client_telegram_id)
+        if client_telegram_ids:
+            invoice_sent = False
+            for client_telegram_id in client_telegram_ids:
+                # Отправляем накладную клиенту
+                if not await send_invoice_to_client(deal_id, client_telegram_id):
+                    continue
+                invoice_sent = True
 
-            if invoice_sent:
                 # Также отправляем уведомление
                 await bot.send_message(
                     client_telegram_id,
                     f"📄 <b>Накладная готова!</b>\n\n"
-                    f"Для вашего заказа #{deal_id} подготовлена накладная.\n"
-                    f"Документ отправлен вам выше.",
+                        f"Для вашего заказа #{deal_id} подготовлена накладная.\n"
+                        f"Документ отправлен вам выше.",
                     parse_mode="HTML"
                 )
 
+            if invoice_sent:
                 return JSONResponse({
                     "status": "success",
                     "message": f"Invoice sent for deal {deal_id}"
@@ -194,7 +236,7 @@ async def handle_photos_upload(request: Request):
     Срабатывает когда в поле фото добавляются файлы
     """
     try:
-        data = await request.json()
+        data = await read_json(request)
         logger.info(f"Photos upload webhook: {data}")
 
         deal_id = data.get('deal_id') or data.get('FIELDS', {}).get('ID')
@@ -207,35 +249,35 @@ async def handle_photos_upload(request: Request):
             return JSONResponse({"status": "error", "message": "Deal not found"}, status_code=404)
 
         # Проверяем, что сделка на стадии "Товар на складе"
-        if deal.get('STAGE_ID') != 'UC_Y5IE8J':
+        if deal.stage_id != 'UC_Y5IE8J':
             return JSONResponse({
                 "status": "info",
                 "message": "Deal not in warehouse stage"
             })
 
-        contact_id = deal.get('CONTACT_ID')
+        contact_id = deal.contact_id
 
         # Находим telegram_id клиента
-        client_telegram_id = None
-        for user_id, user_data in user_phones.items():
-            if user_data.get('client_id') == str(contact_id):
-                client_telegram_id = user_id
-                break
+        client_telegram_ids = users.telegram_ids(contact_id)
 
-        if client_telegram_id:
-            # Отправляем фото клиенту
-            photos_sent = await send_warehouse_photos(deal_id, client_telegram_id)
+        if client_telegram_ids:
+            photos_sent = False
+            for client_telegram_id in client_telegram_ids:
+                # Отправляем фото клиенту
+                if not await send_warehouse_photos(deal_id, client_telegram_id):
+                    continue
+                photos_sent = True
 
-            if photos_sent:
                 # Также отправляем уведомление
                 await bot.send_message(
                     client_telegram_id,
                     f"📸 <b>Фото товара доступны!</b>\n\n"
-                    f"Ваш товар (заказ #{deal_id}) прибыл на склад.\n"
-                    f"Фотографии отправлены вам выше.",
+                        f"Ваш товар (заказ #{deal_id}) прибыл на склад.\n"
+                        f"Фотографии отправлены вам выше.",
                     parse_mode="HTML"
                 )
 
+            if photos_sent:
                 return JSONResponse({
                     "status": "success",
                     "message": f"Photos sent for deal {deal_id}"
@@ -268,7 +310,8 @@ async def root():
         "endpoints": [
             "/webhook/deal_update",
             "/webhook/invoice_uploaded",
-            "/webhook/photos_uploaded"
+            "/webhook/photos_uploaded",
+            "/metrics"
         ]
     }
 
@@ -279,6 +322,12 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики: очередь и ожидание лимитера Битрикс, повторы, задержки"""
+    return metrics.snapshot()
+
+
 if __name__ == "__main__":
     import uvicorn
 
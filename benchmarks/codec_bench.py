@@ -0,0 +1,62 @@
+"""
+Микробенчмарк JSON кодека: разбор страницы crm.deal.list из 50 сделок
+Запуск из корня проекта: python benchmarks/codec_bench.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+from deal_mirror import MIRROR_SELECT  # noqa: E402
+
+ITERATIONS = 2000
+
+
+def make_page(size: int = 50) -> bytes:
+    """Ответ Битрикс со страницей сделок, похожих на реальные"""
+    deals = []
+    for i in range(size):
+        deal = {field: f"Значение поля {field} для сделки {i}" for field in MIRROR_SELECT}
+        deal.update({
+            'ID': str(10000 + i),
+            'TITLE': f"Заказ из Китая №{i} - мебель, 3 места",
+            'DATE_CREATE': '2025-03-14T10:22:31+03:00',
+            'DATE_MODIFY': '2025-04-01T18:05:12+03:00',
+            'STAGE_ID': 'UC_VA28QX',
+            'OPPORTUNITY': '125000.00',
+            'CURRENCY_ID': 'RUB',
+            'CONTACT_ID': '4211',
+            'CLOSED': 'N',
+        })
+        deals.append(deal)
+    response = {'result': deals, 'next': 50, 'total': 320, 'time': {'start': 1, 'finish': 2}}
+    return json.dumps(response, ensure_ascii=False).encode('utf-8')
+
+
+def bench(name: str, func, payload) -> float:
+    seconds = timeit.timeit(lambda: func(payload), number=ITERATIONS)
+    per_call_us = seconds / ITERATIONS * 1e6
+    print(f"{name:<28} {per_call_us:9.1f} мкс")
+    return per_call_us
+
+
+def main():
+    page = make_page()
+    decoded = json.loads(page)
+    print(f"Страница: 50 сделок, {len(page) / 1024:.1f} КБ, кодек: {codec.NAME}")
+
+    before = bench("json.loads (stdlib)", json.loads, page)
+    after = bench(f"codec.loads ({codec.NAME})", codec.loads, page)
+    print(f"Разбор: x{before / after:.1f}")
+
+    before = bench("json.dumps (stdlib)", lambda obj: json.dumps(obj).encode('utf-8'), decoded)
+    after = bench(f"codec.dumps ({codec.NAME})", codec.dumps, decoded)
+    print(f"Сериализация: x{before / after:.1f}")
+
+
+if __name__ == "__main__":
+    main()
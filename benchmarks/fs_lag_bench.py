@@ -0,0 +1,91 @@
+"""
+Задержка event loop при работе с файлами документов
+Старые обработчики писали, перечисляли и удаляли фото прямо в event loop;
+сейчас те же операции идут через пул файловых операций (file_pool).
+Бенчмарк повторяет загрузку и удаление папки с фото обоими способами и
+показывает, насколько при этом опаздывает периодическая задача (как
+metrics.watch_loop_lag).
+Запуск из корня проекта: python benchmarks/fs_lag_bench.py
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_pool import FilePool  # noqa: E402
+
+PHOTOS = 300
+PHOTO_SIZE = 512 * 1024
+TICK = 0.005
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(max(loop.time() - started - TICK, 0.0))
+
+
+def write_photo(path: str, payload: bytes):
+    with open(path, 'wb') as file:
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+async def inline(directory: str, payload: bytes):
+    """Как раньше: синхронные вызовы прямо в обработчике"""
+    os.makedirs(directory, exist_ok=True)
+    for _ in range(PHOTOS):
+        write_photo(f"{directory}/photo_{len(os.listdir(directory)) + 1:03d}.jpg", payload)
+        await asyncio.sleep(0)
+    shutil.rmtree(directory)
+
+
+async def pooled(directory: str, payload: bytes, pool: FilePool):
+    """Сейчас: те же операции через пул"""
+    await pool.makedirs(directory)
+    for _ in range(PHOTOS):
+        count = len(await pool.listdir(directory))
+        await pool.run(write_photo, f"{directory}/photo_{count + 1:03d}.jpg", payload)
+    await pool.rmtree(directory)
+
+
+async def measure(name: str, work) -> float:
+    lags, stop = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    started = time.monotonic()
+    await work
+    elapsed = time.monotonic() - started
+    stop.set()
+    await tick
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+    print(f"{name:<10} время {elapsed:6.2f} с  задержка loop: p99 {p99 * 1000:7.1f} мс, "
+          f"max {lags[-1] * 1000 if lags else 0:7.1f} мс, тиков {len(lags)}")
+    return p99
+
+
+async def main():
+    payload = os.urandom(PHOTO_SIZE)
+    pool = FilePool(4)
+    root = tempfile.mkdtemp()
+    print(f"{PHOTOS} фото по {PHOTO_SIZE // 1024} КБ в {root}")
+    try:
+        before = await measure("в loop", inline(f"{root}/inline", payload))
+        after = await measure("в пуле", pooled(f"{root}/pooled", payload, pool))
+        if after:
+            print(f"p99 задержки loop: x{before / after:.1f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
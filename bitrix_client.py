@@ -0,0 +1,264 @@
+"""
+Клиент REST API Битрикс24
+Одна долгоживущая aiohttp-сессия с пулом keep-alive соединений на всё приложение.
+Создается лениво при первом запросе, закрывается через close() при остановке бота
+или FastAPI приложения.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from urllib.parse import quote
+import aiohttp
+import codec
+import metrics
+from rate_limit import PriorityRateLimiter, SharedTokenBucket
+from circuit_breaker import CircuitBreaker
+from config import (
+    BITRIX_WEBHOOK,
+    BITRIX_CONNECTION_LIMIT,
+    BITRIX_CONNECTION_LIMIT_PER_HOST,
+    BITRIX_DNS_CACHE_TTL,
+    BITRIX_KEEPALIVE_TIMEOUT,
+    BITRIX_REQUEST_TIMEOUT,
+    BITRIX_CONNECT_TIMEOUT,
+    BITRIX_RATE_LIMIT,
+    BITRIX_RATE_BURST,
+    SHARED_STATE_PATH,
+    BITRIX_MAX_RETRIES,
+    BITRIX_RETRY_BASE_DELAY,
+    BITRIX_RETRY_MAX_DELAY,
+    BITRIX_BREAKER_FAILURES,
+    BITRIX_BREAKER_RECOVERY,
+    BITRIX_BREAKER_SLOW_CALL,
+)
+
+logger = logging.getLogger(__name__)
+
+# Максимум команд в одном batch-запросе Битрикс
+BATCH_LIMIT = 50
+
+# Размер страницы списочных методов Битрикс
+PAGE_SIZE = 50
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Ошибки перегрузки портала, после которых запрос стоит повторить
+RETRYABLE_ERRORS = {'QUERY_LIMIT_EXCEEDED', 'OPERATION_TIME_LIMIT'}
+RETRYABLE_STATUSES = {429, 503}
+
+
+def build_query(params: dict, prefix: str = '') -> str:
+    """Параметры метода в query-строку для batch (формат http_build_query)"""
+    parts = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            nested = build_query(value, name)
+            if nested:
+                parts.append(nested)
+        else:
+            if value is None:
+                value = ''
+            elif isinstance(value, bool):
+                value = 'Y' if value else 'N'
+            # Ссылки вида $result[cmd][0][ID] передаются как есть
+            parts.append(f"{quote(name, safe='[]')}={quote(str(value), safe='$[]')}")
+    return '&'.join(parts)
+
+
+class BitrixError(Exception):
+    """Запрос к Битрикс24 не выполнен"""
+
+
+def keyset_params(params: dict, after_id=None, descending: bool = False) -> dict:
+    """
+    Параметры страницы списка в keyset-режиме: сортировка по ID, фильтр >ID/<ID
+    и start=-1, при котором Битрикс не считает общее количество записей
+    """
+    page_filter = dict(params.get('filter') or {})
+    if after_id is not None:
+        page_filter['<ID' if descending else '>ID'] = after_id
+    return {
+        **params,
+        'filter': page_filter,
+        'order': {'ID': 'DESC' if descending else 'ASC'},
+        'start': -1,
+    }
+
+
+class BitrixClient:
+    """Пул соединений к Битрикс24 поверх одной aiohttp.ClientSession"""
+
+    def __init__(
+            self,
+            webhook: str,
+            limit: int = BITRIX_CONNECTION_LIMIT,
+            limit_per_host: int = BITRIX_CONNECTION_LIMIT_PER_HOST,
+            dns_cache_ttl: int = BITRIX_DNS_CACHE_TTL,
+            keepalive_timeout: float = BITRIX_KEEPALIVE_TIMEOUT,
+            timeout: float = BITRIX_REQUEST_TIMEOUT,
+            connect_timeout: float = BITRIX_CONNECT_TIMEOUT,
+            rate: float = BITRIX_RATE_LIMIT,
+            burst: int = BITRIX_RATE_BURST,
+            max_retries: int = BITRIX_MAX_RETRIES,
+    ):
+        self.webhook = webhook
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        # Запас токенов общий для всех процессов бота и webhook handler
+        self.limiter = PriorityRateLimiter(SharedTokenBucket(SHARED_STATE_PATH, rate, burst))
+        self.breaker = CircuitBreaker(BITRIX_BREAKER_FAILURES, BITRIX_BREAKER_RECOVERY, BITRIX_BREAKER_SLOW_CALL)
+        self.max_retries = max_retries
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Сессия создается при первом обращении (нужен запущенный event loop)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def call(self, method: str, params: dict = None, timeout: float = None):
+        """
+        Вызов метода REST API, возвращает полный JSON ответа или None при ошибке.
+        Пока предохранитель разомкнут, сразу возвращает None.
+        """
+        for attempt in range(self.max_retries + 1):
+            # Разомкнутый предохранитель отклоняет запрос сразу, не расходуя токен
+            if self.breaker.rejects():
+                return None
+            # Пробный запрос занимается только после токена: отмена в ожидании токена
+            # не должна оставить предохранитель с занятым пробным запросом
+            await self.limiter.acquire()
+            if not self.breaker.allow_request():
+                return None
+            data, retryable = await self._post(method, params, timeout)
+            if not retryable:
+                return data
+            if attempt == self.max_retries:
+                break
+            # Экспоненциальная задержка с полным джиттером
+            delay = random.uniform(0, min(BITRIX_RETRY_MAX_DELAY, BITRIX_RETRY_BASE_DELAY * 2 ** attempt))
+            metrics.inc('bitrix.retries')
+            logger.warning(f"Bitrix overloaded ({method}), retry {attempt + 1} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        metrics.inc('bitrix.retries_exhausted')
+        logger.error(f"Bitrix request {method} failed after {self.max_retries} retries")
+        return None
+
+    async def _post(self, method: str, params: dict = None, timeout: float = None):
+        """Один HTTP запрос: (JSON ответа или None, нужно ли повторить)"""
+        url = f"{self.webhook}{method}"
+        # timeout=None у aiohttp - "без таймаута", поэтому без переопределения
+        # параметр не передается и действует таймаут сессии
+        overrides = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        started = time.monotonic()
+        try:
+            async with self.session.post(url, data=codec.dumps(params or {}), headers=JSON_HEADERS,
+                                         **overrides) as response:
+                if response.status == 200:
+                    data = codec.loads(await response.read())
+                    self.breaker.record_success(time.monotonic() - started)
+                    return data, False
+                text = await response.text()
+                if response.status in RETRYABLE_STATUSES or any(error in text for error in RETRYABLE_ERRORS):
+                    metrics.inc('bitrix.throttled')
+                    self.breaker.release()
+                    return None, True
+                logger.error(f"Bitrix error {response.status}: {text}")
+                if response.status >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success(time.monotonic() - started)
+                return None, False
+        except Exception as e:
+            logger.error(f"Request error ({method}): {e!r}")
+            self.breaker.record_failure()
+            return None, False
+        except BaseException:
+            # Запрос отменен (таймаут обработчика, остановка) - состояние портала неизвестно
+            self.breaker.release()
+            raise
+        finally:
+            metrics.inc('bitrix.requests')
+            metrics.observe('bitrix.latency', time.monotonic() - started)
+
+    async def batch(self, commands: dict, halt: bool = False) -> dict:
+        """
+        Выполнить набор команд через метод batch.
+        commands: {ключ: (метод, параметры)}. Команды разбиваются на пачки по 50,
+        ссылки $result[ключ] работают только внутри одной пачки.
+        Возвращает {ключ: {'result', 'next', 'total'}} или None для неудачной команды.
+        """
+        keys = list(commands)
+        chunks = [keys[i:i + BATCH_LIMIT] for i in range(0, len(keys), BATCH_LIMIT)]
+        responses = await asyncio.gather(*(
+            self.call('batch', {
+                'halt': 1 if halt else 0,
+                'cmd': {
+                    key: f"{commands[key][0]}?{build_query(commands[key][1] or {})}"
+                    for key in chunk
+                }
+            })
+            for chunk in chunks
+        ))
+
+        results = {}
+        for chunk, response in zip(chunks, responses):
+            payload = (response or {}).get('result') or {}
+            result = payload.get('result') or {}
+            errors = payload.get('result_error') or {}
+            nexts = payload.get('result_next') or {}
+            totals = payload.get('result_total') or {}
+            for key in chunk:
+                if key in errors or key not in result:
+                    if key in errors:
+                        logger.warning(f"Batch command {key} failed: {errors[key]}")
+                    results[key] = None
+                    continue
+                results[key] = {'result': result[key]}
+                if key in nexts:
+                    results[key]['next'] = nexts[key]
+                if key in totals:
+                    results[key]['total'] = totals[key]
+        return results
+
+    async def iter_list(self, method: str, params: dict, after_id=None, descending: bool = False):
+        """
+        Асинхронный генератор страниц списочного метода (crm.*.list) в keyset-режиме.
+        Первая страница отдается сразу, следующие запрашиваются по мере чтения.
+        Если страница не загрузилась, бросает BitrixError.
+        """
+        while True:
+            response = await self.call(method, keyset_params(params, after_id, descending))
+            if not response:
+                raise BitrixError(f"{method}: page after ID {after_id} failed")
+            items = response.get('result') or []
+            if items:
+                yield items
+            if len(items) < PAGE_SIZE:
+                return
+            after_id = items[-1]['ID']
+
+    async def close(self):
+        """Закрыть сессию и все соединения пула"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Общий клиент процесса
+bitrix = BitrixClient(BITRIX_WEBHOOK)
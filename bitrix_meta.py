@@ -0,0 +1,110 @@
+"""
+Справочники Битрикс24: значения списочных полей и названия стадий сделок
+Загружаются одним batch-запросом при старте и периодически обновляются.
+Поиск значения - обращение к словарю, без запросов к Битрикс.
+"""
+
+import asyncio
+import logging
+import time
+import metrics
+from rate_limit import background_priority
+from config import BITRIX_FIELDS, CONTACT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повторной загрузкой после ошибки, сек
+RETRY_AFTER = 60
+
+
+def enumeration_items(fields: dict, field_ids) -> dict:
+    """{field_id: {item_id: значение}} для списочных полей из field_ids"""
+    enums = {}
+    for field_id in field_ids:
+        items = (fields.get(field_id) or {}).get('items') or []
+        if items:
+            enums[field_id] = {str(item.get('ID')): item.get('VALUE') for item in items}
+    return enums
+
+
+class MetadataIndex:
+    """Значения списочных UF-полей сделок и контактов и названия стадий"""
+
+    def __init__(self):
+        self.deal_enums = {}
+        self.contact_enums = {}
+        self.stages = {}
+        self.loaded_at = None
+        self.failed_at = 0.0
+        self._loading = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    async def load(self, client) -> bool:
+        """Загрузить справочники; при ошибке остаются предыдущие значения"""
+        results = await client.batch({
+            'deal_fields': ('crm.deal.fields', {}),
+            'contact_fields': ('crm.contact.fields', {}),
+            'stages': ('crm.status.list', {'filter': {'ENTITY_ID': 'DEAL_STAGE'}}),
+        })
+        if not all(results.get(key) for key in ('deal_fields', 'contact_fields', 'stages')):
+            metrics.inc('meta.load_failures')
+            self.failed_at = time.monotonic()
+            logger.warning("Справочники Битрикс не загружены, используются прежние")
+            return False
+
+        self.deal_enums = enumeration_items(results['deal_fields']['result'], BITRIX_FIELDS.values())
+        self.contact_enums = enumeration_items(results['contact_fields']['result'], CONTACT_FIELDS.values())
+        self.stages = {
+            status['STATUS_ID']: status.get('NAME')
+            for status in results['stages']['result'] or []
+        }
+        self.loaded_at = time.time()
+        logger.info(
+            f"Справочники Битрикс: {len(self.deal_enums)} полей сделок, "
+            f"{len(self.contact_enums)} полей контактов, {len(self.stages)} стадий"
+        )
+        return True
+
+    async def ensure_loaded(self, client) -> bool:
+        """Загрузить справочники, если они еще не загружены (одна загрузка на всех)"""
+        if self.loaded:
+            return True
+        if self._loading is None:
+            if time.monotonic() - self.failed_at < RETRY_AFTER:
+                return False
+            self._loading = asyncio.ensure_future(self.load(client))
+        try:
+            return await asyncio.shield(self._loading)
+        finally:
+            if self._loading is not None and self._loading.done():
+                self._loading = None
+
+    def deal_value(self, field_id: str, item_id) -> str:
+        """Значение списочного поля сделки или None"""
+        return self.deal_enums.get(field_id, {}).get(str(item_id))
+
+    def contact_value(self, field_id: str, item_id) -> str:
+        """Значение списочного поля контакта или None"""
+        return self.contact_enums.get(field_id, {}).get(str(item_id))
+
+    def stage_name(self, stage_id: str) -> str:
+        """Название стадии сделки из Битрикс или None"""
+        return self.stages.get(stage_id)
+
+
+async def refresh_loop(index: MetadataIndex, client, interval: float):
+    """Периодическое обновление справочников"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with background_priority():
+                await index.load(client)
+        except Exception as e:
+            logger.error(f"Ошибка обновления справочников: {e}")
+
+
+# Справочники процесса
+meta = MetadataIndex()
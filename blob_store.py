@@ -0,0 +1,164 @@
+"""
+Хранилище файлов по содержимому
+Файл хранится под SHA-256 своего содержимого: ab/abcdef... Одинаковые
+файлы хранятся один раз, записанный файл больше не меняется. Запись идет под
+временным ключом (хэш считается по ходу записи) и заканчивается переносом
+на ключ по содержимому - читатель видит либо весь файл, либо никакого.
+Какие файлы относятся к заказу, знает манифест документов; файлы, на которые
+манифест больше не ссылается, удаляет сборка мусора.
+Где лежат файлы - на локальном диске или в S3 - решает бэкенд (storage_backends).
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from aiogram.types import InputFile
+import metrics
+from file_pool import FilePool, READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = 'tmp/'
+
+
+class BlobInputFile(InputFile):
+    """Файл из хранилища для отправки в Telegram, читается частями из бэкенда"""
+
+    def __init__(self, backend, key: str, filename: str):
+        super().__init__(filename=filename, chunk_size=READ_CHUNK_SIZE)
+        self.backend = backend
+        self.key = key
+
+    async def read(self, bot):
+        async for chunk in self.backend.get(self.key):
+            yield chunk
+
+
+class BlobStore:
+    """Файлы с именами по SHA-256 содержимого поверх бэкенда хранения"""
+
+    def __init__(self, backend, gc_grace: float, pool: FilePool):
+        self.backend = backend
+        # Пул нужен для работы с локальными файлами (перенос старых папок, временные копии)
+        self.pool = pool
+        # Моложе этого файлы без ссылок не удаляются: ссылка на только что
+        # записанный файл появляется в манифесте чуть позже
+        self.gc_grace = gc_grace
+
+    @staticmethod
+    def key(digest: str) -> str:
+        return f"{digest[:2]}/{digest}"
+
+    async def _commit(self, temp_key: str, digest: str) -> bool:
+        """Перенести временный файл на ключ по содержимому, вернуть False, если такой файл уже есть"""
+        key = self.key(digest)
+        if await self.backend.stat(key):
+            await self.backend.delete(temp_key)
+            # Свежая отметка времени защищает файл от сборки мусора до появления ссылки
+            await self.backend.touch(key)
+            metrics.inc('blobs.deduplicated')
+            return False
+        await self.backend.move(temp_key, key)
+        metrics.inc('blobs.stored')
+        return True
+
+    async def receive(self, chunks) -> tuple:
+        """
+        Записать файл из асинхронного потока частей (скачивание из Telegram).
+        Возвращает (SHA-256, размер).
+        """
+        digest = hashlib.sha256()
+
+        async def hashed():
+            async for chunk in chunks:
+                digest.update(chunk)
+                yield chunk
+
+        temp_key = f"{TEMP_PREFIX}{uuid.uuid4().hex}"
+        try:
+            size = await self.backend.put(temp_key, hashed())
+            await self._commit(temp_key, digest.hexdigest())
+        except BaseException:
+            await self.backend.delete(temp_key)
+            raise
+        return digest.hexdigest(), size
+
+    async def put_bytes(self, data: bytes) -> tuple:
+        """Записать содержимое из памяти, вернуть (SHA-256, размер)"""
+        async def chunks():
+            yield data
+        return await self.receive(chunks())
+
+    async def put_file(self, source: str) -> tuple:
+        """Скопировать локальный файл в хранилище, вернуть (SHA-256, размер)"""
+        return await self.receive(self.pool.read_chunks(source))
+
+    async def exists(self, digest: str) -> bool:
+        return await self.backend.stat(self.key(digest)) is not None
+
+    async def delete(self, digest: str):
+        """Удалить файл, на который точно никто не ссылается (не дожидаясь сборки мусора)"""
+        await self.backend.delete(self.key(digest))
+
+    async def size(self, digest: str) -> int:
+        """Размер файла в байтах (0, если файла нет)"""
+        info = await self.backend.stat(self.key(digest))
+        return info.size if info else 0
+
+    def input_file(self, digest: str, filename: str) -> BlobInputFile:
+        """Файл для отправки в Telegram под именем filename"""
+        return BlobInputFile(self.backend, self.key(digest), filename)
+
+    def presigned_url(self, digest: str, expires: int):
+        """Ссылка на скачивание файла (None, если бэкенд ссылок не дает)"""
+        return self.backend.presigned_url(self.key(digest), expires)
+
+    @staticmethod
+    def _temp_copy() -> tuple:
+        fd, path = tempfile.mkstemp(suffix='.blob')
+        return path, os.fdopen(fd, 'wb')
+
+    @asynccontextmanager
+    async def local_copy(self, digest: str):
+        """Путь к файлу на локальном диске (для бэкендов без локальных файлов - временная копия)"""
+        path = self.backend.local_path(self.key(digest))
+        if path:
+            yield path
+            return
+        path, file = await self.pool.run(self._temp_copy)
+        try:
+            try:
+                async for chunk in self.backend.get(self.key(digest)):
+                    await self.pool.run(file.write, chunk)
+            finally:
+                await self.pool.run(file.close)
+            yield path
+        finally:
+            await self.pool.run(os.remove, path)
+
+    async def collect_garbage(self, referenced: set) -> tuple:
+        """
+        Удалить файлы, на которые нет ссылок, и брошенные временные файлы.
+        Возвращает (количество, освобождено байт).
+        """
+        deadline = time.time() - self.gc_grace
+        removed = freed = 0
+        for info in await self.backend.list():
+            if info.modified > deadline:
+                continue
+            if not info.key.startswith(TEMP_PREFIX) and info.key.rsplit('/', 1)[-1] in referenced:
+                continue
+            await self.backend.delete(info.key)
+            removed += 1
+            freed += info.size
+        if removed:
+            metrics.inc('blobs.collected', removed)
+            logger.info(f"Хранилище файлов: удалено {removed} файлов без ссылок, освобождено {freed} байт")
+        return removed, freed
+
+    async def close(self):
+        await self.backend.close()
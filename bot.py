@@ -1,26 +1,84 @@
 import asyncio
 import logging
-import os
 import re
-import shutil
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, \
-    InlineKeyboardButton, ReplyKeyboardRemove, FSInputFile, InputMediaPhoto
+    InlineKeyboardButton, ReplyKeyboardRemove, InputFile, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-import aiohttp
+from bitrix_client import bitrix, keyset_params, PAGE_SIZE
+from rate_limit import background_priority
+from cache import TTLCache
+from phone_index import PhoneIndex, refresh_loop
+from deal_mirror import DealMirror, sync_loop
+from models import Deal, select_for
+from user_registry import UserRegistry
+from shared_state import DealStages, watch_loop
+from fsm_storage import SQLiteStorage
+from file_pool import FilePool
+from storage_backends import LocalBackend, S3Backend
+from blob_store import BlobStore
+from photo_pipeline import PhotoPipeline
+from document_manifest import DocumentManifest, Document, reconcile_loop, INVOICE, PHOTO, invoice_name, \
+    watch_loop as documents_watch_loop
+from document_archive import DocumentArchive, archive_loop
+from media_groups import MediaGroupCollector
+from download_queue import DownloadQueue
+from bitrix_meta import meta, refresh_loop as meta_refresh_loop
+import metrics
+from singleflight import single_flight
 from config import (
     get_stage_name,
     get_stage_emoji,
     format_date,
     format_price,
-    parse_bitrix_money_with_currency,
+    format_quantity,
     clean_phone,
-    BITRIX_FIELDS,
     format_name,
-    get_category_name
+    get_category_name,
+    DEAL_CACHE_SIZE,
+    DEAL_CACHE_TTL,
+    DEAL_LIST_CACHE_SIZE,
+    DEAL_LIST_CACHE_TTL,
+    PHONE_INDEX_PATH,
+    PHONE_INDEX_TTL,
+    PHONE_INDEX_NEGATIVE_TTL,
+    PHONE_INDEX_REFRESH_INTERVAL,
+    PHONE_INDEX_REFRESH_AFTER,
+    MIRROR_DB_PATH,
+    MIRROR_SYNC_INTERVAL,
+    META_REFRESH_INTERVAL,
+    USERS_DB_PATH,
+    SHARED_STATE_PATH,
+    SHARED_STATE_POLL_INTERVAL,
+    FSM_DB_PATH,
+    FSM_STATE_TTL,
+    DOCUMENTS_DB_PATH,
+    DOCUMENTS_RECONCILE_INTERVAL,
+    ARCHIVE_INTERVAL,
+    ARCHIVE_IDLE,
+    BLOBS_DIR,
+    BLOB_GC_GRACE,
+    STORAGE_BACKEND,
+    S3_ENDPOINT,
+    S3_BUCKET,
+    S3_ACCESS_KEY,
+    S3_SECRET_KEY,
+    S3_REGION,
+    S3_PART_SIZE,
+    FILE_POOL_SIZE,
+    LOOP_LAG_INTERVAL,
+    PHOTO_PROCESS_WORKERS,
+    PHOTO_MAX_SIDE,
+    PHOTO_QUALITY,
+    PHOTO_THUMB_SIDE,
+    PHOTO_THUMB_QUALITY,
+    MEDIA_GROUP_DELAY,
+    DOWNLOADS_DB_PATH,
+    DOWNLOAD_CONCURRENCY,
+    DOWNLOAD_MAX_ATTEMPTS,
+    DOWNLOAD_RETRY_DELAY
 )
 
 # ====== НАСТРОЙКИ ======
@@ -28,13 +86,16 @@ BOT_TOKEN = "8258111612:AAEmqjXRxRlcKAuiBDgLilOOBlz_CmLvmIg"
 BITRIX_WEBHOOK = "https://sunway24.bitrix24.ru/rest/326/fiwux7q90yclt8l1/"
 ADMIN_IDS = [999232338, 1291085389, 785219206]
 
-# Директории для файлов
+# Старые директории для файлов (переносятся в хранилище при запуске)
 INVOICES_DIR = "invoices"
 PHOTOS_DIR = "product_photos"
 
 # Пагинация
 DEALS_PER_PAGE = 10
 
+# Пометка для данных, показанных без связи с Битрикс
+STALE_DATA_NOTE = "\n\n⚠️ <i>Нет связи с CRM, данные могут быть устаревшими</i>"
+
 # Логирование
 logging.basicConfig(
     level=logging.INFO,
@@ -58,11 +119,50 @@ class AdminStates(StatesGroup):
 
 # Инициализация
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = SQLiteStorage(FSM_DB_PATH, FSM_STATE_TTL)
 dp = Dispatcher(storage=storage)
 
-# База данных
-user_phones = {}
+# База данных пользователей
+users = UserRegistry(USERS_DB_PATH)
+
+# Последние известные стадии сделок (общие с webhook handler)
+deal_stages = DealStages(SHARED_STATE_PATH)
+
+# Накладные и фото заказов: файлы по содержимому + манифест ссылок на них
+file_pool = FilePool(FILE_POOL_SIZE)
+if STORAGE_BACKEND == 's3':
+    storage_backend = S3Backend(S3_ENDPOINT, S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY, S3_REGION, S3_PART_SIZE)
+else:
+    storage_backend = LocalBackend(BLOBS_DIR, file_pool)
+blobs = BlobStore(storage_backend, BLOB_GC_GRACE, file_pool)
+documents = DocumentManifest(DOCUMENTS_DB_PATH, blobs)
+document_archive = DocumentArchive(documents, ARCHIVE_IDLE)
+
+# Поворот, уменьшение и превью фото товара после скачивания
+photo_pipeline = PhotoPipeline(
+    PHOTO_PROCESS_WORKERS, PHOTO_MAX_SIDE, PHOTO_QUALITY, PHOTO_THUMB_SIDE, PHOTO_THUMB_QUALITY
+)
+
+# Альбомы фото от админа собираются целиком перед сохранением
+media_groups = MediaGroupCollector(MEDIA_GROUP_DELAY)
+
+# Фоновое скачивание загруженных админом файлов
+downloads = DownloadQueue(
+    DOWNLOADS_DB_PATH, blobs, DOWNLOAD_CONCURRENCY, DOWNLOAD_MAX_ATTEMPTS, DOWNLOAD_RETRY_DELAY
+)
+
+# Кэш сделок: deal_id -> сделка, (active|archived, контакты) -> страницы заказов
+deal_cache = TTLCache(DEAL_CACHE_SIZE, DEAL_CACHE_TTL, name='deal')
+deal_list_cache = TTLCache(DEAL_LIST_CACHE_SIZE, DEAL_LIST_CACHE_TTL, name='deal_list')
+
+# Фоновые задачи подгрузки следующих страниц
+prefetch_tasks = set()
+
+# Индекс телефон -> контакты Битрикс (на диске)
+phone_index = PhoneIndex(PHONE_INDEX_PATH, PHONE_INDEX_TTL, PHONE_INDEX_NEGATIVE_TTL)
+
+# Локальная копия сделок (SQLite), общая с webhook handler
+deal_mirror = DealMirror(MIRROR_DB_PATH)
 
 
 # Проверка админа
@@ -70,245 +170,406 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
+def stale_note() -> str:
+    """Пометка об устаревших данных, пока Битрикс недоступен"""
+    return STALE_DATA_NOTE if bitrix.breaker.is_open else ""
+
+
 # ====== ФУНКЦИИ ДЛЯ РАБОТЫ С БИТРИКС ======
 
 async def bitrix_request(method: str, params: dict = None):
     """Универсальный запрос к Битрикс24"""
-    url = f"{BITRIX_WEBHOOK}{method}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=params or {}) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('result', [])
-                else:
-                    text = await response.text()
-                    logger.error(f"Bitrix error {response.status}: {text}")
-                    return None
-    except Exception as e:
-        logger.error(f"Request error: {e}")
+    data = await bitrix.call(method, params)
+    if data is None:
         return None
+    return data.get('result', [])
 
 
 async def bitrix_request_full(method: str, params: dict = None):
     """Запрос к Битрикс24 с полным ответом (для пагинации)"""
-    url = f"{BITRIX_WEBHOOK}{method}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=params or {}) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    text = await response.text()
-                    logger.error(f"Bitrix error {response.status}: {text}")
-                    return None
-    except Exception as e:
-        logger.error(f"Request error: {e}")
-        return None
+    return await bitrix.call(method, params)
 
 
-async def find_client_by_phone(phone: str):
-    """Поиск клиента в Битрикс по телефону"""
+def get_phone_variants(phone: str) -> list:
+    """Варианты записи номера, под которыми он может храниться в Битрикс"""
     cleaned_phone = clean_phone(phone)
-    phone_variants = [
+    return [
         cleaned_phone,
         f"+{cleaned_phone}",
         f"8{cleaned_phone[1:]}",
     ]
-    for variant in phone_variants:
-        params = {
+
+
+def contact_search_commands(phone: str, with_details: bool = False) -> dict:
+    """Команды batch для поиска контакта по всем вариантам номера"""
+    commands = {}
+    for idx, variant in enumerate(get_phone_variants(phone)):
+        commands[f"phone_{idx}"] = ('crm.contact.list', {
             'filter': {'PHONE': variant},
             'select': ['ID', 'NAME', 'LAST_NAME', 'EMAIL', 'PHONE']
-        }
-        result = await bitrix_request('crm.contact.list', params)
-        if result:
+        })
+        if with_details:
+            # Полная карточка первого найденного контакта в том же запросе
+            commands[f"contact_{idx}"] = ('crm.contact.get', {'ID': f"$result[phone_{idx}][0][ID]"})
+    return commands
+
+
+async def resolve_phone(phone: str, refresh: bool = False):
+    """
+    Контакты по телефону: (основной контакт с карточкой, все контакты с этим номером).
+    Сначала индекс телефонов на диске, затем один batch-запрос к Битрикс.
+    """
+    key = clean_phone(phone)
+    if not refresh:
+        entry = phone_index.get(key)
+        if entry is not None:
+            return entry['primary'], entry['contacts']
+    return await fetch_phone_contacts(key)
+
+
+@single_flight('phone', key=lambda phone: clean_phone(phone))
+async def fetch_phone_contacts(phone: str):
+    """Поиск контактов в Битрикс по всем вариантам номера с записью в индекс"""
+    phone_variants = get_phone_variants(phone)
+    results = await bitrix.batch(contact_search_commands(phone, with_details=True))
+
+    primary = None
+    all_contacts = []
+    seen_ids = set()
+    for idx, variant in enumerate(phone_variants):
+        found = results.get(f"phone_{idx}")
+        if found is None:
+            # Ошибка запроса - не запоминаем номер как неизвестный
+            logger.warning(f"Поиск по номеру {variant} не выполнен")
+            return primary, all_contacts
+        result = found['result']
+        if not result:
+            continue
+
+        if primary is None:
             contact = result[0]
             logger.info(
                 f"Найден контакт: ID={contact.get('ID')}, {contact.get('NAME')} {contact.get('LAST_NAME')}, тел: {variant}")
             if len(result) > 1:
                 logger.warning(f"ВНИМАНИЕ: Найдено {len(result)} контактов с телефоном {variant}!")
-                for c in result:
-                    logger.info(f"  - ID:{c.get('ID')} | {c.get('NAME')} {c.get('LAST_NAME')}")
-            return contact
-    return None
+            details = results.get(f"contact_{idx}")
+            primary = {**contact, **details['result']} if details and details['result'] else contact
 
-
-async def find_all_clients_by_phone(phone: str):
-    """Поиск ВСЕХ клиентов в Битрикс по телефону (для дублей)"""
-    cleaned_phone = clean_phone(phone)
-    phone_variants = [
-        cleaned_phone,
-        f"+{cleaned_phone}",
-        f"8{cleaned_phone[1:]}",
-    ]
-    all_contacts = []
-    seen_ids = set()
-
-    for variant in phone_variants:
-        params = {
-            'filter': {'PHONE': variant},
-            'select': ['ID', 'NAME', 'LAST_NAME', 'EMAIL', 'PHONE']
-        }
-        result = await bitrix_request('crm.contact.list', params)
-        if result:
-            for contact in result:
-                if contact['ID'] not in seen_ids:
-                    seen_ids.add(contact['ID'])
-                    all_contacts.append(contact)
+        for contact in result:
+            if contact['ID'] not in seen_ids:
+                seen_ids.add(contact['ID'])
+                all_contacts.append(contact)
 
     if all_contacts:
         logger.info(f"Найдено контактов по телефону: {len(all_contacts)}")
         for c in all_contacts:
             logger.info(f"  - ID:{c.get('ID')} | {c.get('NAME')} {c.get('LAST_NAME')}")
 
-    return all_contacts
-
-
-async def get_active_deals(client_id: str):
-    """Получение всех активных заказов клиента с пагинацией"""
-    all_deals = []
-    start = 0
-
-    while True:
-        params = {
-            'filter': {
-                'CONTACT_ID': client_id,
-                'CLOSED': 'N'
-            },
-            'select': [
-                'ID', 'TITLE', 'DATE_CREATE', 'STAGE_ID', 'OPPORTUNITY', 'CLOSED',
-                BITRIX_FIELDS['client_id'],
-                BITRIX_FIELDS['weight'],
-                BITRIX_FIELDS['volume'],
-                BITRIX_FIELDS['product_category'],
-                BITRIX_FIELDS['expected_send_date'],
-                BITRIX_FIELDS['expected_arrival_date'],
-                BITRIX_FIELDS['insurance'],
-                BITRIX_FIELDS['invoice_file'],
-                BITRIX_FIELDS['product_photos'],
-                BITRIX_FIELDS['invoice_cost']
-            ],
-            'start': start
-        }
-        response = await bitrix_request_full('crm.deal.list', params)
-
-        if not response:
-            break
-
-        result = response.get('result', [])
-
-        if result:
-            all_deals.extend(result)
-
-        if 'next' not in response:
-            break
-
-        start = response['next']
-
-    logger.info(f"Активных сделок для контакта {client_id}: {len(all_deals)}")
-    return all_deals
-
-
-async def get_archived_deals(client_id: str):
-    """Получение всех завершенных заказов с пагинацией"""
-    all_deals = []
-    start = 0
-
-    while True:
-        params = {
-            'filter': {
-                'CONTACT_ID': client_id,
-                'CLOSED': 'Y'
-            },
-            'select': [
-                'ID', 'TITLE', 'DATE_CREATE', 'DATE_MODIFY', 'STAGE_ID', 'OPPORTUNITY',
-                'CURRENCY_ID',
-                BITRIX_FIELDS['client_id'],
-                BITRIX_FIELDS['weight'],
-                BITRIX_FIELDS['volume'],
-                BITRIX_FIELDS['product_category'],
-                BITRIX_FIELDS['expected_send_date'],
-                BITRIX_FIELDS['expected_arrival_date'],
-                BITRIX_FIELDS['insurance'],
-                BITRIX_FIELDS['invoice_cost']
-            ],
-            'start': start
-        }
-        response = await bitrix_request_full('crm.deal.list', params)
+    await phone_index.put(clean_phone(phone), primary, all_contacts)
+    return primary, all_contacts
+
+
+async def find_client_by_phone(phone: str):
+    """Поиск клиента в Битрикс по телефону"""
+    primary, _ = await resolve_phone(phone)
+    return primary
+
+
+async def find_all_clients_by_phone(phone: str):
+    """Поиск ВСЕХ клиентов в Битрикс по телефону (для дублей)"""
+    _, contacts = await resolve_phone(phone)
+    return contacts
 
-        if not response:
-            break
 
-        result = response.get('result', [])
-        if result:
-            all_deals.extend(result)
+# Поля, запрашиваемые для списков заказов и для карточки заказа
+DEAL_LIST_SELECT = select_for('list')
+DEAL_CARD_SELECT = select_for('details', 'archive', 'service')
 
-        if 'next' not in response:
-            break
 
-        start = response['next']
+def deals_params(contact_ids: list, closed: bool) -> dict:
+    """Параметры crm.deal.list для активных или завершенных заказов контактов"""
+    return {
+        'filter': {
+            'CONTACT_ID': contact_ids[0] if len(contact_ids) == 1 else list(contact_ids),
+            'CLOSED': 'Y' if closed else 'N'
+        },
+        'select': DEAL_LIST_SELECT
+    }
+
 
-    return all_deals
+def deal_pages_key(contact_ids: list, closed: bool) -> tuple:
+    """Ключ кэша страниц заказов: (active|archived, ID контактов через запятую)"""
+    return 'archived' if closed else 'active', ','.join(sorted(map(str, contact_ids)))
+
+
+def store_deal_pages(key: tuple, pages: dict):
+    """Добавить страницы в кэш: курсор -> (заказы, курсор следующей страницы)"""
+    cached = deal_list_cache.get(key) or {}
+    deal_list_cache.set(key, {**cached, **pages})
+
+
+def prefetch(coro):
+    """Подгрузить данные заранее в фоновой задаче (с фоновым приоритетом к Битрикс)"""
+    with background_priority():
+        task = asyncio.create_task(coro)
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+
+async def get_deals_page(contact_ids: list, closed: bool, cursor: str = None):
+    """
+    Страница заказов контактов (новые сверху) и курсор следующей страницы.
+    Курсор - ID последнего заказа предыдущей страницы, None - первая страница.
+    Следующая страница подгружается в фоне, пока клиент смотрит текущую.
+    """
+    key = deal_pages_key(contact_ids, closed)
+    page = (deal_list_cache.get(key) or {}).get(cursor)
+    if page is None:
+        page = await fetch_deals_page(contact_ids, closed, cursor)
+    if page is None:
+        return [], None
+
+    next_cursor = page[1]
+    if next_cursor and next_cursor not in (deal_list_cache.get(key) or {}):
+        prefetch(fetch_deals_page(contact_ids, closed, next_cursor))
+    return page
+
+
+@single_flight('deal_page', key=lambda contact_ids, closed, cursor=None: (deal_pages_key(contact_ids, closed), cursor))
+async def fetch_deals_page(contact_ids: list, closed: bool, cursor: str = None):
+    """Загрузка страницы заказов из локальной копии или Битрикс в кэш"""
+    key = deal_pages_key(contact_ids, closed)
+    if await deal_mirror.is_ready():
+        page = await deal_mirror.list_page(contact_ids, closed, cursor, DEALS_PER_PAGE)
+        store_deal_pages(key, {cursor: page})
+        return page
+
+    params = keyset_params(deals_params(contact_ids, closed), after_id=cursor, descending=True)
+    result = await bitrix_request('crm.deal.list', params)
+    if result is None:
+        # Битрикс недоступен - последняя известная версия страницы
+        return (deal_list_cache.get_stale(key) or {}).get(cursor)
+
+    # Битрикс отдает до 50 сделок за запрос - раскладываем их на несколько страниц
+    deals = [Deal.from_bitrix(raw) for raw in result]
+    pages = {}
+    page_cursor = cursor
+    for start in range(0, max(len(deals), 1), DEALS_PER_PAGE):
+        page_deals = deals[start:start + DEALS_PER_PAGE]
+        has_more = start + DEALS_PER_PAGE < len(deals) or len(deals) == PAGE_SIZE
+        next_cursor = page_deals[-1].id if page_deals and has_more else None
+        pages[page_cursor] = (page_deals, next_cursor)
+        page_cursor = next_cursor
+    store_deal_pages(key, pages)
+    return pages[cursor]
+
+
+async def count_deals(contact_ids: list, closed: bool):
+    """Количество заказов по локальной копии; None, если копия еще не готова"""
+    if await deal_mirror.is_ready():
+        return await deal_mirror.count(contact_ids, closed)
+    return None
 
 
-async def get_deal_details(deal_id: str):
+async def get_deal_details(deal_id: str, refresh: bool = False):
     """Детали конкретного заказа"""
+    if not refresh:
+        deal = deal_cache.get(str(deal_id))
+        if deal is not None:
+            return deal
+        if await deal_mirror.is_ready():
+            deal = await deal_mirror.get(deal_id)
+            if deal is not None:
+                deal_cache.set(str(deal_id), deal)
+                return deal
+    return await fetch_deal_details(deal_id)
+
+
+@single_flight('deal', key=lambda deal_id: str(deal_id))
+async def fetch_deal_details(deal_id: str):
+    """Загрузка сделки из Битрикс в кэш (только поля карточки заказа)"""
     params = {
-        'ID': deal_id,
-        'select': [
-            'ID', 'TITLE', 'DATE_CREATE', 'STAGE_ID', 'OPPORTUNITY',
-            'CURRENCY_ID',
-            BITRIX_FIELDS['client_id'],
-            BITRIX_FIELDS['weight'],
-            BITRIX_FIELDS['volume'],
-            BITRIX_FIELDS['product_category'],
-            BITRIX_FIELDS['expected_send_date'],
-            BITRIX_FIELDS['expected_arrival_date'],
-            BITRIX_FIELDS['insurance'],
-            BITRIX_FIELDS['invoice_cost']
-        ]
+        'filter': {'ID': deal_id},
+        'select': DEAL_CARD_SELECT
     }
-    result = await bitrix_request('crm.deal.get', params)
-    return result if result else None
+    result = await bitrix_request('crm.deal.list', params)
+    if not result:
+        # Битрикс недоступен - отдаем последнюю известную версию сделки
+        return deal_cache.get_stale(str(deal_id))
+    await deal_mirror.upsert(result)
+    deal = Deal.from_bitrix(result[0])
+    deal_cache.set(str(deal_id), deal)
+    return deal
+
+
+def invalidate_client_deals(client_id: str):
+    """
+    Сбросить кэш страниц заказов клиента.
+    Страницы админки по нескольким контактам-дублям истекают по времени жизни кэша.
+    """
+    deal_list_cache.invalidate(deal_pages_key([client_id], closed=False))
+    deal_list_cache.invalidate(deal_pages_key([client_id], closed=True))
+
+
+def on_mirror_change(deals: list):
+    """Сбросить кэш сделок, которые пришли с синхронизацией копии"""
+    for deal in deals:
+        deal_cache.invalidate(str(deal['ID']))
+        if deal.get('CONTACT_ID'):
+            invalidate_client_deals(deal['CONTACT_ID'])
+
+
+def on_shared_change(deals: list):
+    """Сбросить кэш сделок, которые обновил другой процесс (webhook handler)"""
+    for deal_id, contact_id in deals:
+        deal_cache.invalidate(deal_id)
+        if contact_id:
+            invalidate_client_deals(contact_id)
+
+
+async def refresh_deal(deal_id: str):
+    """
+    Обновить сделку в кэше по событию из Битрикс (вебхук изменения сделки).
+    Списки заказов клиента сбрасываются, т.к. сделка могла сменить стадию или контакт.
+    """
+    old_deal = deal_cache.get(str(deal_id))
+    deal_cache.invalidate(str(deal_id))
+    deal = await get_deal_details(deal_id, refresh=True)
+
+    for current in (old_deal, deal):
+        if current and current.contact_id:
+            invalidate_client_deals(current.contact_id)
+    return deal
+
+
+def telegram_input(entry, name: str):
+    """file_id документа, если он уже загружен в Telegram, иначе сам файл"""
+    if entry.file_id:
+        metrics.inc('file_ids.hits')
+        return entry.file_id
+    metrics.inc('file_ids.misses')
+    return documents.input_file(entry, name)
+
+
+async def restore_archived(deal_id: str, entries):
+    """
+    Документы заказа для отправки. Если какой-то из entries нельзя отправить
+    по file_id, а его файл в архиве, заказ сначала восстанавливается из архива.
+    """
+    if any(entry.archive and not entry.file_id for entry in entries):
+        await document_archive.restore(deal_id)
+    return documents.get(deal_id)
+
+
+async def remember_upload(media, deal_id: str, kind: str, name: str, file_id: str, preview: bool = False):
+    """Запомнить file_id документа, который был загружен (а не отправлен по file_id)"""
+    if isinstance(media, InputFile):
+        await documents.set_file_id(deal_id, kind, name, file_id, preview)
+
+
+async def store_documents(deal_id: str, kind: str, files: list):
+    """
+    Принять документы от админа, files - [(file_id, размер), ...]: file_id
+    запоминаются сразу (документы уже можно отправлять клиенту), файлы
+    скачиваются в хранилище фоновой очередью.
+    Возвращает (имена документов, документы заказа).
+    """
+    entries = [Document(size or 0, None, file_id) for file_id, size in files]
+    names, deal_documents = await documents.add_many(deal_id, kind, entries)
+    await downloads.enqueue(deal_id, kind, [(name, entry.file_id) for name, entry in zip(names, entries)])
+    return names, deal_documents
+
+
+async def on_document_downloaded(job: dict, digest: str, size: int):
+    """
+    Файл скачан: документ заказа ссылается на него в хранилище.
+    Фото перед этим обрабатывается; оригинал, если копия меньше, удалит сборка мусора.
+    """
+    thumb = None
+    if job['kind'] == PHOTO:
+        async with blobs.local_copy(digest) as path:
+            rendered = await photo_pipeline.process(path)
+        if rendered:
+            photo, preview = rendered
+            if len(photo) < size:
+                metrics.inc('photos.bytes_saved', size - len(photo))
+                digest, size = await blobs.put_bytes(photo)
+            thumb, _ = await blobs.put_bytes(preview)
+    await documents.settle(job['deal_id'], job['kind'], job['name'], size, digest, job['file_id'], thumb)
+
+
+async def on_document_download_failed(job: dict, error: Exception):
+    """Файл не скачался: документ отдается клиентам по file_id, админам - сообщение"""
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(
+                admin_id,
+                f"⚠️ <b>Файл не сохранен в хранилище</b>\n\n"
+                f"Заказ #{job['deal_id']}, {job['name']}: {error}\n"
+                f"Клиенты получают его из Telegram. Если файл пропадет, загрузите его заново.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 К заказу", callback_data=f"admin_deal_{job['deal_id']}")]
+                ]),
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка уведомления админа {admin_id} о скачивании: {e}")
 
 
-async def get_deals_by_phone(phone: str):
-    """Получить все сделки по номеру телефона (включая дубли контактов)"""
-    contacts = await find_all_clients_by_phone(phone)
-    if not contacts:
-        return None, None
+async def send_invoice(chat_id, deal_id: str, caption: str):
+    """Отправить накладную заказа (по file_id, если она уже загружалась)"""
+    deal_documents = await restore_archived(deal_id, [documents.get(deal_id).invoice])
+    doc = telegram_input(deal_documents.invoice, invoice_name(deal_id))
+    sent = await bot.send_document(chat_id, doc, caption=caption, parse_mode="HTML")
+    await remember_upload(doc, deal_id, INVOICE, invoice_name(deal_id), sent.document.file_id)
+
 
-    # Собираем сделки со всех контактов
-    all_deals = []
-    for contact in contacts:
-        deals = await get_active_deals(contact['ID'])
-        all_deals.extend(deals)
+async def send_photo_albums(chat_id, deal_id: str, caption: str, preview: bool = False) -> int:
+    """
+    Отправить фото заказа альбомами по 10 (по file_id, если фото уже загружались).
+    preview - отправить превью вместо фото.
+    """
+    def to_send(deal_documents):
+        return {
+            photo_file: entry.preview() if preview else entry for photo_file, entry in deal_documents.photos.items()
+        }
+
+    deal_documents = await restore_archived(deal_id, to_send(documents.get(deal_id)).values())
+    photos = sorted(deal_documents.photos)
+    entries = to_send(deal_documents)
 
-    # Убираем дубли сделок (на всякий случай)
-    seen_deal_ids = set()
-    unique_deals = []
-    for deal in all_deals:
-        if deal['ID'] not in seen_deal_ids:
-            seen_deal_ids.add(deal['ID'])
-            unique_deals.append(deal)
+    for start in range(0, len(photos), 10):
+        batch = photos[start:start + 10]
+        inputs = [telegram_input(entries[photo_file], photo_file) for photo_file in batch]
 
-    logger.info(f"Всего уникальных сделок по телефону: {len(unique_deals)}")
+        # Альбом - от 2 до 10 фото, одиночное фото отправляется отдельно
+        if len(inputs) == 1:
+            sent = [await bot.send_photo(chat_id, inputs[0], caption=caption if start == 0 else None,
+                                         parse_mode="HTML")]
+        else:
+            media = []
+            for idx, item in enumerate(inputs):
+                if start == 0 and idx == 0:
+                    media.append(InputMediaPhoto(media=item, caption=caption, parse_mode="HTML"))
+                else:
+                    media.append(InputMediaPhoto(media=item))
+            sent = await bot.send_media_group(chat_id, media)
 
-    # Возвращаем первый контакт для отображения имени
-    return contacts[0], unique_deals
+        for photo_file, item, message in zip(batch, inputs, sent):
+            is_preview = entries[photo_file] is not deal_documents.photos[photo_file]
+            await remember_upload(item, deal_id, PHOTO, photo_file, message.photo[-1].file_id, is_preview)
+
+    return len(photos)
 
 
 async def send_invoice_to_client(deal_id: str, client_telegram_id: str):
     """Отправка накладной"""
-    local_invoice = f"{INVOICES_DIR}/{deal_id}.pdf"
-    if os.path.exists(local_invoice):
+    if documents.has_invoice(deal_id):
         try:
-            doc = FSInputFile(local_invoice)
-            await bot.send_document(
+            await send_invoice(
                 client_telegram_id,
-                doc,
-                caption=f"📄 <b>Накладная для заказа #{deal_id}</b>\n\nВаша накладная готова!",
-                parse_mode="HTML"
+                deal_id,
+                f"📄 <b>Накладная для заказа #{deal_id}</b>\n\nВаша накладная готова!"
             )
             logger.info(f"✅ Накладная отправлена")
             return True
@@ -319,62 +580,67 @@ async def send_invoice_to_client(deal_id: str, client_telegram_id: str):
 
 async def send_warehouse_photos(deal_id: str, client_telegram_id: str):
     """Отправка фото"""
-    local_photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    if os.path.exists(local_photos_dir):
-        photos = os.listdir(local_photos_dir)
-        if photos:
-            try:
-                for idx, photo_file in enumerate(sorted(photos)):
-                    photo_path = f"{local_photos_dir}/{photo_file}"
-                    photo = FSInputFile(photo_path)
-
-                    caption = None
-                    if idx == 0:
-                        caption = f"📸 <b>Фото товара на складе</b>\n\nЗаказ #{deal_id}"
-
-                    await bot.send_photo(
-                        client_telegram_id,
-                        photo,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-
-                logger.info(f"✅ {len(photos)} фото отправлены")
-                return True
-            except Exception as e:
-                logger.error(f"Ошибка отправки фото: {e}")
-    return False
-
+    deal_documents = await restore_archived(deal_id, documents.get(deal_id).photos.values())
+    photos = sorted(deal_documents.photos)
+    if photos:
+        try:
+            for idx, photo_file in enumerate(photos):
+                photo = telegram_input(deal_documents.photos[photo_file], photo_file)
 
-async def has_invoice(deal_id: str) -> bool:
-    """Проверить, есть ли накладная"""
-    return os.path.exists(f"{INVOICES_DIR}/{deal_id}.pdf")
+                caption = None
+                if idx == 0:
+                    caption = f"📸 <b>Фото товара на складе</b>\n\nЗаказ #{deal_id}"
 
+                sent = await bot.send_photo(
+                    client_telegram_id,
+                    photo,
+                    caption=caption,
+                    parse_mode="HTML"
+                )
+                await remember_upload(photo, deal_id, PHOTO, photo_file, sent.photo[-1].file_id)
 
-async def has_photos(deal_id: str) -> bool:
-    """Проверить, есть ли фото"""
-    local_photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    if os.path.exists(local_photos_dir):
-        files = os.listdir(local_photos_dir)
-        return len(files) > 0
+            logger.info(f"✅ {len(photos)} фото отправлены")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отправки фото: {e}")
     return False
 
 
+async def notify_stage_change(deal_id: str, new_stage: str):
+    """Уведомление клиента о смене статуса заказа"""
+    deal = await get_deal_details(deal_id)
+    if not deal:
+        return False
+
+    client_telegram_ids = users.telegram_ids(deal.contact_id)
+    for client_telegram_id in client_telegram_ids:
+        try:
+            await bot.send_message(
+                client_telegram_id,
+                f"{get_stage_emoji(new_stage)} <b>Статус заказа #{deal_id} изменен</b>\n\n"
+                f"📦 {deal.title or 'Без названия'}\n"
+                f"Новый статус: <b>{get_stage_name(new_stage)}</b>",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="📦 Мои заказы", callback_data="current_orders")]
+                ]),
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка уведомления {client_telegram_id} о смене статуса: {e}")
+    return bool(client_telegram_ids)
+
+
 async def notify_on_document_upload(deal_id: str, doc_type: str = "invoice", admin_id: int = None):
     """Автоматическое уведомление клиента при загрузке документа"""
     deal = await get_deal_details(deal_id)
     if not deal:
         return False
 
-    contact_id = deal.get('CONTACT_ID')
+    contact_id = deal.contact_id
 
-    client_telegram_id = None
-    for user_id, user_data in user_phones.items():
-        if user_data.get('client_id') == str(contact_id):
-            client_telegram_id = user_id
-            break
+    client_telegram_ids = users.telegram_ids(contact_id)
 
-    if client_telegram_id:
+    if client_telegram_ids:
         if doc_type == "invoice":
             emoji = "📄"
             text = "Накладная готова!"
@@ -382,16 +648,17 @@ async def notify_on_document_upload(deal_id: str, doc_type: str = "invoice", adm
             emoji = "📸"
             text = "Фото товара загружены!"
 
-        await bot.send_message(
-            client_telegram_id,
-            f"{emoji} <b>Уведомление по заказу #{deal_id}</b>\n\n"
-            f"{text}\n"
-            f"Перейдите в личный кабинет для просмотра.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📦 Мои заказы", callback_data="current_orders")]
-            ]),
-            parse_mode="HTML"
-        )
+        for client_telegram_id in client_telegram_ids:
+            await bot.send_message(
+                client_telegram_id,
+                f"{emoji} <b>Уведомление по заказу #{deal_id}</b>\n\n"
+                f"{text}\n"
+                f"Перейдите в личный кабинет для просмотра.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="📦 Мои заказы", callback_data="current_orders")]
+                ]),
+                parse_mode="HTML"
+            )
 
         if admin_id:
             await bot.send_message(
@@ -416,19 +683,24 @@ async def safe_delete_message(message: Message):
         logger.debug(f"Не удалось удалить сообщение: {e}")
 
 
+async def delete_messages(chat_id, message_ids: list):
+    """Удалить сообщения пачками (не больше 100 сообщений за вызов)"""
+    for start in range(0, len(message_ids), 100):
+        try:
+            await bot.delete_messages(chat_id, message_ids[start:start + 100])
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщения: {e}")
+
+
 async def update_deal_menu(message: Message, deal_id: str, state: FSMContext):
     """Обновление меню заказа"""
     deal = await get_deal_details(deal_id)
     if not deal:
         return
 
-    title = deal.get('TITLE', 'Без названия')
-    has_invoice = os.path.exists(f"{INVOICES_DIR}/{deal_id}.pdf")
-
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    photo_count = 0
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
+    title = deal.title or 'Без названия'
+    has_invoice = documents.has_invoice(deal_id)
+    photo_count = documents.photo_count(deal_id)
     has_photos = photo_count > 0
 
     text = (
@@ -493,19 +765,24 @@ def get_main_menu():
     return keyboard
 
 
-def get_orders_keyboard_with_status(orders: list, prefix: str = "order"):
-    """Клавиатура со списком заказов и статусом документов"""
+def get_orders_keyboard_with_status(orders: list, prefix: str = "order", first_page: str = None,
+                                    cursor: str = None, next_cursor: str = None):
+    """
+    Клавиатура со страницей заказов и статусом документов.
+    first_page - callback первой страницы, следующая страница - f"{first_page}_{next_cursor}".
+    """
     keyboard = []
     for order in orders:
-        order_id = order.get('ID')
-        date = format_date(order.get('DATE_CREATE', ''))
-        title = order.get('TITLE', 'Без названия')
+        order_id = order.id
+        date = format_date(order.date_create)
+        title = order.title or 'Без названия'
 
         if len(title) > 30:
             title = title[:27] + "..."
 
-        has_doc = os.path.exists(f"{INVOICES_DIR}/{order_id}.pdf")
-        has_photo = os.path.exists(f"{PHOTOS_DIR}/{order_id}") and os.listdir(f"{PHOTOS_DIR}/{order_id}")
+        order_documents = documents.get(order_id)
+        has_doc = order_documents.invoice is not None
+        has_photo = order_documents.photo_count > 0
 
         icons = ""
         if has_doc:
@@ -517,27 +794,30 @@ def get_orders_keyboard_with_status(orders: list, prefix: str = "order"):
 
         keyboard.append([InlineKeyboardButton(text=text, callback_data=f"{prefix}_{order_id}")])
 
+    # Кнопки пагинации
+    nav_buttons = []
+    if cursor:
+        nav_buttons.append(InlineKeyboardButton(text="⏮ В начало", callback_data=first_page))
+    if next_cursor:
+        nav_buttons.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"{first_page}_{next_cursor}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+
     keyboard.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_admin_deals_keyboard(deals: list, page: int = 0) -> InlineKeyboardMarkup:
-    """Клавиатура со списком заказов для админки с пагинацией"""
+def get_admin_deals_keyboard(page_deals: list, cursor: str = None, next_cursor: str = None) -> InlineKeyboardMarkup:
+    """Клавиатура со страницей заказов для админки с пагинацией"""
     keyboard = []
-    total_deals = len(deals)
-    total_pages = (total_deals + DEALS_PER_PAGE - 1) // DEALS_PER_PAGE
-
-    start_idx = page * DEALS_PER_PAGE
-    end_idx = min(start_idx + DEALS_PER_PAGE, total_deals)
-
-    page_deals = deals[start_idx:end_idx]
 
     for deal in page_deals:
-        deal_id = deal.get('ID')
-        title = deal.get('TITLE', 'Без названия')
+        deal_id = deal.id
+        title = deal.title or 'Без названия'
 
-        has_invoice_icon = "✅📄" if os.path.exists(f"{INVOICES_DIR}/{deal_id}.pdf") else "❌📄"
-        has_photo_icon = "✅📸" if os.path.exists(f"{PHOTOS_DIR}/{deal_id}") else "❌📸"
+        deal_documents = documents.get(deal_id)
+        has_invoice_icon = "✅📄" if deal_documents.invoice is not None else "❌📄"
+        has_photo_icon = "✅📸" if deal_documents.photo_count > 0 else "❌📸"
 
         if len(title) > 25:
             title = title[:22] + "..."
@@ -546,13 +826,12 @@ def get_admin_deals_keyboard(deals: list, page: int = 0) -> InlineKeyboardMarkup
         keyboard.append([InlineKeyboardButton(text=text_button, callback_data=f"admin_deal_{deal_id}")])
 
     # Кнопки пагинации
-    if total_pages > 1:
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_page_{page - 1}"))
-        nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="admin_page_info"))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_page_{page + 1}"))
+    nav_buttons = []
+    if cursor:
+        nav_buttons.append(InlineKeyboardButton(text="⏮ В начало", callback_data="admin_page_first"))
+    if next_cursor:
+        nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_page_{next_cursor}"))
+    if nav_buttons:
         keyboard.append(nav_buttons)
 
     keyboard.append([InlineKeyboardButton(text="🔄 Новый поиск", callback_data="admin_new_search")])
@@ -561,19 +840,43 @@ def get_admin_deals_keyboard(deals: list, page: int = 0) -> InlineKeyboardMarkup
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+def admin_deals_text(title: str, client: dict, phone: str, total_deals: int = None) -> str:
+    """Заголовок списка заказов клиента в админке"""
+    client = client or {}
+    total = f": {total_deals}" if total_deals is not None else ""
+    return (
+        f"👤 <b>{title}</b>\n"
+        f"📝 {client.get('NAME', '')} {client.get('LAST_NAME', '')}\n"
+        f"📱 {phone}\n\n"
+        f"📦 <b>Активные заказы{total}</b>\n\n"
+        f"Выберите заказ:"
+    )
+
+
+async def render_admin_deals(title: str, phone: str, contact_ids: list, cursor: str = None):
+    """Текст и клавиатура страницы заказов: клиент и страница берутся из кэша"""
+    client, (page_deals, next_cursor), total = await asyncio.gather(
+        find_client_by_phone(phone),
+        get_deals_page(contact_ids, closed=False, cursor=cursor),
+        count_deals(contact_ids, closed=False)
+    )
+    return (
+        admin_deals_text(title, client, phone, total),
+        get_admin_deals_keyboard(page_deals, cursor, next_cursor)
+    )
+
+
 async def get_order_details_keyboard(deal_id: str):
     """Клавиатура для деталей заказа"""
     keyboard = []
 
-    if await has_invoice(deal_id):
+    if documents.has_invoice(deal_id):
         keyboard.append([InlineKeyboardButton(text="📄 Скачать накладную", callback_data=f"invoice_{deal_id}")])
 
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
-        if photo_count > 0:
-            keyboard.append([InlineKeyboardButton(text=f"📸 Посмотреть фото ({photo_count} шт.)",
-                                                  callback_data=f"photos_{deal_id}")])
+    photo_count = documents.photo_count(deal_id)
+    if photo_count > 0:
+        keyboard.append([InlineKeyboardButton(text=f"📸 Посмотреть фото ({photo_count} шт.)",
+                                              callback_data=f"photos_{deal_id}")])
 
     keyboard.append([InlineKeyboardButton(text="🔙 К списку заказов", callback_data="current_orders")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -628,9 +931,9 @@ async def admin_process_phone(message: Message, state: FSMContext):
         await state.update_data(admin_message_id=sent.message_id)
         admin_msg_id = sent.message_id
 
-    client, deals = await get_deals_by_phone(phone)
+    contacts = await find_all_clients_by_phone(phone)
 
-    if not client:
+    if not contacts:
         await bot.edit_message_text(
             "❌ Клиент не найден\n\n"
             "Проверьте номер и попробуйте снова",
@@ -642,6 +945,11 @@ async def admin_process_phone(message: Message, state: FSMContext):
         )
         return
 
+    # Заказы всех контактов с этим номером (включая дубли)
+    client = contacts[0]
+    contact_ids = [contact['ID'] for contact in contacts]
+    deals, _ = await get_deals_page(contact_ids, closed=False)
+
     if not deals:
         await bot.edit_message_text(
             f"❌ У клиента {client.get('NAME', '')} {client.get('LAST_NAME', '')}\n"
@@ -654,22 +962,16 @@ async def admin_process_phone(message: Message, state: FSMContext):
         )
         return
 
-    # Сохраняем данные клиента и текущую страницу
-    await state.update_data(client=client, deals=deals, phone=phone, page=0)
-
-    text = (
-        f"👤 <b>Клиент найден</b>\n"
-        f"📝 {client.get('NAME', '')} {client.get('LAST_NAME', '')}\n"
-        f"📱 {phone}\n\n"
-        f"📦 <b>Активные заказы: {len(deals)}</b>\n\n"
-        f"Выберите заказ:"
-    )
+    # Сохраняем только ID контактов и курсор страницы,
+    # сами заказы страницы берутся из кэша при показе
+    await state.update_data(contact_ids=contact_ids, phone=phone, cursor=None)
 
+    text, keyboard = await render_admin_deals("Клиент найден", phone, contact_ids)
     await bot.edit_message_text(
         text,
         chat_id=message.chat.id,
         message_id=admin_msg_id,
-        reply_markup=get_admin_deals_keyboard(deals, page=0),
+        reply_markup=keyboard,
         parse_mode="HTML"
     )
     await state.set_state(AdminStates.waiting_deal_selection)
@@ -678,36 +980,19 @@ async def admin_process_phone(message: Message, state: FSMContext):
 @dp.callback_query(F.data.startswith("admin_page_"))
 async def admin_change_page(callback: CallbackQuery, state: FSMContext):
     """Переключение страницы заказов"""
-    if callback.data == "admin_page_info":
-        await callback.answer()
-        return
-
-    page = int(callback.data.split("_")[2])
+    cursor = callback.data.split("_")[2]
+    if cursor == "first":
+        cursor = None
     data = await state.get_data()
 
-    client = data.get('client')
-    deals = data.get('deals')
-    phone = data.get('phone')
-
-    if not client or not deals:
+    if not data.get('contact_ids'):
         await callback.answer("❌ Ошибка, начните заново /admin", show_alert=True)
         return
 
-    await state.update_data(page=page)
-
-    text = (
-        f"👤 <b>Клиент найден</b>\n"
-        f"📝 {client.get('NAME', '')} {client.get('LAST_NAME', '')}\n"
-        f"📱 {phone}\n\n"
-        f"📦 <b>Активные заказы: {len(deals)}</b>\n\n"
-        f"Выберите заказ:"
-    )
+    await state.update_data(cursor=cursor)
 
-    await callback.message.edit_text(
-        text,
-        reply_markup=get_admin_deals_keyboard(deals, page=page),
-        parse_mode="HTML"
-    )
+    text, keyboard = await render_admin_deals("Клиент найден", data['phone'], data['contact_ids'], cursor)
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
@@ -717,12 +1002,7 @@ async def admin_select_deal(callback: CallbackQuery, state: FSMContext):
     current_state = await state.get_state()
     if current_state == AdminStates.waiting_photos:
         data = await state.get_data()
-        photo_messages = data.get('photo_messages', [])
-        for msg_id in photo_messages:
-            try:
-                await bot.delete_message(callback.message.chat.id, msg_id)
-            except:
-                pass
+        await delete_messages(callback.message.chat.id, data.get('photo_messages', []))
         await state.update_data(photo_messages=[])
 
     deal_id = callback.data.split("_")[2]
@@ -778,18 +1058,10 @@ async def admin_add_photos(callback: CallbackQuery, state: FSMContext):
 async def admin_view_invoice(callback: CallbackQuery, state: FSMContext):
     """Просмотр накладной админом"""
     deal_id = callback.data.split("_")[3]
-    invoice_path = f"{INVOICES_DIR}/{deal_id}.pdf"
-
-    if os.path.exists(invoice_path):
+    if documents.has_invoice(deal_id):
         await callback.answer("📄 Отправляю накладную...")
         try:
-            doc = FSInputFile(invoice_path)
-            await bot.send_document(
-                callback.from_user.id,
-                doc,
-                caption=f"📄 <b>Накладная для заказа #{deal_id}</b>",
-                parse_mode="HTML"
-            )
+            await send_invoice(callback.from_user.id, deal_id, f"📄 <b>Накладная для заказа #{deal_id}</b>")
         except Exception as e:
             logger.error(f"Ошибка отправки накладной админу: {e}")
             await callback.answer("❌ Ошибка отправки накладной", show_alert=True)
@@ -801,38 +1073,18 @@ async def admin_view_invoice(callback: CallbackQuery, state: FSMContext):
 async def admin_view_photos(callback: CallbackQuery, state: FSMContext):
     """Просмотр фото админом"""
     deal_id = callback.data.split("_")[3]
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
 
-    if os.path.exists(photos_dir):
-        photos = sorted(os.listdir(photos_dir))
+    if documents.get(deal_id).photos:
+        photos = documents.photo_names(deal_id)
         if photos:
             await callback.answer("📸 Отправляю фото...")
             try:
-                media = []
-                for idx, photo_file in enumerate(photos[:10]):
-                    photo_path = f"{photos_dir}/{photo_file}"
-                    photo = FSInputFile(photo_path)
-
-                    if idx == 0:
-                        media.append(InputMediaPhoto(
-                            media=photo,
-                            caption=f"📸 <b>Фото товара - Заказ #{deal_id}</b>\n\nВсего фото: {len(photos)}",
-                            parse_mode="HTML"
-                        ))
-                    else:
-                        media.append(InputMediaPhoto(media=photo))
-
-                await bot.send_media_group(callback.from_user.id, media)
-
-                if len(photos) > 10:
-                    for i in range(10, len(photos), 10):
-                        batch = photos[i:i + 10]
-                        media = []
-                        for photo_file in batch:
-                            photo_path = f"{photos_dir}/{photo_file}"
-                            photo = FSInputFile(photo_path)
-                            media.append(InputMediaPhoto(media=photo))
-                        await bot.send_media_group(callback.from_user.id, media)
+                await send_photo_albums(
+                    callback.from_user.id,
+                    deal_id,
+                    f"📸 <b>Фото товара - Заказ #{deal_id}</b>\n\nВсего фото: {len(photos)}",
+                    preview=True
+                )
 
                 logger.info(f"Отправлено {len(photos)} фото админу для заказа {deal_id}")
             except Exception as e:
@@ -848,10 +1100,10 @@ async def admin_view_photos(callback: CallbackQuery, state: FSMContext):
 async def admin_delete_invoice(callback: CallbackQuery, state: FSMContext):
     """Удаление накладной"""
     deal_id = callback.data.split("_")[3]
-    invoice_path = f"{INVOICES_DIR}/{deal_id}.pdf"
 
-    if os.path.exists(invoice_path):
-        os.remove(invoice_path)
+    if documents.has_invoice(deal_id):
+        await downloads.cancel(deal_id, INVOICE)
+        await documents.remove(deal_id, INVOICE)
         await callback.answer("✅ Накладная удалена")
 
         await update_deal_menu(callback.message, deal_id, state)
@@ -863,11 +1115,11 @@ async def admin_delete_invoice(callback: CallbackQuery, state: FSMContext):
 async def admin_delete_photos(callback: CallbackQuery, state: FSMContext):
     """Удаление всех фото"""
     deal_id = callback.data.split("_")[3]
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
 
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
-        shutil.rmtree(photos_dir)
+    if documents.get(deal_id).photos:
+        photo_count = documents.photo_count(deal_id)
+        await downloads.cancel(deal_id, PHOTO)
+        await documents.remove(deal_id, PHOTO)
         await callback.answer(f"✅ Удалено {photo_count} фото")
 
         await update_deal_menu(callback.message, deal_id, state)
@@ -907,28 +1159,13 @@ async def admin_exit(callback: CallbackQuery, state: FSMContext):
 async def admin_back_to_deals(callback: CallbackQuery, state: FSMContext):
     """Вернуться к списку заказов"""
     data = await state.get_data()
-    client = data.get('client')
-    deals = data.get('deals')
-    phone = data.get('phone')
-    page = data.get('page', 0)
 
-    if not client or not deals:
+    if not data.get('contact_ids'):
         await callback.answer("❌ Ошибка, начните заново /admin", show_alert=True)
         return
 
-    text = (
-        f"👤 <b>Клиент</b>\n"
-        f"📝 {client.get('NAME', '')} {client.get('LAST_NAME', '')}\n"
-        f"📱 {phone}\n\n"
-        f"📦 <b>Активные заказы: {len(deals)}</b>\n\n"
-        f"Выберите заказ:"
-    )
-
-    await callback.message.edit_text(
-        text,
-        reply_markup=get_admin_deals_keyboard(deals, page=page),
-        parse_mode="HTML"
-    )
+    text, keyboard = await render_admin_deals("Клиент", data['phone'], data['contact_ids'], data.get('cursor'))
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await state.set_state(AdminStates.waiting_deal_selection)
     await callback.answer()
 
@@ -942,25 +1179,17 @@ async def admin_process_invoice(message: Message, state: FSMContext):
 
     await safe_delete_message(message)
 
-    os.makedirs(INVOICES_DIR, exist_ok=True)
-
     document = message.document
-    file_path = f"{INVOICES_DIR}/{deal_id}.pdf"
-
-    file = await bot.get_file(document.file_id)
-    await bot.download_file(file.file_path, file_path)
-    logger.info(f"Накладная сохранена: {file_path}")
+    await store_documents(deal_id, INVOICE, [(document.file_id, document.file_size)])
+    logger.info(f"Накладная принята: заказ {deal_id}")
 
     await notify_on_document_upload(deal_id, "invoice", message.from_user.id)
 
     if admin_msg_id:
         deal = await get_deal_details(deal_id)
         if deal:
-            title = deal.get('TITLE', 'Без названия')
-            photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-            photo_count = 0
-            if os.path.exists(photos_dir):
-                photo_count = len(os.listdir(photos_dir))
+            title = deal.title or 'Без названия'
+            photo_count = documents.photo_count(deal_id)
             has_photos = photo_count > 0
 
             text = (
@@ -1010,33 +1239,28 @@ async def admin_process_invoice(message: Message, state: FSMContext):
 
 @dp.message(AdminStates.waiting_photos, F.photo)
 async def admin_process_photo(message: Message, state: FSMContext):
-    """Обработка фото товара"""
+    """Обработка фото товара (альбом обрабатывается один раз, целиком)"""
+    messages = await media_groups.collect(message)
+    if not messages:
+        return
+
     data = await state.get_data()
     deal_id = data['deal_id']
     admin_msg_id = data.get('admin_message_id')
 
-    photo_messages = data.get('photo_messages', [])
-    photo_messages.append(message.message_id)
+    photo_messages = data.get('photo_messages', []) + [item.message_id for item in messages]
     await state.update_data(photo_messages=photo_messages)
 
-    deal_photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    os.makedirs(deal_photos_dir, exist_ok=True)
-    logger.info(f"Сохраняем фото в: {deal_photos_dir}")
-
-    existing_photos = os.listdir(deal_photos_dir)
-    photo_index = len(existing_photos) + 1
-
-    photo = message.photo[-1]
-    file_path = f"{deal_photos_dir}/photo_{photo_index:03d}.jpg"
-
-    file = await bot.get_file(photo.file_id)
-    await bot.download_file(file.file_path, file_path)
-    logger.info(f"Фото сохранено: {file_path}")
+    photos = [item.photo[-1] for item in messages]
+    photo_names, deal_documents = await store_documents(
+        deal_id, PHOTO, [(photo.file_id, photo.file_size) for photo in photos]
+    )
+    logger.info(f"Фото принято: заказ {deal_id}, {', '.join(photo_names)}")
 
     if admin_msg_id:
         try:
-            total_photos = len(os.listdir(deal_photos_dir))
-            logger.info(f"Всего фото в папке: {total_photos}")
+            total_photos = deal_documents.photo_count
+            logger.info(f"Всего фото у заказа: {total_photos}")
             await bot.edit_message_text(
                 f"📸 <b>Загрузка фото товара</b>\n"
                 f"Заказ #{deal_id}\n\n"
@@ -1061,25 +1285,18 @@ async def admin_photos_done(callback: CallbackQuery, state: FSMContext):
     deal_id = data['deal_id']
     photo_messages = data.get('photo_messages', [])
 
-    for msg_id in photo_messages:
-        try:
-            await bot.delete_message(callback.message.chat.id, msg_id)
-        except:
-            pass
+    await delete_messages(callback.message.chat.id, photo_messages)
 
     await state.update_data(photo_messages=[])
 
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    photo_count = 0
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
+    photo_count = documents.photo_count(deal_id)
 
     await notify_on_document_upload(deal_id, "photos", callback.from_user.id)
 
     deal = await get_deal_details(deal_id)
     if deal:
-        title = deal.get('TITLE', 'Без названия')
-        has_invoice = os.path.exists(f"{INVOICES_DIR}/{deal_id}.pdf")
+        title = deal.title or 'Без названия'
+        has_invoice = documents.has_invoice(deal_id)
 
         text = (
             f"✅ <b>Фото успешно загружены!</b>\n\n"
@@ -1131,26 +1348,19 @@ async def finish_photo_upload(message: Message, state: FSMContext):
     admin_msg_id = data.get('admin_message_id')
     photo_messages = data.get('photo_messages', [])
 
-    for msg_id in photo_messages:
-        try:
-            await bot.delete_message(message.chat.id, msg_id)
-        except:
-            pass
+    await delete_messages(message.chat.id, photo_messages)
 
     await state.update_data(photo_messages=[])
 
-    photos_dir = f"{PHOTOS_DIR}/{deal_id}"
-    photo_count = 0
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
+    photo_count = documents.photo_count(deal_id)
 
     await notify_on_document_upload(deal_id, "photos", message.from_user.id)
 
     if admin_msg_id:
         deal = await get_deal_details(deal_id)
         if deal:
-            title = deal.get('TITLE', 'Без названия')
-            has_invoice = os.path.exists(f"{INVOICES_DIR}/{deal_id}.pdf")
+            title = deal.title or 'Без названия'
+            has_invoice = documents.has_invoice(deal_id)
 
             text = (
                 f"✅ <b>Фото успешно загружены!</b>\n\n"
@@ -1187,6 +1397,24 @@ async def finish_photo_upload(message: Message, state: FSMContext):
                 pass
 
 
+@dp.message(Command("stats"))
+async def admin_stats(message: Message):
+    """Метрики запросов к Битрикс"""
+    if not is_admin(message.from_user.id):
+        return
+
+    snapshot = metrics.snapshot()
+    lines = ["📊 <b>Статистика</b>\n"]
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f"{name}: {value}")
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append(f"{name}: {value}")
+    for name, timing in sorted(snapshot['timings'].items()):
+        lines.append(f"{name}: n={timing['count']} avg={timing['avg']}s max={timing['max']}s")
+
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
 @dp.message(Command("exit"))
 async def admin_exit_command(message: Message, state: FSMContext):
     """Быстрый выход из админки командой"""
@@ -1213,7 +1441,7 @@ async def cmd_start(message: Message, state: FSMContext):
 
     user_id = message.from_user.id
 
-    if user_id in user_phones:
+    if user_id in users:
         await show_main_menu(message)
         return
 
@@ -1244,26 +1472,23 @@ async def process_phone(message: Message, state: FSMContext):
             client.get('LAST_NAME', '')
         )
 
-        email_params = {
-            'ID': client['ID']
-        }
-        contact_data = await bitrix_request('crm.contact.get', email_params)
-
+        # Карточка контакта (с EMAIL) приходит в том же batch-запросе, что и поиск
         email_value = 'Не указан'
-        if contact_data and 'EMAIL' in contact_data:
-            email_list = contact_data.get('EMAIL', [])
+        if 'EMAIL' in client:
+            email_list = client.get('EMAIL', [])
             if email_list and len(email_list) > 0:
                 email_value = email_list[0].get('VALUE', 'Не указан')
 
-        user_phones[user_id] = {
-            'phone': phone,
-            'client_id': client['ID'],
-            'name': full_name,
-            'email': email_value
-        }
+        user_data = await users.register(
+            user_id,
+            client_id=client['ID'],
+            phone=phone,
+            name=full_name,
+            email=email_value
+        )
 
         await message.answer(
-            f"✅ <b>Отлично, {user_phones[user_id]['name']}!</b>\n\n"
+            f"✅ <b>Отлично, {user_data['name']}!</b>\n\n"
             "Ваш аккаунт успешно подключен! 🎊\n"
             "Теперь вы можете управлять своими заказами 📦",
             parse_mode="HTML"
@@ -1285,7 +1510,7 @@ async def process_phone(message: Message, state: FSMContext):
 async def show_main_menu(message: Message):
     """Показать главное меню"""
     user_id = message.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
 
     if not user_data:
         await message.answer("⚠️ Пожалуйста, начните с команды /start")
@@ -1304,7 +1529,7 @@ async def show_main_menu(message: Message):
 async def back_to_menu(callback: CallbackQuery):
     """Возврат в главное меню"""
     user_id = callback.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
 
     await callback.message.edit_text(
         f"🏠 <b>Личный кабинет</b>\n\n"
@@ -1316,73 +1541,66 @@ async def back_to_menu(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "current_orders")
+@dp.callback_query(F.data.startswith("current_orders"))
 async def show_current_orders(callback: CallbackQuery):
-    """Текущие заказы с расширенной информацией"""
+    """Текущие заказы с расширенной информацией (постранично)"""
     user_id = callback.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
+
+    if not user_data:
+        await callback.answer("❌ Пожалуйста, начните с команды /start", show_alert=True)
+        return
 
     await callback.answer("⏳ Загружаю заказы...")
 
-    orders = await get_active_deals(user_data['client_id'])
+    cursor = callback.data.split("_")[2] if callback.data.count("_") == 2 else None
+    contact_ids = [user_data['client_id']]
+    (orders, next_cursor), total_orders = await asyncio.gather(
+        get_deals_page(contact_ids, closed=False, cursor=cursor),
+        count_deals(contact_ids, closed=False)
+    )
 
-    if orders:
-        total_orders = len(orders)
+    if orders or cursor:
         orders_with_docs = 0
         orders_with_photos = 0
 
         for order in orders:
-            order_id = order.get('ID')
-            if os.path.exists(f"{INVOICES_DIR}/{order_id}.pdf"):
+            order_documents = documents.get(order.id)
+            if order_documents.invoice is not None:
                 orders_with_docs += 1
-            if os.path.exists(f"{PHOTOS_DIR}/{order_id}"):
-                if os.listdir(f"{PHOTOS_DIR}/{order_id}"):
-                    orders_with_photos += 1
-
-        text = (
-            f"📦 <b>Текущие заказы</b>\n\n"
-            f"📊 Статистика:\n"
-            f"• Всего заказов: {total_orders}\n"
-            f"• С накладными: {orders_with_docs}/{total_orders}\n"
-            f"• С фото: {orders_with_photos}/{total_orders}\n\n"
-            f"Выберите заказ для просмотра:"
+            if order_documents.photo_count > 0:
+                orders_with_photos += 1
+
+        text = "📦 <b>Текущие заказы</b>\n\n📊 Статистика:\n"
+        if total_orders is not None:
+            text += f"• Всего заказов: {total_orders}\n"
+        text += (
+            f"• На этой странице: {len(orders)}\n"
+            f"• С накладными: {orders_with_docs}/{len(orders)}\n"
+            f"• С фото: {orders_with_photos}/{len(orders)}\n\n"
+            f"Выберите заказ для просмотра:{stale_note()}"
         )
 
         await callback.message.edit_text(
             text,
-            reply_markup=get_orders_keyboard_with_status(orders, "order"),
+            reply_markup=get_orders_keyboard_with_status(orders, "order", "current_orders", cursor, next_cursor),
             parse_mode="HTML"
         )
     else:
         await callback.message.edit_text(
             "📦 <b>Текущие заказы</b>\n\n"
             "У вас пока нет активных заказов 🤷\n\n"
-            "Оформите новый заказ, связавшись с нашим менеджером!",
+            "Оформите новый заказ, связавшись с нашим менеджером!" + stale_note(),
             reply_markup=get_back_button(),
             parse_mode="HTML"
         )
 
 
-def parse_bitrix_money(value, default=0.0):
-    """Парсит денежное значение из Битрикс в формате '100|RUB'"""
-    if value in [None, '', [], {}]:
-        return default
-
-    try:
-        if '|' in str(value):
-            return float(str(value).split('|')[0])
-        else:
-            clean_value = str(value).replace(' ', '').replace(',', '.')
-            return float(clean_value) if clean_value else default
-    except (ValueError, TypeError):
-        return default
-
-
 @dp.callback_query(F.data.startswith("order_"))
 async def show_order_details(callback: CallbackQuery):
     """Детали заказа"""
     user_id = callback.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
 
     if not user_data:
         await callback.answer("❌ Пожалуйста, начните с команды /start", show_alert=True)
@@ -1398,80 +1616,42 @@ async def show_order_details(callback: CallbackQuery):
         await callback.answer("❌ Ошибка загрузки заказа", show_alert=True)
         return
 
-    def get_field(field_key, default='Н/Д'):
-        field_id = BITRIX_FIELDS.get(field_key, '')
-        value = deal.get(field_id, default)
-        if value in [None, '', [], {}]:
-            return default
-        return str(value).strip()
-
-    title = deal.get('TITLE', 'Без названия')
+    title = deal.title or 'Без названия'
 
     text = f"📦 <b>Заказ №{order_id}</b>\n"
     text += f"<b>{title}</b>\n\n"
 
-    stage = deal.get('STAGE_ID', 'UNKNOWN')
-    emoji = get_stage_emoji(stage)
+    stage = deal.stage_id or 'UNKNOWN'
     status_name = get_stage_name(stage)
     text += f"<b>Текущий статус:</b> {status_name}\n\n"
 
-    product_type_id = get_field('product_category', 'Не указано')
-    if product_type_id != 'Не указано':
-        product_type = await get_category_name(product_type_id)
-    else:
-        product_type = 'Не указано'
+    product_type = await get_category_name(deal.product_category) if deal.product_category else 'Не указано'
     text += f"<b>Тип товара:</b> {product_type}\n"
 
-    weight = get_field('weight', 'Н/Д')
-    text += f"<b>Вес:</b> {weight} кг\n"
-
-    volume = get_field('volume', 'Н/Д')
-    text += f"<b>Объем:</b> {volume} м³\n"
-
-    insurance = get_field('insurance', 'Не указана')
-    text += f"<b>Страховка:</b> {insurance}\n\n"
+    text += f"<b>Вес:</b> {format_quantity(deal.weight)} кг\n"
+    text += f"<b>Объем:</b> {format_quantity(deal.volume)} м³\n"
+    text += f"<b>Страховка:</b> {deal.insurance or 'Не указана'}\n\n"
 
-    send_date = format_date(get_field('expected_send_date', ''))
-    text += f"<b>Дата выхода груза:</b> {send_date}\n"
-
-    arrival_date = format_date(get_field('expected_arrival_date', ''))
-    text += f"<b>Ожидаемая дата прихода:</b> {arrival_date}\n"
-
-    arrival_city = get_field('arrival_city', 'Не указан')
-    text += f"<b>Город прибытия:</b> {arrival_city}\n\n"
-
-    cargo_marking = get_field('cargo_marking', 'Не указана')
-    text += f"<b>Маркировка груза:</b> {cargo_marking}\n\n"
+    text += f"<b>Дата выхода груза:</b> {format_date(deal.expected_send_date)}\n"
+    text += f"<b>Ожидаемая дата прихода:</b> {format_date(deal.expected_arrival_date)}\n"
+    text += f"<b>Город прибытия:</b> {deal.arrival_city or 'Не указан'}\n\n"
+    text += f"<b>Маркировка груза:</b> {deal.cargo_marking or 'Не указана'}\n\n"
 
     text += f"<b>Документы:</b>\n"
 
-    invoice_status = "✅ Загружена" if await has_invoice(order_id) else "⏳ Ожидается"
+    invoice_status = "✅ Загружена" if documents.has_invoice(order_id) else "⏳ Ожидается"
     text += f"Накладная: {invoice_status}\n"
 
-    photos_dir = f"{PHOTOS_DIR}/{order_id}"
-    photo_count = 0
-    if os.path.exists(photos_dir):
-        photo_count = len(os.listdir(photos_dir))
+    photo_count = documents.photo_count(order_id)
     photos_status = f"✅ Загружено ({photo_count} шт.)" if photo_count > 0 else "⏳ Ожидаются"
     text += f"Фото: {photos_status}\n\n"
 
     text += f"<b>Финансы:</b>\n"
 
-    product_cost_raw = get_field('invoice_cost', '0')
-    product_cost_value, product_currency = parse_bitrix_money_with_currency(product_cost_raw)
-    product_cost_formatted = format_price(product_cost_value, product_currency)
-    text += f"Стоимость товара: {product_cost_formatted}\n"
-
-    delivery_cost_raw = deal.get('OPPORTUNITY', '0')
-    deal_currency = deal.get('CURRENCY_ID', 'RUB')
-
-    try:
-        delivery_cost_value = float(str(delivery_cost_raw).replace(',', '.'))
-    except:
-        delivery_cost_value = 0.0
-
-    delivery_cost_formatted = format_price(delivery_cost_value, deal_currency)
+    text += f"Стоимость товара: {format_price(deal.invoice_cost, deal.invoice_currency)}\n"
+    delivery_cost_formatted = format_price(deal.opportunity, deal.currency)
     text += f"Стоимость доставки: {delivery_cost_formatted}"
+    text += stale_note()
 
     keyboard = await get_order_details_keyboard(order_id)
 
@@ -1501,50 +1681,18 @@ async def show_product_photos(callback: CallbackQuery):
     logger.info(f"Запрос фото для заказа {order_id}")
     await callback.answer("⏳ Загружаю фото...")
 
-    local_photos_dir = f"{PHOTOS_DIR}/{order_id}"
-    logger.info(f"Путь к фото: {local_photos_dir}")
-
-    if os.path.exists(local_photos_dir):
-        photos = os.listdir(local_photos_dir)
+    if documents.get(order_id).photos:
+        photos = documents.photo_names(order_id)
         logger.info(f"Найдено фото: {len(photos)} шт. - {photos}")
 
         if photos:
             try:
-                photos = sorted(photos)
-
-                media = []
-                for idx, photo_file in enumerate(photos[:10]):
-                    photo_path = f"{local_photos_dir}/{photo_file}"
-                    photo = FSInputFile(photo_path)
-
-                    if idx == 0:
-                        media.append(InputMediaPhoto(
-                            media=photo,
-                            caption=f"📸 <b>Фото товара на складе</b>\n\nЗаказ #{order_id}\nВсего фото: {len(photos)}",
-                            parse_mode="HTML"
-                        ))
-                    else:
-                        media.append(InputMediaPhoto(media=photo))
-
-                await bot.send_media_group(
+                await send_photo_albums(
                     callback.from_user.id,
-                    media
+                    order_id,
+                    f"📸 <b>Фото товара на складе</b>\n\nЗаказ #{order_id}\nВсего фото: {len(photos)}"
                 )
-                logger.info(f"Отправлен альбом из {len(media)} фото")
-
-                if len(photos) > 10:
-                    for i in range(10, len(photos), 10):
-                        batch = photos[i:i + 10]
-                        media = []
-                        for photo_file in batch:
-                            photo_path = f"{local_photos_dir}/{photo_file}"
-                            photo = FSInputFile(photo_path)
-                            media.append(InputMediaPhoto(media=photo))
-
-                        await bot.send_media_group(
-                            callback.from_user.id,
-                            media
-                        )
+                logger.info(f"Отправлено {len(photos)} фото альбомами")
 
                 await bot.send_message(
                     callback.from_user.id,
@@ -1562,33 +1710,43 @@ async def show_product_photos(callback: CallbackQuery):
                 await callback.answer("❌ Ошибка при отправке фото", show_alert=True)
                 return
     else:
-        logger.warning(f"Папка с фото не найдена: {local_photos_dir}")
+        logger.warning(f"Фото заказа {order_id} не найдены")
 
     await callback.answer("❌ Фото не найдены", show_alert=True)
 
 
-@dp.callback_query(F.data == "archive_orders")
+@dp.callback_query(F.data.startswith("archive_orders"))
 async def show_archive_orders(callback: CallbackQuery):
-    """Архив заказов"""
+    """Архив заказов (постранично)"""
     user_id = callback.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
+
+    if not user_data:
+        await callback.answer("❌ Пожалуйста, начните с команды /start", show_alert=True)
+        return
 
     await callback.answer("⏳ Загружаю архив...")
 
-    orders = await get_archived_deals(user_data['client_id'])
+    cursor = callback.data.split("_")[2] if callback.data.count("_") == 2 else None
+    contact_ids = [user_data['client_id']]
+    (orders, next_cursor), total_orders = await asyncio.gather(
+        get_deals_page(contact_ids, closed=True, cursor=cursor),
+        count_deals(contact_ids, closed=True)
+    )
 
-    if orders:
+    if orders or cursor:
+        total = f"Завершенных заказов: {total_orders}\n" if total_orders is not None else ""
         await callback.message.edit_text(
             f"📚 <b>Архив заказов</b>\n\n"
-            f"Завершенных заказов: {len(orders)}\n"
-            f"Выберите заказ для просмотра:",
-            reply_markup=get_orders_keyboard_with_status(orders, "archive"),
+            f"{total}"
+            f"Выберите заказ для просмотра:{stale_note()}",
+            reply_markup=get_orders_keyboard_with_status(orders, "archive", "archive_orders", cursor, next_cursor),
             parse_mode="HTML"
         )
     else:
         await callback.message.edit_text(
             "📚 <b>Архив заказов</b>\n\n"
-            "Архив пуст 🤷",
+            "Архив пуст 🤷" + stale_note(),
             reply_markup=get_back_button(),
             parse_mode="HTML"
         )
@@ -1648,52 +1806,24 @@ async def show_archive_details(callback: CallbackQuery):
     await callback.answer("⏳ Загружаю данные...")
     deal = await get_deal_details(order_id)
     if deal:
-        def get_field(field_key, default='Н/Д'):
-            field_id = BITRIX_FIELDS.get(field_key, '')
-            value = deal.get(field_id, default)
-            if value in [None, '', [], {}]:
-                return default
-            return str(value).strip()
-
-        title = deal.get('TITLE', 'Без названия')
+        title = deal.title or 'Без названия'
 
         text = f"📚 <b>Архив - Заказ #{order_id}</b>\n"
         text += f"📌 <b>{title}</b>\n\n"
 
-        send_date = format_date(get_field('expected_send_date', ''))
-        text += f"📅 <b>Дата выхода груза:</b> {send_date}\n"
-        weight = get_field('weight', 'Н/Д')
-        text += f"⚖️ <b>Вес:</b> {weight} кг\n"
-        volume = get_field('volume', 'Н/Д')
-        text += f"📦 <b>Объем:</b> {volume} м³\n"
-        product_type_id = get_field('product_category', 'Не указано')
-        if product_type_id != 'Не указано':
-            product_type = await get_category_name(product_type_id)
-        else:
-            product_type = 'Не указано'
+        text += f"📅 <b>Дата выхода груза:</b> {format_date(deal.expected_send_date)}\n"
+        text += f"⚖️ <b>Вес:</b> {format_quantity(deal.weight)} кг\n"
+        text += f"📦 <b>Объем:</b> {format_quantity(deal.volume)} м³\n"
+        product_type = await get_category_name(deal.product_category) if deal.product_category else 'Не указано'
         text += f"🏷️ <b>Тип товара:</b> {product_type}\n"
 
-        product_cost_raw = get_field('invoice_cost', '0')
-        product_cost_value, product_currency = parse_bitrix_money_with_currency(product_cost_raw)
-        product_cost_formatted = format_price(product_cost_value, product_currency)
-        text += f"💰 <b>Стоимость товара:</b> {product_cost_formatted}\n"
+        text += f"💰 <b>Стоимость товара:</b> {format_price(deal.invoice_cost, deal.invoice_currency)}\n"
+        text += f"💰 <b>Стоимость доставки:</b> {format_price(deal.opportunity, deal.currency)}\n"
 
-        delivery_cost_raw = deal.get('OPPORTUNITY', '0')
-        deal_currency = deal.get('CURRENCY_ID', 'RUB')
-
-        try:
-            delivery_cost_value = float(str(delivery_cost_raw).replace(',', '.'))
-        except:
-            delivery_cost_value = 0.0
-
-        delivery_cost_formatted = format_price(delivery_cost_value, deal_currency)
-        text += f"💰 <b>Стоимость доставки:</b> {delivery_cost_formatted}\n"
-
-        date_create = format_date(deal.get('DATE_CREATE', ''))
-        text += f"📅 <b>Создан:</b> {date_create}\n"
-        date_modify = format_date(deal.get('DATE_MODIFY', ''))
-        text += f"✅ <b>Завершен:</b> {date_modify}\n\n"
+        text += f"📅 <b>Создан:</b> {format_date(deal.date_create)}\n"
+        text += f"✅ <b>Завершен:</b> {format_date(deal.date_modify)}\n\n"
         text += "🏁 <b>Заказ завершен</b> ✅"
+        text += stale_note()
 
         await callback.message.edit_text(
             text,
@@ -1740,7 +1870,7 @@ async def consultation(callback: CallbackQuery):
 async def show_profile(callback: CallbackQuery):
     """Профиль клиента"""
     user_id = callback.from_user.id
-    user_data = user_phones.get(user_id)
+    user_data = users.get(user_id)
 
     if not user_data:
         await callback.answer("❌ Данные не найдены", show_alert=True)
@@ -1766,7 +1896,40 @@ async def main():
     logger.info(f"📋 Webhook: {BITRIX_WEBHOOK}")
     logger.info(f"👨‍💼 Админ ID: {str(ADMIN_IDS)}")
     logger.info("=" * 60)
-    await dp.start_polling(bot)
+    photo_pipeline.start()
+    await meta.load(bitrix)
+    meta_refresh = asyncio.create_task(meta_refresh_loop(meta, bitrix, META_REFRESH_INTERVAL))
+    phone_refresh = asyncio.create_task(refresh_loop(
+        phone_index,
+        lambda phone: resolve_phone(phone, refresh=True),
+        PHONE_INDEX_REFRESH_INTERVAL,
+        PHONE_INDEX_REFRESH_AFTER
+    ))
+    mirror_sync = asyncio.create_task(sync_loop(deal_mirror, bitrix, MIRROR_SYNC_INTERVAL, on_mirror_change))
+    shared_watch = asyncio.create_task(watch_loop(deal_stages, SHARED_STATE_POLL_INTERVAL, on_shared_change))
+    await documents.import_legacy(INVOICES_DIR, PHOTOS_DIR)
+    await documents.reconcile()
+    documents_reconcile = asyncio.create_task(reconcile_loop(documents, DOCUMENTS_RECONCILE_INTERVAL))
+    documents_watch = asyncio.create_task(documents_watch_loop(documents, SHARED_STATE_POLL_INTERVAL))
+    downloads.start(bot, on_document_downloaded, on_document_download_failed)
+    documents_archive = asyncio.create_task(archive_loop(document_archive, deal_mirror.closed_ids, ARCHIVE_INTERVAL))
+    loop_lag = asyncio.create_task(metrics.watch_loop_lag(LOOP_LAG_INTERVAL))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        meta_refresh.cancel()
+        phone_refresh.cancel()
+        mirror_sync.cancel()
+        shared_watch.cancel()
+        documents_reconcile.cancel()
+        documents_watch.cancel()
+        documents_archive.cancel()
+        downloads.stop()
+        loop_lag.cancel()
+        file_pool.shutdown()
+        photo_pipeline.shutdown()
+        await blobs.close()
+        await bitrix.close()
 
 
 if __name__ == "__main__":
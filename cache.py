@@ -0,0 +1,60 @@
+"""
+Кэш в памяти с ограничением размера (LRU) и временем жизни записей (TTL)
+"""
+
+import time
+from collections import OrderedDict
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш: не больше maxsize записей, каждая живет ttl секунд"""
+
+    def __init__(self, maxsize: int, ttl: float, name: str = 'cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Свежее значение по ключу или default"""
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] < time.monotonic():
+            metrics.inc(f"cache.{self.name}.misses")
+            return default
+        self._data.move_to_end(key)
+        metrics.inc(f"cache.{self.name}.hits")
+        return entry[1]
+
+    def get_stale(self, key, default=None):
+        """Значение по ключу, даже если время жизни истекло (для работы без Битрикс)"""
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        metrics.inc(f"cache.{self.name}.stale_hits")
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        """Сохранить значение, вытеснив самые давние записи при переполнении"""
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        metrics.set_gauge(f"cache.{self.name}.size", len(self._data))
+
+    def invalidate(self, key):
+        """Удалить запись"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Очистить кэш"""
+        self._data.clear()
+
+    def __contains__(self, key):
+        entry = self._data.get(key, _MISSING)
+        return entry is not _MISSING and entry[0] >= time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
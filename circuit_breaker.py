@@ -0,0 +1,91 @@
+"""
+Предохранитель (circuit breaker) для запросов к Битрикс24
+После серии ошибок или медленных ответов запросы сразу отклоняются, пока
+не пройдет recovery_timeout; затем пропускается один пробный запрос.
+"""
+
+import logging
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Состояния: closed (работаем), open (отклоняем), half_open (пробный запрос)"""
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float, slow_call_threshold: float,
+                 name: str = 'bitrix'):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.slow_call_threshold = slow_call_threshold
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        metrics.set_gauge(f"{self.name}.breaker", self.state)
+
+    @property
+    def is_open(self) -> bool:
+        """Портал считается недоступным (open или проверка в half_open)"""
+        return self.state != CLOSED
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+            self.state = state
+            metrics.set_gauge(f"{self.name}.breaker", state)
+
+    def rejects(self) -> bool:
+        """
+        Дешевая проверка до ожидания токена: запрос точно будет отклонен (open и
+        recovery_timeout не прошел). Пробный запрос не занимает.
+        """
+        if self.state == OPEN and time.monotonic() - self.opened_at < self.recovery_timeout:
+            metrics.inc(f"{self.name}.breaker_rejected")
+            return True
+        return False
+
+    def allow_request(self) -> bool:
+        """
+        Можно ли отправить запрос сейчас. В half_open разрешение занимает пробный
+        запрос - его нужно завершить record_success, record_failure или release.
+        """
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        metrics.inc(f"{self.name}.breaker_rejected")
+        return False
+
+    def record_success(self, latency: float):
+        """Запрос выполнен; слишком медленный ответ считается ошибкой"""
+        if latency > self.slow_call_threshold:
+            metrics.inc(f"{self.name}.slow_calls")
+            self.record_failure()
+            return
+        self._probe_in_flight = False
+        self.failures = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        """Запрос завершился ошибкой портала или сети"""
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                metrics.inc(f"{self.name}.breaker_opened")
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self):
+        """Запрос не показал состояние портала (например, ограничение частоты)"""
+        self._probe_in_flight = False
@@ -0,0 +1,31 @@
+"""
+JSON кодек: orjson, если установлен, иначе стандартный json
+Используется клиентом Битрикс24, локальными хранилищами и webhook handler.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NAME = 'orjson' if orjson else 'json'
+
+
+if orjson:
+    def dumps(obj) -> bytes:
+        """Сериализовать в JSON (bytes, UTF-8)"""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data):
+        """Разобрать JSON из bytes или str"""
+        return orjson.loads(data)
+else:
+    def dumps(obj) -> bytes:
+        """Сериализовать в JSON (bytes, UTF-8)"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        """Разобрать JSON из bytes или str"""
+        return json.loads(data)
@@ -1,4 +1,5 @@
-import aiohttp
+import datetime
+from decimal import Decimal
 
 STAGE_NAMES = {
     'NEW': '🆕 Новая заявка',
@@ -86,49 +87,131 @@ CONTACT_FIELDS = {
     'email': 'UF_CRM_5F02275DA7BD0',
 }
 
-CATEGORY_CACHE = {}
+# Кэш сделок
+DEAL_CACHE_SIZE = 2000  # Сделок в кэше
+DEAL_CACHE_TTL = 300  # Время жизни сделки в кэше, сек
+DEAL_LIST_CACHE_SIZE = 1000  # Списков заказов клиентов в кэше
+DEAL_LIST_CACHE_TTL = 60  # Время жизни списка заказов, сек
+
+# Данные бота на диске
+DATA_DIR = "data"
+
+# Зарегистрированные пользователи
+USERS_DB_PATH = f"{DATA_DIR}/users.db"
+
+# Общее состояние бота и webhook handler (последние стадии сделок)
+SHARED_STATE_PATH = f"{DATA_DIR}/shared.db"
+SHARED_STATE_POLL_INTERVAL = 2  # секунды
+
+# Состояния диалогов (FSM)
+FSM_DB_PATH = f"{DATA_DIR}/fsm.db"
+FSM_STATE_TTL = 7 * 24 * 3600  # секунды
+
+# Манифест документов заказов (накладные и фото)
+DOCUMENTS_DB_PATH = f"{DATA_DIR}/documents.db"
+DOCUMENTS_RECONCILE_INTERVAL = 300  # секунды
+# Документы завершенных заказов, не менявшиеся ARCHIVE_IDLE, уходят в архив
+ARCHIVE_INTERVAL = 3600  # секунды
+ARCHIVE_IDLE = 14 * 24 * 3600  # секунды
+
+# Файлы документов по SHA-256 содержимого
+BLOBS_DIR = f"{DATA_DIR}/blobs"
+BLOB_GC_GRACE = 3600  # секунды, файлы без ссылок моложе этого не удаляются
+
+# Где хранятся файлы документов: 'local' - в BLOBS_DIR, 's3' - в S3-совместимом
+# хранилище (нужно, если бот и webhook handler работают на разных машинах)
+STORAGE_BACKEND = 'local'
+S3_ENDPOINT = "http://localhost:9000"
+S3_BUCKET = "sunway24-documents"
+S3_ACCESS_KEY = ""
+S3_SECRET_KEY = ""
+S3_REGION = "us-east-1"
+S3_PART_SIZE = 8 * 1024 * 1024  # байт, часть multipart upload
+
+# Потоки для операций с файлами документов
+FILE_POOL_SIZE = 4
+
+# Обработка фото товара (нужен Pillow): поворот по EXIF, уменьшение, превью
+PHOTO_PROCESS_WORKERS = 2
+PHOTO_MAX_SIDE = 1600  # пикселей по длинной стороне
+PHOTO_QUALITY = 82
+PHOTO_THUMB_SIDE = 320
+PHOTO_THUMB_QUALITY = 70
+
+# Пауза после последнего фото альбома, после которой альбом считается полным
+MEDIA_GROUP_DELAY = 1.0  # секунды
+
+# Период измерения задержки event loop
+LOOP_LAG_INTERVAL = 0.5  # секунды
+
+# Загрузки от админа: сразу запоминается file_id, файл скачивается в фоне
+DOWNLOADS_DB_PATH = f"{DATA_DIR}/downloads.db"
+DOWNLOAD_CONCURRENCY = 3
+DOWNLOAD_MAX_ATTEMPTS = 5
+DOWNLOAD_RETRY_DELAY = 5  # секунды, растет с каждой попыткой
+
+# Индекс телефон -> контакты
+PHONE_INDEX_PATH = f"{DATA_DIR}/phone_index.db"
+PHONE_INDEX_TTL = 24 * 3600  # Время жизни найденного номера, сек
+PHONE_INDEX_NEGATIVE_TTL = 300  # Время жизни неизвестного номера, сек
+PHONE_INDEX_REFRESH_INTERVAL = 3600  # Период фонового обновления, сек
+PHONE_INDEX_REFRESH_AFTER = 12 * 3600  # Обновлять записи старше, сек
+
+# Локальная копия сделок
+MIRROR_DB_PATH = f"{DATA_DIR}/deals.db"
+MIRROR_SYNC_INTERVAL = 60  # Период инкрементальной синхронизации, сек
+
+# Справочники Битрикс (списочные поля, стадии)
+META_REFRESH_INTERVAL = 6 * 3600  # Период обновления, сек
 BITRIX_WEBHOOK = "https://sunway24.bitrix24.ru/rest/326/fiwux7q90yclt8l1/"
 
+# Пул соединений к Битрикс24
+BITRIX_CONNECTION_LIMIT = 20  # Всего соединений в пуле
+BITRIX_CONNECTION_LIMIT_PER_HOST = 10  # Соединений к порталу
+BITRIX_DNS_CACHE_TTL = 300  # Кэш DNS, сек
+BITRIX_KEEPALIVE_TIMEOUT = 60  # Время жизни простаивающего соединения, сек
+BITRIX_REQUEST_TIMEOUT = 30  # Таймаут запроса, сек
+BITRIX_CONNECT_TIMEOUT = 10  # Таймаут установки соединения, сек
 
-async def get_list_item_name(field_id: str, item_id: str):
-    """Получить текстовое название элемента списка"""
-    url = f"{BITRIX_WEBHOOK}crm.deal.fields"
+# Лимиты запросов к Битрикс24 (портал пропускает ~2 запроса в секунду)
+BITRIX_RATE_LIMIT = 2  # Запросов в секунду, всего на бот и все воркеры webhook handler
+BITRIX_RATE_BURST = 10  # Запас запросов для всплесков
+BITRIX_MAX_RETRIES = 4  # Повторов при QUERY_LIMIT_EXCEEDED / 503
+BITRIX_RETRY_BASE_DELAY = 0.5  # Базовая задержка повтора, сек
+BITRIX_RETRY_MAX_DELAY = 8  # Максимальная задержка повтора, сек
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url) as response:
-                data = await response.json()
-                fields = data.get('result', {})
+# Предохранитель: при недоступности Битрикс отвечаем последними известными данными
+BITRIX_BREAKER_FAILURES = 5  # Ошибок подряд до размыкания
+BITRIX_BREAKER_RECOVERY = 30  # Пауза перед пробным запросом, сек
+BITRIX_BREAKER_SLOW_CALL = 10  # Ответ дольше этого считается ошибкой, сек
 
-                field_info = fields.get(field_id, {})
-                items = field_info.get('items', [])
 
-                for item in items:
-                    if str(item.get('ID')) == str(item_id):
-                        return item.get('VALUE', item_id)
+async def get_list_item_name(field_id: str, item_id: str):
+    """Получить текстовое название элемента списка"""
+    from bitrix_client import bitrix
+    from bitrix_meta import meta
 
-                return item_id
-    except:
-        return item_id
+    # Без загруженных справочников возвращаем ID, но не запоминаем его
+    await meta.ensure_loaded(bitrix)
+    return meta.deal_value(field_id, item_id) or item_id
 
 
 async def get_category_name(category_id: str):
-    """Получить название категории с кэшированием"""
+    """Получить название категории"""
     if not category_id or category_id == 'Н/Д':
         return 'Не указано'
 
-    if category_id in CATEGORY_CACHE:
-        return CATEGORY_CACHE[category_id]
-
-    # Используем новый ID поля категории
-    name = await get_list_item_name('UF_CRM_1764050074878', category_id)
-    CATEGORY_CACHE[category_id] = name
-    return name
+    return await get_list_item_name(BITRIX_FIELDS['product_category'], category_id)
 
 
 def get_stage_name(stage_id: str) -> str:
     """Получить читаемое название статуса"""
-    return STAGE_NAMES.get(stage_id, f'❓ {stage_id}')
+    if stage_id in STAGE_NAMES:
+        return STAGE_NAMES[stage_id]
+
+    from bitrix_meta import meta
+    name = meta.stage_name(stage_id)
+    return f'❓ {name}' if name else f'❓ {stage_id}'
 
 
 def get_stage_emoji(stage_id: str) -> str:
@@ -138,6 +221,9 @@ def get_stage_emoji(stage_id: str) -> str:
 
 def format_date(date_str: str) -> str:
     """Форматировать дату из Битрикс"""
+    if isinstance(date_str, datetime.date):
+        return date_str.strftime('%d.%m.%Y')
+
     if not date_str or date_str == 'Н/Д':
         return 'Н/Д'
 
@@ -161,22 +247,13 @@ def format_date(date_str: str) -> str:
         return 'Н/Д'
 
 
-def parse_bitrix_money_with_currency(value, default=0.0):
-    """Парсит денежное значение из Битрикс в формате '100|USD' и возвращает кортеж (сумма, валюта)"""
-    if value in [None, '', [], {}]:
-        return default, 'RUB'
-
-    try:
-        if '|' in str(value):
-            parts = str(value).split('|')
-            amount = float(parts[0])
-            currency = parts[1] if len(parts) > 1 else 'RUB'
-            return amount, currency
-        else:
-            clean_value = str(value).replace(' ', '').replace(',', '.')
-            return (float(clean_value), 'RUB') if clean_value else (default, 'RUB')
-    except (ValueError, TypeError):
-        return default, 'RUB'
+def format_quantity(value, default: str = 'Н/Д') -> str:
+    """Форматировать вес/объем без лишних нулей"""
+    if value is None:
+        return default
+    if isinstance(value, Decimal):
+        return f"{value.normalize():f}"
+    return str(value)
 
 
 def format_price(value, currency='RUB') -> str:
@@ -0,0 +1,204 @@
+"""
+Локальная копия сделок Битрикс24 в SQLite (WAL)
+Фоновая синхронизация забирает только сделки, измененные после последней
+контрольной точки (DATE_MODIFY), вебхуки изменения сделок пишут сюда же.
+Чтение - миллисекунды, без запросов к Битрикс.
+"""
+
+import asyncio
+import logging
+import time
+import codec
+import metrics
+from bitrix_client import BitrixError
+from rate_limit import background_priority
+from models import Deal, VIEW_FIELDS, select_for
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# Поля сделки, которые хранятся в копии: все, что нужно экранам бота
+MIRROR_SELECT = select_for(*VIEW_FIELDS)
+
+
+class DealMirror(SQLiteStore):
+    """Копия сделок: один SQLite файл, общий для бота и webhook handler"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS deals (
+        id INTEGER PRIMARY KEY,
+        contact_id TEXT,
+        closed TEXT,
+        date_modify TEXT,
+        data BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS deals_contact ON deals (contact_id, closed);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._ready = False
+
+    # ---- синхронные операции (выполняются в пуле потоков) ----
+
+    def _get(self, deal_id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM deals WHERE id = ?", (int(deal_id),)).fetchone()
+        return Deal.from_bitrix(codec.loads(row[0])) if row else None
+
+    def _page(self, contact_ids: list, closed: str, before_id, limit: int):
+        query = (
+            f"SELECT data FROM deals WHERE contact_id IN ({', '.join('?' * len(contact_ids))}) "
+            f"AND closed = ?"
+        )
+        params = [str(contact_id) for contact_id in contact_ids] + [closed]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(int(before_id))
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+        return [Deal.from_bitrix(codec.loads(row[0])) for row in rows]
+
+    def _count(self, contact_ids: list, closed: str):
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM deals WHERE contact_id IN ({', '.join('?' * len(contact_ids))}) "
+                f"AND closed = ?",
+                [str(contact_id) for contact_id in contact_ids] + [closed]
+            ).fetchone()[0]
+
+    @staticmethod
+    def _upsert(conn, deals: list):
+        rows = []
+        for deal in deals:
+            data = {key: deal[key] for key in MIRROR_SELECT if key in deal}
+            rows.append((
+                int(deal['ID']),
+                str(deal.get('CONTACT_ID') or ''),
+                deal.get('CLOSED') or 'N',
+                deal.get('DATE_MODIFY') or '',
+                codec.dumps(data),
+            ))
+        conn.executemany(
+            "INSERT INTO deals (id, contact_id, closed, date_modify, data) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET contact_id = excluded.contact_id, closed = excluded.closed, "
+            "date_modify = excluded.date_modify, data = excluded.data",
+            rows
+        )
+
+    def _closed_ids(self, deal_ids: list) -> set:
+        placeholders = ','.join('?' * len(deal_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id FROM deals WHERE id IN ({placeholders}) AND closed = 'Y'",
+                [int(deal_id) for deal_id in deal_ids]
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def _delete(self, deal_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM deals WHERE id = ?", (int(deal_id),))
+
+    def _get_meta(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    # ---- асинхронный интерфейс ----
+
+    async def get(self, deal_id):
+        """Сделка (Deal) по ID или None"""
+        return await asyncio.to_thread(self._get, deal_id)
+
+    async def list_page(self, contact_ids: list, closed: bool, before_id=None, limit: int = 10):
+        """
+        Страница сделок (Deal) контактов, новые сверху: limit сделок с ID меньше before_id.
+        Возвращает (сделки, курсор следующей страницы или None).
+        """
+        deals = await asyncio.to_thread(self._page, contact_ids, 'Y' if closed else 'N', before_id, limit + 1)
+        if len(deals) > limit:
+            return deals[:limit], deals[limit - 1].id
+        return deals, None
+
+    async def count(self, contact_ids: list, closed: bool) -> int:
+        """Количество сделок контактов: активных или завершенных"""
+        return await asyncio.to_thread(self._count, contact_ids, 'Y' if closed else 'N')
+
+    async def closed_ids(self, deal_ids: list) -> set:
+        """ID завершенных (WON/LOSE) сделок из deal_ids"""
+        if not deal_ids:
+            return set()
+        return await asyncio.to_thread(self._closed_ids, deal_ids)
+
+    async def upsert(self, deals: list):
+        """Записать или обновить сделки"""
+        if deals:
+            await asyncio.to_thread(self._transaction, self._upsert, deals)
+
+    async def delete(self, deal_id):
+        """Удалить сделку"""
+        await asyncio.to_thread(self._delete, deal_id)
+
+    async def checkpoint(self):
+        """DATE_MODIFY последней синхронизации или None, если полной синхронизации еще не было"""
+        return await asyncio.to_thread(self._get_meta, 'checkpoint')
+
+    async def is_ready(self) -> bool:
+        """Копия прошла первичную синхронизацию и может отвечать вместо Битрикс"""
+        if not self._ready:
+            self._ready = await self.checkpoint() is not None
+        return self._ready
+
+    async def sync_once(self, client) -> list:
+        """
+        Забрать из Битрикс сделки, измененные с последней контрольной точки.
+        Возвращает список измененных сделок.
+        """
+        checkpoint = await self.checkpoint()
+        params = {'filter': {}, 'select': MIRROR_SELECT}
+        if checkpoint:
+            # >= : сделки, измененные в ту же секунду, перезапишутся повторно, но не потеряются
+            params['filter']['>=DATE_MODIFY'] = checkpoint
+
+        started = time.monotonic()
+        changed = []
+        latest = checkpoint or ''
+        async for page in client.iter_list('crm.deal.list', params):
+            await self.upsert(page)
+            changed.extend(page)
+            latest = max([latest] + [deal.get('DATE_MODIFY') or '' for deal in page])
+
+        if latest:
+            await asyncio.to_thread(self._set_meta, 'checkpoint', latest)
+        metrics.inc('mirror.synced_deals', len(changed))
+        metrics.observe('mirror.sync', time.monotonic() - started)
+        return changed
+
+
+async def sync_loop(mirror: DealMirror, client, interval: float, on_change=None):
+    """Фоновая инкрементальная синхронизация копии сделок"""
+    while True:
+        try:
+            with background_priority():
+                changed = await mirror.sync_once(client)
+            if changed:
+                logger.info(f"Синхронизация сделок: обновлено {len(changed)}")
+                if on_change:
+                    on_change(changed)
+        except BitrixError as e:
+            logger.warning(f"Синхронизация сделок прервана: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации сделок: {e}", exc_info=True)
+        await asyncio.sleep(interval)
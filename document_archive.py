@@ -0,0 +1,235 @@
+"""
+Архив документов закрытых заказов
+Накладные и фото заказов, завершенных (WON/LOSE) и давно не менявшихся,
+собираются в один сжатый tar на заказ: файлы по SHA-256 плюс index.json
+с именами документов. Архив - обычный файл хранилища по содержимому,
+манифест помнит, в каком архиве лежит документ, а отдельные файлы
+документов, на которые больше никто не ссылается, удаляет сборка мусора.
+Заказ, архив которого не меньше самих файлов (уже сжатые фото), не архивируется.
+При обращении к документу, который нельзя отправить по file_id, заказ
+восстанавливается из архива целиком.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import re
+import tarfile
+import tempfile
+import time
+import metrics
+from document_manifest import DocumentManifest
+from file_pool import READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+INDEX = 'index.json'
+COMPRESS_LEVEL = 6
+# Проверка по SQLite за один запрос - не больше стольких заказов
+BATCH_SIZE = 500
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+class DocumentArchive:
+    """Перенос документов закрытых заказов в архив и обратно"""
+
+    def __init__(self, manifest: DocumentManifest, idle: float):
+        self.manifest = manifest
+        self.blobs = manifest.blobs
+        self.pool = manifest.blobs.pool
+        # Сколько секунд документы заказа не должны меняться, чтобы уйти в архив
+        self.idle = idle
+        self._restoring = {}
+        # Заказы, архив которых оказался не меньше файлов: заказ -> SHA-256 его файлов.
+        # Пока файлы те же, архив не собирается повторно на каждом проходе
+        self._incompressible = {}
+
+    # ---- архивация ----
+
+    @staticmethod
+    def _open_tar() -> tuple:
+        fd, path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        return path, tarfile.open(path, 'w:gz', compresslevel=COMPRESS_LEVEL)
+
+    @staticmethod
+    def _add_index(tar, index: list):
+        data = json.dumps(index, ensure_ascii=False).encode()
+        info = tarfile.TarInfo(INDEX)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+
+    async def archive(self, deal_id):
+        """
+        Собрать документы заказа в архив.
+        Возвращает (байт в документах, байт в архиве) или None, если архивировать
+        нечего или архив не меньше файлов документов.
+        """
+        deal_id = str(deal_id)
+        rows = [
+            (kind, name, entry) for kind, name, entry in self.manifest.entries(deal_id, self.manifest.get(deal_id))
+            if entry.archive is None
+        ]
+        if not rows or any(entry.digest is None for _, _, entry in rows):
+            return None
+        sizes = {entry.digest: entry.size for _, _, entry in rows}
+        for _, _, entry in rows:
+            if entry.thumb and entry.thumb not in sizes:
+                sizes[entry.thumb] = await self.blobs.size(entry.thumb)
+        digests = list(sizes)
+        if self._incompressible.get(deal_id) == digests:
+            return None
+        index = [
+            {'kind': kind, 'name': name, 'digest': entry.digest, 'thumb': entry.thumb}
+            for kind, name, entry in rows
+        ]
+
+        path, tar = await self.pool.run(self._open_tar)
+        try:
+            try:
+                for digest in digests:
+                    async with self.blobs.local_copy(digest) as source:
+                        await self.pool.run(tar.add, source, digest)
+                await self.pool.run(self._add_index, tar, index)
+            finally:
+                await self.pool.run(tar.close)
+            archive, stored = await self.blobs.put_file(path)
+        finally:
+            await self.pool.run(os.remove, path)
+
+        original = sum(sizes.values())
+        if stored >= original:
+            # Файлы не сжимаются (JPEG): архив только занял бы место рядом с ними
+            await self.blobs.delete(archive)
+            self._incompressible[deal_id] = digests
+            metrics.inc('archive.skipped')
+            logger.debug(f"Документы заказа {deal_id} не архивируются: архив {stored} байт из {original}")
+            return None
+
+        marked = await self.manifest.set_archive(
+            deal_id, [(kind, name, entry.digest) for kind, name, entry in rows], archive
+        )
+        if not marked:
+            # Документы заменили, пока собирался архив; архив без ссылок удалит сборка мусора
+            return None
+        metrics.inc('archive.deals')
+        metrics.inc('archive.bytes_in', original)
+        metrics.inc('archive.bytes_out', stored)
+        return original, stored
+
+    async def archive_closed(self, closed_ids) -> tuple:
+        """
+        Архивировать документы закрытых заказов, не менявшиеся дольше idle.
+        closed_ids(ids) - какие из заказов ids завершены.
+        Возвращает (заказов, освобождено байт за вычетом места под архивы).
+        """
+        started = time.monotonic()
+        candidates = await self.manifest.idle_deals(time.time() - self.idle)
+        archived = []
+        stored = 0
+        for start in range(0, len(candidates), BATCH_SIZE):
+            batch = candidates[start:start + BATCH_SIZE]
+            closed = {str(deal_id) for deal_id in await closed_ids(batch)}
+            for deal_id in batch:
+                if deal_id not in closed:
+                    continue
+                documents = self.manifest.get(deal_id)
+                try:
+                    result = await self.archive(deal_id)
+                except Exception as e:
+                    logger.error(f"Ошибка архивации документов заказа {deal_id}: {e}")
+                    continue
+                if result:
+                    archived.append(documents)
+                    stored += result[1]
+
+        # Освобождается место файлов, на которые больше никто не ссылается (удалит сборка мусора)
+        referenced = await self.manifest.referenced()
+        released = set()
+        reclaimed = 0
+        for documents in archived:
+            for _, _, entry in self.manifest.entries(None, documents):
+                for digest, size in ((entry.digest, entry.size), (entry.thumb, None)):
+                    if digest and digest not in referenced and digest not in released:
+                        released.add(digest)
+                        reclaimed += size if size is not None else await self.blobs.size(digest)
+        # Архивы занимают место вместо освобожденных файлов
+        reclaimed -= stored
+        if archived:
+            metrics.inc('archive.reclaimed', reclaimed)
+            logger.info(
+                f"Архив документов: заказов {len(archived)}, освобождается {reclaimed} байт "
+                f"за {time.monotonic() - started:.1f} с"
+            )
+        return len(archived), reclaimed
+
+    # ---- восстановление ----
+
+    def _members(self, tar) -> list:
+        return [
+            member for member in tar.getmembers()
+            if member.isfile() and _DIGEST.fullmatch(member.name)
+        ]
+
+    async def _read_member(self, tar, member):
+        file = await self.pool.run(tar.extractfile, member)
+        while chunk := await self.pool.run(file.read, READ_CHUNK_SIZE):
+            yield chunk
+
+    async def _unpack(self, archive: str):
+        """Вернуть файлы архива в хранилище"""
+        async with self.blobs.local_copy(archive) as path:
+            tar = await self.pool.run(tarfile.open, path, 'r:gz')
+            try:
+                for member in await self.pool.run(self._members, tar):
+                    digest, _ = await self.blobs.receive(self._read_member(tar, member))
+                    if digest != member.name:
+                        raise ValueError(f"файл {member.name} архива {archive} поврежден")
+            finally:
+                await self.pool.run(tar.close)
+
+    async def _restore(self, deal_id: str) -> int:
+        started = time.monotonic()
+        rows = [
+            (kind, name, entry) for kind, name, entry in self.manifest.entries(deal_id, self.manifest.get(deal_id))
+            if entry.archive
+        ]
+        restored = 0
+        for archive in dict.fromkeys(entry.archive for _, _, entry in rows):
+            await self._unpack(archive)
+            restored += await self.manifest.set_archive(
+                deal_id, [(kind, name, entry.digest) for kind, name, entry in rows if entry.archive == archive],
+                None, current=archive
+            )
+        if restored:
+            elapsed = time.monotonic() - started
+            metrics.inc('archive.restored')
+            metrics.observe('archive.restore', elapsed)
+            logger.info(f"Документы заказа {deal_id} восстановлены из архива за {elapsed:.2f} с")
+        return restored
+
+    async def restore(self, deal_id) -> int:
+        """
+        Вернуть документы заказа из архива. Одновременные обращения к одному
+        заказу ждут одно восстановление. Возвращает количество документов.
+        """
+        deal_id = str(deal_id)
+        task = self._restoring.get(deal_id)
+        if task is None:
+            task = self._restoring[deal_id] = asyncio.ensure_future(self._restore(deal_id))
+            task.add_done_callback(lambda _: self._restoring.pop(deal_id, None))
+        return await asyncio.shield(task)
+
+
+async def archive_loop(archive: DocumentArchive, closed_ids, interval: float):
+    """Периодический перенос документов закрытых заказов в архив"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await archive.archive_closed(closed_ids)
+        except Exception as e:
+            logger.error(f"Ошибка архивации документов: {e}")
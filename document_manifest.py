@@ -0,0 +1,443 @@
+"""
+Манифест документов заказов
+deal_id -> накладная и фото. Каждый документ - ссылка на файл в хранилище по
+содержимому (SHA-256), его размер и file_id Telegram, если он известен.
+Отрисовка списков заказов читает только память, без обращений к файловой системе.
+Документ, принятый по ссылке (file_id Telegram) и еще не скачанный, хранится
+как ожидающий: SHA-256 None, отправляется клиентам по file_id. У обработанных
+фото есть превью - отдельный маленький файл со своим file_id.
+Документы закрытых заказов могут лежать в архиве (document_archive): в записи
+остается SHA-256, а сам файл хранится внутри архива заказа.
+Номера фото выдаются в транзакции SQLite, поэтому одновременные загрузки
+в один заказ (альбом) не получают одинаковый номер. Манифест хранится в общем
+SQLite файле - webhook handler видит те же документы, что и бот.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple, Optional
+import metrics
+from blob_store import BlobStore
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+INVOICE = 'invoice'
+PHOTO = 'photo'
+
+
+class Document(NamedTuple):
+    """
+    Документ заказа: размер, SHA-256 содержимого (None - еще не скачан), file_id Telegram,
+    превью и SHA-256 архива, в котором лежат файлы документа (None - не в архиве)
+    """
+    size: int
+    digest: Optional[str]
+    file_id: Optional[str]
+    thumb: Optional[str] = None
+    thumb_file_id: Optional[str] = None
+    archive: Optional[str] = None
+
+    def preview(self) -> 'Document':
+        """Превью фото, если оно есть, иначе сам документ"""
+        if self.thumb is None:
+            return self
+        return Document(0, self.thumb, self.thumb_file_id, archive=self.archive)
+
+
+class DealDocuments:
+    """Документы одного заказа"""
+
+    __slots__ = ('invoice', 'photos')
+
+    def __init__(self, invoice=None, photos=None):
+        self.invoice = invoice
+        self.photos = photos or {}
+
+    @property
+    def photo_count(self) -> int:
+        return len(self.photos)
+
+    @property
+    def size(self) -> int:
+        """Общий размер документов заказа в байтах"""
+        return (self.invoice.size if self.invoice else 0) + sum(photo.size for photo in self.photos.values())
+
+    def __bool__(self):
+        return bool(self.invoice or self.photos)
+
+    def __eq__(self, other):
+        return isinstance(other, DealDocuments) and (self.invoice, self.photos) == (other.invoice, other.photos)
+
+    def copy(self) -> 'DealDocuments':
+        return DealDocuments(self.invoice, dict(self.photos))
+
+
+def is_pending(entry) -> bool:
+    """Документ принят, но еще не скачан на диск"""
+    return entry is not None and entry.digest is None
+
+
+def invoice_name(deal_id) -> str:
+    return f"{deal_id}.pdf"
+
+
+def photo_name(index: int) -> str:
+    return f"photo_{index:03d}.jpg"
+
+
+EMPTY = DealDocuments()
+
+
+class DocumentManifest(SQLiteStore):
+    """Документы всех заказов в памяти с копией в SQLite"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS deal_documents (
+        deal_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        number INTEGER,
+        size INTEGER,
+        digest TEXT,
+        file_id TEXT,
+        thumb TEXT,
+        thumb_file_id TEXT,
+        archive TEXT,
+        updated_at REAL,
+        PRIMARY KEY (deal_id, kind, name)
+    );
+    CREATE INDEX IF NOT EXISTS deal_documents_digest ON deal_documents (digest);
+    """
+
+    def __init__(self, path: str, blobs: BlobStore):
+        super().__init__(path)
+        self.blobs = blobs
+        self._deals = {}
+        self.load()
+
+    # ---- чтение из памяти ----
+
+    def load(self):
+        """Загрузить манифест из SQLite"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT deal_id, kind, name, size, digest, file_id, thumb, thumb_file_id, archive FROM deal_documents"
+            ).fetchall()
+        deals = {}
+        for deal_id, kind, name, *fields in rows:
+            documents = deals.setdefault(deal_id, DealDocuments())
+            if kind == INVOICE:
+                documents.invoice = Document(*fields)
+            else:
+                documents.photos[name] = Document(*fields)
+        self._deals = deals
+        metrics.set_gauge('documents.deals', len(deals))
+
+    def refresh(self):
+        """
+        Перечитать манифест, если его изменил другой процесс. Вызывается раз за такт
+        watch_loop, а не на каждое чтение: отрисовка списка заказов обходится без SQLite.
+        """
+        if self.changed_elsewhere():
+            self.load()
+
+    def get(self, deal_id) -> DealDocuments:
+        """Документы заказа (пустые, если их нет)"""
+        return self._deals.get(str(deal_id), EMPTY)
+
+    def has_invoice(self, deal_id) -> bool:
+        return self.get(deal_id).invoice is not None
+
+    def photo_count(self, deal_id) -> int:
+        return self.get(deal_id).photo_count
+
+    def photo_names(self, deal_id) -> list:
+        """Имена фото заказа по порядку"""
+        return sorted(self.get(deal_id).photos)
+
+    @staticmethod
+    def entries(deal_id, documents: DealDocuments) -> list:
+        """Документы заказа списком [(вид, имя, документ), ...]"""
+        entries = [(INVOICE, invoice_name(deal_id), documents.invoice)] if documents.invoice else []
+        return entries + [(PHOTO, name, entry) for name, entry in sorted(documents.photos.items())]
+
+    def input_file(self, entry: Document, name: str):
+        """Файл документа для отправки в Telegram (документ должен быть скачан)"""
+        return self.blobs.input_file(entry.digest, name)
+
+    # ---- изменение ----
+
+    def _set(self, deal_id: str, kind: str, name, entry):
+        """Заменить документ в памяти (name None - все документы вида, entry None - удалить)"""
+        documents = self._deals.get(deal_id, EMPTY).copy()
+        if kind == INVOICE:
+            documents.invoice = entry
+        elif name is None:
+            documents.photos = {}
+        elif entry is None:
+            documents.photos.pop(name, None)
+        else:
+            documents.photos[name] = entry
+        if documents:
+            self._deals[deal_id] = documents
+        else:
+            self._deals.pop(deal_id, None)
+        metrics.set_gauge('documents.deals', len(self._deals))
+        return documents
+
+    @staticmethod
+    def _add(conn, deal_id: str, kind: str, entries: list, skip_duplicate: bool) -> list:
+        number = conn.execute(
+            "SELECT COALESCE(MAX(number), 0) FROM deal_documents WHERE deal_id = ? AND kind = ?", (deal_id, PHOTO)
+        ).fetchone()[0]
+        names = []
+        for entry in entries:
+            if skip_duplicate and entry.digest and conn.execute(
+                "SELECT 1 FROM deal_documents WHERE deal_id = ? AND kind = ? AND digest = ?",
+                (deal_id, kind, entry.digest)
+            ).fetchone():
+                names.append(None)
+                continue
+            if kind == INVOICE:
+                name, entry_number = invoice_name(deal_id), None
+            else:
+                number += 1
+                name, entry_number = photo_name(number), number
+            conn.execute(
+                "INSERT OR REPLACE INTO deal_documents "
+                "(deal_id, kind, name, number, size, digest, file_id, thumb, thumb_file_id, archive, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (deal_id, kind, name, entry_number, *entry, time.time())
+            )
+            names.append(name)
+        return names
+
+    async def add_many(self, deal_id, kind: str, entries: list, skip_duplicate: bool = False):
+        """
+        Добавить документы одной транзакцией (накладная заменяет прежнюю,
+        фото получают следующие номера по порядку).
+        Возвращает (имена, документы заказа); имя None - такой файл у заказа
+        уже есть (только при skip_duplicate).
+        """
+        deal_id = str(deal_id)
+        names = await asyncio.to_thread(self._transaction, self._add, deal_id, kind, entries, skip_duplicate)
+        for name, entry in zip(names, entries):
+            if name is not None:
+                self._set(deal_id, kind, name, entry)
+        return names, self.get(deal_id)
+
+    async def add(self, deal_id, kind: str, size: int, digest: str = None, file_id: str = None,
+                  skip_duplicate: bool = False):
+        """Добавить один документ, вернуть (имя, документы заказа) - см. add_many"""
+        names, documents = await self.add_many(deal_id, kind, [Document(size, digest, file_id)], skip_duplicate)
+        return names[0], documents
+
+    def _settle(self, deal_id: str, kind: str, name: str, entry: Document) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE deal_documents SET size = ?, digest = ?, thumb = ?, thumb_file_id = NULL, updated_at = ? "
+                "WHERE deal_id = ? AND kind = ? AND name = ? AND file_id = ?",
+                (entry.size, entry.digest, entry.thumb, time.time(), deal_id, kind, name, entry.file_id)
+            )
+        return cursor.rowcount > 0
+
+    async def settle(self, deal_id, kind: str, name: str, size: int, digest: str, file_id: str,
+                     thumb: str = None) -> bool:
+        """
+        Отметить ожидающий документ скачанным (thumb - SHA-256 превью фото).
+        False - документ успел удалиться или замениться другим файлом.
+        """
+        deal_id = str(deal_id)
+        entry = Document(size, digest, file_id, thumb)
+        if not await asyncio.to_thread(self._settle, deal_id, kind, name, entry):
+            return False
+        self._set(deal_id, kind, name, entry)
+        return True
+
+    def _update(self, deal_id: str, kind: str, name: str, digest: str, column: str, value):
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE deal_documents SET {column} = ? "
+                "WHERE deal_id = ? AND kind = ? AND name = ? AND digest = ?",
+                (value, deal_id, kind, name, digest)
+            )
+
+    def _entry(self, deal_id: str, kind: str, name: str):
+        documents = self.get(deal_id)
+        return documents.invoice if kind == INVOICE else documents.photos.get(name)
+
+    async def set_file_id(self, deal_id, kind: str, name: str, file_id: str, preview: bool = False):
+        """Запомнить file_id, который Telegram вернул после загрузки файла (или его превью)"""
+        deal_id = str(deal_id)
+        entry = self._entry(deal_id, kind, name)
+        if entry is None or entry.digest is None:
+            return
+        column = 'thumb_file_id' if preview else 'file_id'
+        await asyncio.to_thread(self._update, deal_id, kind, name, entry.digest, column, file_id)
+        self._set(deal_id, kind, name, entry._replace(**{column: file_id}))
+
+    def _remove(self, deal_id: str, kind: str, names):
+        with self._lock:
+            if names is None:
+                self._conn.execute("DELETE FROM deal_documents WHERE deal_id = ? AND kind = ?", (deal_id, kind))
+            else:
+                self._conn.executemany(
+                    "DELETE FROM deal_documents WHERE deal_id = ? AND kind = ? AND name = ?",
+                    [(deal_id, kind, name) for name in names]
+                )
+
+    async def remove(self, deal_id, kind: str, names=None):
+        """
+        Удалить документы вида kind (names None - все). Файлы, на которые
+        больше никто не ссылается, удалит сборка мусора при сверке.
+        """
+        deal_id = str(deal_id)
+        await asyncio.to_thread(self._remove, deal_id, kind, None if names is None else list(names))
+        if names is None:
+            return self._set(deal_id, kind, None, None)
+        for name in names:
+            self._set(deal_id, kind, name, None)
+        return self.get(deal_id)
+
+    # ---- архив ----
+
+    def _idle_deals(self, before: float) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT deal_id FROM deal_documents GROUP BY deal_id "
+                "HAVING MAX(updated_at) < ? AND SUM(archive IS NULL) > 0 AND SUM(digest IS NULL) = 0",
+                (before,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    async def idle_deals(self, before: float) -> list:
+        """Заказы, документы которых не менялись с before и есть что архивировать"""
+        return await asyncio.to_thread(self._idle_deals, before)
+
+    @staticmethod
+    def _mark(conn, deal_id: str, rows: list, archive, current) -> list:
+        marked = []
+        for kind, name, digest in rows:
+            cursor = conn.execute(
+                "UPDATE deal_documents SET archive = ?, updated_at = ? "
+                "WHERE deal_id = ? AND kind = ? AND name = ? AND digest = ? AND archive IS ?",
+                (archive, time.time(), deal_id, kind, name, digest, current)
+            )
+            if cursor.rowcount:
+                marked.append((kind, name))
+        return marked
+
+    async def set_archive(self, deal_id, rows: list, archive, current=None) -> int:
+        """
+        Отметить документы rows [(вид, имя, SHA-256), ...], лежавшие в архиве current
+        (None - не в архиве), лежащими в архиве archive (None - вернулись из архива).
+        Документы, замененные за это время, не меняются. Возвращает количество отмеченных.
+        """
+        deal_id = str(deal_id)
+        marked = await asyncio.to_thread(self._transaction, self._mark, deal_id, rows, archive, current)
+        for kind, name in marked:
+            entry = self._entry(deal_id, kind, name)
+            if entry is not None:
+                self._set(deal_id, kind, name, entry._replace(archive=archive))
+        return len(marked)
+
+    # ---- обслуживание ----
+
+    @staticmethod
+    def _legacy_files(invoices_dir: str, photos_dir: str) -> list:
+        files = []
+        if os.path.isdir(invoices_dir):
+            for name in sorted(os.listdir(invoices_dir)):
+                if name.endswith('.pdf'):
+                    files.append((name[:-4], INVOICE, f"{invoices_dir}/{name}"))
+        if os.path.isdir(photos_dir):
+            for deal_id in sorted(os.listdir(photos_dir)):
+                deal_dir = f"{photos_dir}/{deal_id}"
+                if os.path.isdir(deal_dir):
+                    for name in sorted(os.listdir(deal_dir)):
+                        files.append((deal_id, PHOTO, f"{deal_dir}/{name}"))
+        return files
+
+    async def import_legacy(self, invoices_dir: str, photos_dir: str) -> int:
+        """
+        Перенести документы из старых папок (invoices/<deal>.pdf,
+        product_photos/<deal>/...) в хранилище по содержимому.
+        Перенесенный файл удаляется; повторный запуск после сбоя не создает дублей.
+        """
+        pool = self.blobs.pool
+        files = await pool.run(self._legacy_files, invoices_dir, photos_dir)
+        for deal_id, kind, path in files:
+            digest, size = await self.blobs.put_file(path)
+            await self.add(deal_id, kind, size, digest=digest, skip_duplicate=True)
+            await pool.remove(path)
+        for deal_id in {deal_id for deal_id, kind, _ in files if kind == PHOTO}:
+            await pool.rmtree(f"{photos_dir}/{deal_id}")
+        if files:
+            logger.info(f"Перенесено документов из старых папок: {len(files)}")
+        return len(files)
+
+    def _referenced(self) -> set:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT digest FROM deal_documents WHERE digest IS NOT NULL AND archive IS NULL "
+                "UNION SELECT thumb FROM deal_documents WHERE thumb IS NOT NULL AND archive IS NULL "
+                "UNION SELECT archive FROM deal_documents WHERE archive IS NOT NULL"
+            )
+            return {row[0] for row in rows}
+
+    async def referenced(self) -> set:
+        """SHA-256 всех файлов, на которые ссылается манифест (документы, превью, архивы)"""
+        return await asyncio.to_thread(self._referenced)
+
+    async def reconcile(self) -> int:
+        """
+        Сверить манифест с хранилищем: убрать ссылки на пропавшие файлы
+        и удалить файлы без ссылок. Возвращает количество убранных ссылок.
+        """
+        started = time.monotonic()
+        self.refresh()
+        missing = []
+        for deal_id, documents in list(self._deals.items()):
+            for kind, name, entry in self.entries(deal_id, documents):
+                if entry.archive:
+                    # Файлы документа - внутри архива, на месте должен быть сам архив
+                    if not await self.blobs.exists(entry.archive):
+                        missing.append((deal_id, kind, name))
+                elif entry.digest and not await self.blobs.exists(entry.digest):
+                    missing.append((deal_id, kind, name))
+                elif entry.thumb and not await self.blobs.exists(entry.thumb):
+                    # Без превью фото показывается целиком
+                    await asyncio.to_thread(self._update, deal_id, kind, name, entry.digest, 'thumb', None)
+                    self._set(deal_id, kind, name, entry._replace(thumb=None, thumb_file_id=None))
+        for deal_id, kind, name in missing:
+            logger.error(f"Файл документа не найден: заказ {deal_id}, {name}")
+            await self.remove(deal_id, kind, [name])
+
+        await self.blobs.collect_garbage(await self.referenced())
+        metrics.observe('documents.reconcile', time.monotonic() - started)
+        return len(missing)
+
+
+async def watch_loop(manifest: DocumentManifest, interval: float):
+    """Подхватывать документы, которые добавили или удалили другие процессы"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            manifest.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка чтения манифеста документов: {e}")
+
+
+async def reconcile_loop(manifest: DocumentManifest, interval: float):
+    """Периодическая сверка манифеста с хранилищем"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await manifest.reconcile()
+            if changed:
+                logger.info(f"Манифест документов: убрано ссылок на пропавшие файлы {changed}")
+        except Exception as e:
+            logger.error(f"Ошибка сверки манифеста документов: {e}")
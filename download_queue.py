@@ -0,0 +1,166 @@
+"""
+Фоновое скачивание файлов из Telegram
+Загрузка документа админом только записывает file_id - бот сразу отвечает
+и уведомляет клиента, а файл скачивается в хранилище здесь, не больше
+concurrency файлов одновременно. Очередь хранится в SQLite, поэтому
+недокачанные файлы продолжают скачиваться после перезапуска. Задание удаляется
+из очереди, только когда документ записан в манифест или скачать его не удалось
+за max_attempts попыток (об этом сообщается админам).
+"""
+
+import asyncio
+import logging
+import time
+import metrics
+from blob_store import BlobStore
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+JOB_FIELDS = ('deal_id', 'kind', 'name', 'file_id')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60  # секунды на файл
+
+
+async def telegram_chunks(bot, file_id: str):
+    """Содержимое файла Telegram частями, по мере скачивания"""
+    file = await bot.get_file(file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    async for chunk in bot.session.stream_content(
+        url=url, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE, raise_for_status=True
+    ):
+        yield chunk
+
+
+class DownloadQueue(SQLiteStore):
+    """Очередь скачивания: документ заказа -> file_id Telegram"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS download_jobs (
+        deal_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at REAL,
+        PRIMARY KEY (deal_id, kind, name)
+    );
+    """
+
+    def __init__(self, path: str, blobs: BlobStore, concurrency: int, max_attempts: int, retry_delay: float):
+        super().__init__(path)
+        self.blobs = blobs
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue()
+        self._cancelled = set()
+        self._workers = []
+
+    @staticmethod
+    def _key(job: dict) -> tuple:
+        return job['deal_id'], job['kind'], job['name']
+
+    def _insert(self, jobs: list):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO download_jobs (deal_id, kind, name, file_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(*(job[field] for field in JOB_FIELDS), time.time()) for job in jobs]
+            )
+
+    def _delete(self, job: dict):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM download_jobs WHERE deal_id = ? AND kind = ? AND name = ? AND file_id = ?",
+                tuple(job[field] for field in JOB_FIELDS)
+            )
+
+    def _delete_kind(self, deal_id: str, kind: str):
+        def delete(conn, deal_id, kind):
+            rows = conn.execute(
+                "SELECT name FROM download_jobs WHERE deal_id = ? AND kind = ?", (deal_id, kind)
+            ).fetchall()
+            conn.execute("DELETE FROM download_jobs WHERE deal_id = ? AND kind = ?", (deal_id, kind))
+            return [row[0] for row in rows]
+        return self._transaction(delete, deal_id, kind)
+
+    def _pending(self) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM download_jobs ORDER BY created_at"
+            ).fetchall()
+        return [dict(zip(JOB_FIELDS, row)) for row in rows]
+
+    async def enqueue(self, deal_id, kind: str, files: list):
+        """Поставить документы в очередь скачивания, files - [(имя, file_id), ...]"""
+        jobs = [{'deal_id': str(deal_id), 'kind': kind, 'name': name, 'file_id': file_id} for name, file_id in files]
+        await asyncio.to_thread(self._insert, jobs)
+        for job in jobs:
+            self._cancelled.discard(self._key(job))
+            self._queue.put_nowait(job)
+        metrics.set_gauge('downloads.queued', self._queue.qsize())
+
+    async def cancel(self, deal_id, kind: str):
+        """Не скачивать документы вида kind (удалены до окончания скачивания)"""
+        deal_id = str(deal_id)
+        names = await asyncio.to_thread(self._delete_kind, deal_id, kind)
+        self._cancelled.update((deal_id, kind, name) for name in names)
+
+    def start(self, bot, on_done, on_failed):
+        """
+        Запустить воркеры и дописать в очередь недокачанное до перезапуска.
+        on_done(job, digest, size) вызывается после того, как файл оказался в хранилище,
+        on_failed(job, error) - когда попытки скачать файл кончились.
+        """
+        for job in self._pending():
+            self._queue.put_nowait(job)
+        self._workers = [
+            asyncio.create_task(self._worker(bot, on_done, on_failed)) for _ in range(self.concurrency)
+        ]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    async def _worker(self, bot, on_done, on_failed):
+        while True:
+            job = await self._queue.get()
+            metrics.set_gauge('downloads.queued', self._queue.qsize())
+            try:
+                await self._download(bot, job, on_done, on_failed)
+            except Exception as e:
+                # Задание остается в SQLite и повторится после перезапуска
+                logger.error(f"Ошибка скачивания {job['name']} (заказ {job['deal_id']}): {e}", exc_info=True)
+            finally:
+                # Отмена относилась к этому заданию, новое с тем же именем ставит enqueue
+                self._cancelled.discard(self._key(job))
+                self._queue.task_done()
+
+    async def _download(self, bot, job: dict, on_done, on_failed):
+        if self._key(job) in self._cancelled:
+            return
+        started = time.monotonic()
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                digest, size = await self.blobs.receive(telegram_chunks(bot, job['file_id']))
+                break
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    # Документ остается доступным клиентам по file_id, повторять после перезапуска незачем
+                    metrics.inc('downloads.failed')
+                    logger.error(f"{job['name']} (заказ {job['deal_id']}) не скачан за {attempt} попыток: {e}")
+                    await asyncio.to_thread(self._delete, job)
+                    if self._key(job) not in self._cancelled:
+                        await on_failed(job, e)
+                    return
+                logger.warning(f"Скачивание {job['name']} не удалось ({e}), попытка {attempt + 1}")
+                await asyncio.sleep(self.retry_delay * attempt)
+
+        if self._key(job) not in self._cancelled:
+            await on_done(job, digest, size)
+        # Только после записи в манифест: при сбое on_done задание повторится после перезапуска
+        await asyncio.to_thread(self._delete, job)
+        metrics.inc('downloads.completed')
+        metrics.observe('downloads.latency', time.monotonic() - started)
@@ -0,0 +1,66 @@
+"""
+Файловые операции вне event loop
+Все обращения к диску с документами (запись, чтение для отправки, удаление,
+обход каталогов) выполняются в отдельном ограниченном пуле потоков - медленный
+или сетевой диск задерживает только их, а не обработку остальных апдейтов.
+Пул отдельный от пула asyncio.to_thread, которым пользуются SQLite хранилища,
+поэтому долгая файловая операция не занимает потоки, нужные для записи состояния.
+"""
+
+import asyncio
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class FilePool:
+    """Асинхронный доступ к файловой системе через выделенный пул потоков"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fs')
+        self._pending = 0
+
+    async def run(self, func, *args):
+        """Выполнить func(*args) в пуле"""
+        started = time.monotonic()
+        self._pending += 1
+        metrics.set_gauge('fs.pending', self._pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+            metrics.set_gauge('fs.pending', self._pending)
+            metrics.observe('fs.call', time.monotonic() - started)
+
+    async def exists(self, path: str) -> bool:
+        return await self.run(os.path.exists, path)
+
+    async def listdir(self, path: str) -> list:
+        return await self.run(os.listdir, path)
+
+    async def makedirs(self, path: str):
+        await self.run(lambda: os.makedirs(path, exist_ok=True))
+
+    async def remove(self, path: str):
+        await self.run(os.remove, path)
+
+    async def rmtree(self, path: str):
+        await self.run(lambda: shutil.rmtree(path, ignore_errors=True))
+
+    async def read_chunks(self, path: str, chunk_size: int = READ_CHUNK_SIZE):
+        """Читать файл частями, не держа его целиком в памяти"""
+        file = await self.run(open, path, 'rb')
+        try:
+            while chunk := await self.run(file.read, chunk_size):
+                yield chunk
+        finally:
+            await self.run(file.close)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
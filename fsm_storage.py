@@ -0,0 +1,97 @@
+"""
+Хранилище состояний FSM (aiogram) в SQLite
+Состояния и данные переживают перезапуск бота. Данные хранятся в памяти
+и на диске в сжатом виде (байты общего JSON кодека) и разбираются только
+при чтении - без deepcopy на каждое обращение, как в MemoryStorage.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Mapping
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey, StateType
+import codec
+import metrics
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+EMPTY_DATA = codec.dumps({})
+
+
+class SQLiteStorage(SQLiteStore, BaseStorage):
+    """Состояния FSM: память + запись на диск в пуле потоков"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS fsm (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data BLOB,
+        updated_at REAL
+    );
+    """
+
+    def __init__(self, path: str, ttl: float = None):
+        super().__init__(path)
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._states = {}
+        self._data = {}
+        self.load()
+
+    def load(self):
+        """Загрузить сохраненные состояния, устаревшие удалить"""
+        with self._lock:
+            if self.ttl:
+                self._conn.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+            rows = self._conn.execute("SELECT key, state, data FROM fsm").fetchall()
+        for key, state, data in rows:
+            if state:
+                self._states[key] = state
+            if data and data != EMPTY_DATA:
+                self._data[key] = data
+        metrics.set_gauge('fsm.keys', len(rows))
+        logger.info(f"Состояния FSM: {len(rows)} записей")
+
+    def _write(self, key: str):
+        state = self._states.get(key)
+        data = self._data.get(key)
+        with self._lock:
+            if state is None and data is None:
+                self._conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            else:
+                self._conn.execute(
+                    "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    (key, state, data, time.time())
+                )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            self._states.pop(name, None)
+        else:
+            self._states[name] = state
+        await asyncio.to_thread(self._write, name)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._states.get(self.key_builder.build(key))
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        name = self.key_builder.build(key)
+        if data:
+            self._data[name] = codec.dumps(dict(data))
+        else:
+            self._data.pop(name, None)
+        await asyncio.to_thread(self._write, name)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        data = self._data.get(self.key_builder.build(key))
+        return codec.loads(data) if data else {}
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
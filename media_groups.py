@@ -0,0 +1,44 @@
+"""
+Сбор альбомов (media group) Telegram
+Альбом приходит отдельными апдейтами - по одному на фото. Первый обработчик
+альбома ждет, пока новые фото перестанут приходить, и получает весь альбом
+разом; обработчики остальных фото сразу завершаются. Так альбом сохраняется
+одной записью состояния и одним обновлением сообщения вместо N.
+"""
+
+import asyncio
+import metrics
+
+
+class MediaGroupCollector:
+    """Сообщения альбомов, которые еще собираются: (chat_id, media_group_id) -> сообщения"""
+
+    def __init__(self, delay: float):
+        # Пауза после последнего фото, после которой альбом считается полным
+        self.delay = delay
+        self._groups = {}
+
+    async def collect(self, message) -> list:
+        """
+        Все сообщения альбома для первого его сообщения, пустой список для остальных.
+        Сообщение без альбома возвращается сразу.
+        """
+        if not message.media_group_id:
+            return [message]
+        key = (message.chat.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(message)
+            return []
+
+        group = self._groups[key] = [message]
+        try:
+            size = 0
+            while size != len(group):
+                size = len(group)
+                await asyncio.sleep(self.delay)
+        finally:
+            del self._groups[key]
+        metrics.inc('media_groups.albums')
+        metrics.inc('media_groups.messages', len(group))
+        return sorted(group, key=lambda item: item.message_id)
@@ -0,0 +1,60 @@
+"""
+Метрики процесса
+Счетчики, текущие значения и тайминги в памяти. Снимок отдается через
+/metrics в webhook handler и командой /stats в боте.
+"""
+
+import asyncio
+from collections import defaultdict
+
+counters = defaultdict(int)
+gauges = {}
+timings = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+
+
+def inc(name: str, value: int = 1):
+    """Увеличить счетчик"""
+    counters[name] += value
+
+
+def set_gauge(name: str, value):
+    """Записать текущее значение"""
+    gauges[name] = value
+
+
+def observe(name: str, seconds: float):
+    """Учесть длительность операции"""
+    timing = timings[name]
+    timing['count'] += 1
+    timing['total'] += seconds
+    timing['max'] = max(timing['max'], seconds)
+
+
+def snapshot() -> dict:
+    """Снимок всех метрик"""
+    return {
+        'counters': dict(counters),
+        'gauges': dict(gauges),
+        'timings': {
+            name: {
+                'count': t['count'],
+                'avg': round(t['total'] / t['count'], 4) if t['count'] else 0.0,
+                'max': round(t['max'], 4),
+            }
+            for name, t in timings.items()
+        },
+    }
+
+
+async def watch_loop_lag(interval: float):
+    """
+    Измерять задержку event loop: насколько позже заданного просыпается
+    sleep(interval). Большая задержка - loop занят синхронной работой.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started - interval, 0.0)
+        observe('loop.lag', lag)
+        set_gauge('loop.lag', round(lag, 4))
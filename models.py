@@ -0,0 +1,151 @@
+"""
+Модель сделки
+Значения полей Битрикс разбираются один раз при получении: даты - в date,
+деньги - в Decimal с валютой, вес и объем - в Decimal. Каждый экран объявляет
+нужные ему поля, и из Битрикс запрашиваются только они.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from config import BITRIX_FIELDS
+
+# Атрибут модели -> поле сделки в Битрикс
+FIELD_MAP = {
+    'id': 'ID',
+    'title': 'TITLE',
+    'stage_id': 'STAGE_ID',
+    'contact_id': 'CONTACT_ID',
+    'closed': 'CLOSED',
+    'date_create': 'DATE_CREATE',
+    'date_modify': 'DATE_MODIFY',
+    'opportunity': 'OPPORTUNITY',
+    'currency': 'CURRENCY_ID',
+    'invoice_cost': BITRIX_FIELDS['invoice_cost'],
+    'weight': BITRIX_FIELDS['weight'],
+    'volume': BITRIX_FIELDS['volume'],
+    'insurance': BITRIX_FIELDS['insurance'],
+    'product_category': BITRIX_FIELDS['product_category'],
+    'expected_send_date': BITRIX_FIELDS['expected_send_date'],
+    'expected_arrival_date': BITRIX_FIELDS['expected_arrival_date'],
+    'arrival_city': BITRIX_FIELDS['arrival_city'],
+    'cargo_marking': BITRIX_FIELDS['cargo_marking'],
+}
+
+# Поля, которые нужны каждому экрану
+VIEW_FIELDS = {
+    # Списки заказов (клиент и админка)
+    'list': ('id', 'title', 'date_create', 'stage_id', 'contact_id', 'closed'),
+    # Карточка текущего заказа
+    'details': (
+        'id', 'title', 'stage_id', 'product_category', 'weight', 'volume', 'insurance',
+        'expected_send_date', 'expected_arrival_date', 'arrival_city', 'cargo_marking',
+        'invoice_cost', 'opportunity', 'currency',
+    ),
+    # Карточка архивного заказа
+    'archive': (
+        'id', 'title', 'expected_send_date', 'weight', 'volume', 'product_category',
+        'invoice_cost', 'opportunity', 'currency', 'date_create', 'date_modify',
+    ),
+    # Служебные поля: уведомления, кэш, локальная копия
+    'service': ('id', 'contact_id', 'stage_id', 'closed', 'date_modify'),
+}
+
+
+def select_for(*views: str) -> list:
+    """Список полей Битрикс (select) для набора экранов"""
+    fields = []
+    for view in views:
+        for attr in VIEW_FIELDS[view]:
+            field = FIELD_MAP[attr]
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def is_empty(value) -> bool:
+    return value in (None, '', [], {})
+
+
+def parse_text(value):
+    """Строка без пробелов по краям или None"""
+    if is_empty(value):
+        return None
+    if isinstance(value, list):
+        value = ', '.join(str(item) for item in value)
+    return str(value).strip() or None
+
+
+def parse_date(value):
+    """Дата из Битрикс (ISO или ДД.ММ.ГГГГ) в date; нераспознанный текст остается строкой"""
+    text = parse_text(value)
+    if text is None:
+        return None
+    try:
+        if '.' in text and len(text) == 10:
+            return datetime.strptime(text, '%d.%m.%Y').date()
+        if '-' in text and len(text) >= 10:
+            return date.fromisoformat(text[:10])
+    except ValueError:
+        pass
+    return text
+
+
+def parse_decimal(value):
+    """Число в Decimal ('12,5' -> 12.5); нечисловой текст остается строкой"""
+    text = parse_text(value)
+    if text is None:
+        return None
+    try:
+        return Decimal(text.replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        return text
+
+
+def parse_money(value, default_currency: str = 'RUB'):
+    """Деньги из Битрикс ('100|USD' или '100') в (Decimal, валюта)"""
+    text = parse_text(value)
+    if text is None:
+        return Decimal(0), default_currency
+    amount, _, currency = text.partition('|')
+    try:
+        return Decimal(amount.replace(' ', '').replace(',', '.')), currency or default_currency
+    except InvalidOperation:
+        return Decimal(0), default_currency
+
+
+class Deal:
+    """Сделка с уже разобранными значениями полей"""
+
+    __slots__ = (
+        'id', 'title', 'stage_id', 'contact_id', 'closed', 'date_create', 'date_modify',
+        'opportunity', 'currency', 'invoice_cost', 'invoice_currency', 'weight', 'volume',
+        'insurance', 'product_category', 'expected_send_date', 'expected_arrival_date',
+        'arrival_city', 'cargo_marking',
+    )
+
+    @classmethod
+    def from_bitrix(cls, raw: dict) -> 'Deal':
+        """Разобрать сделку из ответа crm.deal.list / crm.deal.get"""
+        deal = cls.__new__(cls)
+        deal.id = str(raw.get('ID', ''))
+        deal.title = parse_text(raw.get('TITLE'))
+        deal.stage_id = parse_text(raw.get('STAGE_ID'))
+        deal.contact_id = parse_text(raw.get('CONTACT_ID'))
+        deal.closed = raw.get('CLOSED') == 'Y'
+        deal.date_create = parse_date(raw.get('DATE_CREATE'))
+        deal.date_modify = parse_date(raw.get('DATE_MODIFY'))
+        deal.currency = parse_text(raw.get('CURRENCY_ID')) or 'RUB'
+        deal.opportunity, _ = parse_money(raw.get('OPPORTUNITY'), deal.currency)
+        deal.invoice_cost, deal.invoice_currency = parse_money(raw.get(FIELD_MAP['invoice_cost']))
+        deal.weight = parse_decimal(raw.get(FIELD_MAP['weight']))
+        deal.volume = parse_decimal(raw.get(FIELD_MAP['volume']))
+        deal.insurance = parse_text(raw.get(FIELD_MAP['insurance']))
+        deal.product_category = parse_text(raw.get(FIELD_MAP['product_category']))
+        deal.expected_send_date = parse_date(raw.get(FIELD_MAP['expected_send_date']))
+        deal.expected_arrival_date = parse_date(raw.get(FIELD_MAP['expected_arrival_date']))
+        deal.arrival_city = parse_text(raw.get(FIELD_MAP['arrival_city']))
+        deal.cargo_marking = parse_text(raw.get(FIELD_MAP['cargo_marking']))
+        return deal
+
+    def __repr__(self):
+        return f"Deal(id={self.id!r}, title={self.title!r}, stage_id={self.stage_id!r})"
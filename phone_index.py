@@ -0,0 +1,138 @@
+"""
+Индекс телефон -> контакты Битрикс24
+Хранится в общем SQLite файле (WAL) - бот и webhook handler видят один индекс,
+запись одного номера - одна строка, без перезаписи всего индекса. Записи живут
+PHONE_INDEX_TTL, неизвестные номера запоминаются на PHONE_INDEX_NEGATIVE_TTL.
+Наполняется при регистрации клиентов и поиске в админке, устаревающие записи
+обновляются в фоне.
+"""
+
+import asyncio
+import logging
+import time
+import codec
+import metrics
+from rate_limit import background_priority
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# Поля контакта, которые нужны боту (регистрация и админка)
+CONTACT_KEYS = ('ID', 'NAME', 'LAST_NAME', 'EMAIL', 'PHONE')
+
+
+def compact_contact(contact: dict) -> dict:
+    """Оставить только нужные поля контакта"""
+    return {key: contact[key] for key in CONTACT_KEYS if key in contact}
+
+
+class PhoneIndex(SQLiteStore):
+    """Нормализованный телефон -> основной контакт и все контакты с этим номером"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS phones (
+        phone TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        updated REAL NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS phones_expires ON phones (expires);
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self.load()
+
+    @staticmethod
+    def _write_many(conn, items: list):
+        conn.executemany(
+            "INSERT INTO phones (phone, data, updated, expires) VALUES (?, ?, ?, ?) ON CONFLICT(phone) "
+            "DO UPDATE SET data = excluded.data, updated = excluded.updated, expires = excluded.expires",
+            [
+                (phone, codec.dumps({'primary': entry['primary'], 'contacts': entry['contacts']}),
+                 entry['updated'], entry['expires'])
+                for phone, entry in items
+            ]
+        )
+
+    def load(self):
+        """Прочитать индекс из SQLite"""
+        with self._lock:
+            rows = self._conn.execute("SELECT phone, data, updated, expires FROM phones").fetchall()
+        self._entries = {
+            phone: {**codec.loads(data), 'updated': updated, 'expires': expires}
+            for phone, data, updated, expires in rows
+        }
+        metrics.set_gauge('phone_index.size', len(self._entries))
+
+    def get(self, phone: str):
+        """
+        Запись по нормализованному телефону: {'primary': контакт или None, 'contacts': [...]}.
+        None, если номера нет в индексе или запись устарела.
+        """
+        if self.changed_elsewhere():
+            self.load()
+        entry = self._entries.get(phone)
+        if entry is None or entry['expires'] < time.time():
+            metrics.inc('phone_index.misses')
+            return None
+        metrics.inc('phone_index.hits')
+        return entry
+
+    async def put(self, phone: str, primary: dict = None, contacts: list = None):
+        """Запомнить результат поиска (пустой результат - отрицательная запись)"""
+        contacts = [compact_contact(c) for c in contacts or []]
+        now = time.time()
+        entry = {
+            'primary': compact_contact(primary) if primary else None,
+            'contacts': contacts,
+            'updated': now,
+            'expires': now + (self.ttl if primary or contacts else self.negative_ttl),
+        }
+        self._entries[phone] = entry
+        metrics.set_gauge('phone_index.size', len(self._entries))
+        try:
+            await asyncio.to_thread(self._transaction, self._write_many, [(phone, entry)])
+        except Exception as e:
+            logger.error(f"Не удалось сохранить индекс телефонов: {e}")
+
+    def stale_phones(self, older_than: float) -> list:
+        """Положительные записи, обновленные больше older_than секунд назад"""
+        if self.changed_elsewhere():
+            self.load()
+        threshold = time.time() - older_than
+        return [
+            phone for phone, entry in self._entries.items()
+            if entry['updated'] < threshold and (entry['primary'] or entry['contacts'])
+        ]
+
+    def _purge(self, now: float) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM phones WHERE expires < ?", (now,)).rowcount
+
+    async def purge_expired(self) -> int:
+        """Удалить истекшие записи"""
+        now = time.time()
+        removed = await asyncio.to_thread(self._purge, now)
+        self._entries = {phone: entry for phone, entry in self._entries.items() if entry['expires'] >= now}
+        metrics.set_gauge('phone_index.size', len(self._entries))
+        return removed
+
+
+async def refresh_loop(index: PhoneIndex, resolver, interval: float, older_than: float):
+    """Фоновое обновление: перезапрашивает устаревающие номера через resolver(phone)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await index.purge_expired()
+            phones = index.stale_phones(older_than)
+            with background_priority():
+                for phone in phones:
+                    await resolver(phone)
+            if phones:
+                logger.info(f"Индекс телефонов: обновлено {len(phones)} номеров")
+        except Exception as e:
+            logger.error(f"Ошибка обновления индекса телефонов: {e}")
@@ -0,0 +1,88 @@
+"""
+Обработка фото товара после загрузки
+Скачанное фото поворачивается по EXIF, уменьшается до PHOTO_MAX_SIDE
+и пережимается в JPEG, рядом сохраняется маленькая превью-копия. Работа
+с пикселями занимает процессор, поэтому идет в отдельных процессах, а не
+в event loop и не в пуле потоков.
+Нужен Pillow; без него фото хранятся как есть.
+"""
+
+import asyncio
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = Image is not None
+
+
+def _encode(image, max_side: int, quality: int) -> bytes:
+    copy = image.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    copy.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def render(path: str, max_side: int, quality: int, thumb_side: int, thumb_quality: int) -> tuple:
+    """
+    Выполняется в процессе пула: (фото, превью) в JPEG.
+    EXIF в копии не переносятся - поворот уже применен.
+    """
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        return _encode(image, max_side, quality), _encode(image, thumb_side, thumb_quality)
+
+
+def _warm_up():
+    return AVAILABLE
+
+
+class PhotoPipeline:
+    """Пул процессов для обработки фото"""
+
+    def __init__(self, workers: int, max_side: int, quality: int, thumb_side: int, thumb_quality: int):
+        self.workers = workers
+        self.options = (max_side, quality, thumb_side, thumb_quality)
+        self._executor = None
+
+    def start(self):
+        """
+        Запустить процессы. Вызывать до запуска фоновых задач: процессы
+        создаются через fork, и в этот момент в боте еще нет других потоков.
+        """
+        if not AVAILABLE:
+            logger.warning("Pillow не установлен - фото сохраняются без обработки")
+            return
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+        for _ in range(self.workers):
+            self._executor.submit(_warm_up)
+
+    async def process(self, path: str):
+        """(фото, превью) в JPEG или None, если обработка недоступна или не удалась"""
+        if self._executor is None:
+            return None
+        started = time.monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, render, path, *self.options)
+        except Exception as e:
+            metrics.inc('photos.failed')
+            logger.error(f"Ошибка обработки фото {path}: {e}")
+            return None
+        metrics.observe('photos.process', time.monotonic() - started)
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,166 @@
+"""
+Ограничение частоты запросов к Битрикс24
+Token bucket с очередью по приоритетам: пока токенов нет, первыми обслуживаются
+интерактивные запросы (нажатия кнопок клиентами), затем фоновые (вебхуки, синхронизация).
+Лимит портала общий для бота и всех воркеров webhook handler, поэтому запас
+токенов хранится в общем SQLite файле (SharedTokenBucket): сколько бы процессов
+ни работало, вместе они делают не больше rate запросов в секунду. Очередь по
+приоритетам - своя в каждом процессе.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import metrics
+from shared_state import SQLiteStore
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+# Приоритет запросов текущей задачи (по умолчанию - интерактивный)
+request_priority = ContextVar('bitrix_request_priority', default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def background_priority():
+    """Выполнить запросы к Битрикс внутри блока с фоновым приоритетом"""
+    token = request_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class TokenBucket:
+    """Token bucket в памяти процесса: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _spend(self, tokens: float, elapsed: float) -> tuple:
+        """Пополнить запас за elapsed секунд и взять токен: (остаток, сколько ждать; 0 - токен взят)"""
+        # max: часы процессов могут немного расходиться
+        tokens = min(self.burst, tokens + max(0.0, elapsed) * self.rate)
+        # Допуск на округление: после ожидания ровно wait секунд токен должен быть
+        if tokens >= 1 - 1e-9:
+            return max(0.0, tokens - 1), 0.0
+        return tokens, (1 - tokens) / self.rate
+
+    async def take(self) -> float:
+        """Взять токен: 0, если взят, иначе сколько секунд ждать следующего"""
+        now = self.clock()
+        self.tokens, wait = self._spend(self.tokens, now - self.updated)
+        self.updated = now
+        return wait
+
+
+class RateBuckets(SQLiteStore):
+    """Запасы токенов в общем SQLite файле"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    );
+    """
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket в общем SQLite файле: один запас токенов на все процессы"""
+
+    def __init__(self, path: str, rate: float, burst: int, name: str = 'bitrix', clock=time.time):
+        super().__init__(rate, burst, clock)
+        self.path = path
+        self.name = name
+        # Файл открывается при первом запросе: импорт клиента Битрикс не трогает диск
+        self._store = None
+
+    def _take(self, conn) -> float:
+        now = self.clock()
+        row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE name = ?", (self.name,)).fetchone()
+        tokens, updated = row if row else (float(self.burst), now)
+        tokens, wait = self._spend(tokens, now - updated)
+        conn.execute(
+            "INSERT INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+            (self.name, tokens, now)
+        )
+        return wait
+
+    async def take(self) -> float:
+        if self._store is None:
+            self._store = RateBuckets(self.path)
+        return await asyncio.to_thread(self._store._transaction, self._take)
+
+
+class PriorityRateLimiter:
+    """Очередь запросов по приоритетам перед token bucket (общим или своим)"""
+
+    def __init__(self, bucket, name: str = 'bitrix'):
+        self.bucket = bucket
+        self.name = name
+        self._queue = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def _update_depth(self):
+        metrics.set_gauge(f"{self.name}.queue_depth", len(self._queue))
+
+    def _prune(self):
+        """Убрать из головы очереди отмененные ожидания"""
+        while self._queue and self._queue[0][2].done():
+            heapq.heappop(self._queue)
+
+    async def _dispatch(self):
+        """Раздавать токены ожидающим по приоритету, пока очередь не опустеет"""
+        try:
+            while True:
+                self._prune()
+                self._update_depth()
+                if not self._queue:
+                    return
+                wait = await self.bucket.take()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                self._prune()
+                if self._queue:
+                    _, _, future = heapq.heappop(self._queue)
+                    future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    async def acquire(self, priority: int = None):
+        """Дождаться токена; priority по умолчанию берется из контекста задачи"""
+        if priority is None:
+            priority = request_priority.get()
+        label = PRIORITY_NAMES.get(priority, str(priority))
+
+        if not self._queue and not await self.bucket.take():
+            metrics.observe(f"{self.name}.wait.{label}", 0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), future))
+        self._update_depth()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        started = time.monotonic()
+        try:
+            await future
+        finally:
+            metrics.observe(f"{self.name}.wait.{label}", time.monotonic() - started)
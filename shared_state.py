@@ -0,0 +1,154 @@
+"""
+Общее состояние бота и webhook handler
+Бот и webhook handler - разные процессы (webhook handler может работать в
+нескольких воркерах uvicorn), поэтому все, что они должны видеть одинаково,
+хранится в общих SQLite файлах (WAL). Каждый процесс держит копию в памяти
+и перечитывает ее, только когда файл изменил другой процесс (PRAGMA data_version).
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore:
+    """SQLite файл в режиме WAL, общий для нескольких процессов"""
+
+    schema = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.schema)
+        self._version = self._data_version()
+
+    def _data_version(self) -> int:
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed_elsewhere(self) -> bool:
+        """
+        Изменил ли файл другой процесс с прошлой проверки.
+        Собственные записи соединения data_version не меняют.
+        Вызывается из event loop, поэтому не ждет блокировку: пока соединение
+        занято транзакцией (BEGIN IMMEDIATE может ждать чужую запись до 5 секунд),
+        процесс работает со своей копией, а изменение заметит следующая проверка.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            self._lock.release()
+        if version == self._version:
+            return False
+        self._version = version
+        return True
+
+    def _transaction(self, func, *args):
+        """Выполнить func(conn, *args) в транзакции с блокировкой записи"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn, *args)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return result
+
+
+class DealStages(SQLiteStore):
+    """
+    Последние известные стадии сделок.
+    Каждая запись получает возрастающий номер (seq) - по нему процессы узнают,
+    какие сделки обновил кто-то другой, и сбрасывают свои кэши.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS deal_stages (
+        deal_id INTEGER PRIMARY KEY,
+        contact_id TEXT,
+        stage_id TEXT,
+        seq INTEGER NOT NULL,
+        updated_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS deal_stages_seq ON deal_stages (seq);
+    """
+
+    @staticmethod
+    def _record(conn, deal_id: int, contact_id: str, stage_id: str):
+        row = conn.execute("SELECT stage_id FROM deal_stages WHERE deal_id = ?", (deal_id,)).fetchone()
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM deal_stages").fetchone()[0]
+        conn.execute(
+            "INSERT INTO deal_stages (deal_id, contact_id, stage_id, seq, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(deal_id) DO UPDATE SET "
+            "contact_id = excluded.contact_id, stage_id = excluded.stage_id, "
+            "seq = excluded.seq, updated_at = excluded.updated_at",
+            (deal_id, contact_id, stage_id, seq, time.time())
+        )
+        return row[0] if row else None
+
+    async def record(self, deal_id, contact_id, stage_id: str):
+        """
+        Записать текущую стадию сделки и вернуть предыдущую (None, если сделка новая).
+        Чтение и запись - одна транзакция, поэтому из нескольких воркеров,
+        получивших одно и то же событие, смену стадии увидит только один.
+        """
+        return await asyncio.to_thread(
+            self._transaction, self._record, int(deal_id), str(contact_id or ''), stage_id
+        )
+
+    def _get(self, deal_id: int):
+        with self._lock:
+            row = self._conn.execute("SELECT stage_id FROM deal_stages WHERE deal_id = ?", (deal_id,)).fetchone()
+        return row[0] if row else None
+
+    async def get(self, deal_id):
+        """Последняя известная стадия сделки или None"""
+        return await asyncio.to_thread(self._get, int(deal_id))
+
+    def _changes(self, after_seq: int):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, deal_id, contact_id FROM deal_stages WHERE seq > ? ORDER BY seq",
+                (after_seq,)
+            ).fetchall()
+
+    async def changes(self, after_seq: int) -> list:
+        """Сделки, записанные после номера after_seq: [(seq, deal_id, contact_id), ...]"""
+        return await asyncio.to_thread(self._changes, after_seq)
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM deal_stages").fetchone()[0]
+
+
+async def watch_loop(stages: DealStages, interval: float, on_change):
+    """
+    Следить за сделками, которые обновили другие процессы.
+    on_change(deals) получает список (deal_id, contact_id).
+    """
+    cursor = await asyncio.to_thread(stages.last_seq)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not stages.changed_elsewhere():
+                continue
+            rows = await stages.changes(cursor)
+            if rows:
+                cursor = rows[-1][0]
+                on_change([(str(deal_id), contact_id) for _, deal_id, contact_id in rows])
+        except Exception as e:
+            logger.error(f"Ошибка чтения общего состояния: {e}")
@@ -0,0 +1,56 @@
+"""
+Single-flight для запросов к Битрикс24
+Одновременные вызовы с одинаковым ключом ждут один общий запрос вместо
+того, чтобы отправлять каждый свой. Счетчики singleflight.<name>.hits/misses
+показывают, сколько запросов сэкономлено.
+"""
+
+import asyncio
+import functools
+import metrics
+
+
+class SingleFlight:
+    """Группа вызовов, объединяемых по ключу"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        """Выполнить func(*args) или присоединиться к уже идущему вызову с тем же ключом"""
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.inc(f"singleflight.{self.name}.hits")
+            return await asyncio.shield(future)
+
+        metrics.inc(f"singleflight.{self.name}.misses")
+        future = asyncio.ensure_future(func(*args, **kwargs))
+        self._calls[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def in_flight(self) -> int:
+        """Сколько запросов выполняется сейчас"""
+        return len(self._calls)
+
+
+def single_flight(name: str, key=None):
+    """Декоратор: объединять одновременные вызовы функции с одинаковыми аргументами"""
+    def decorator(func):
+        flight = SingleFlight(name)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call_key = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            return await flight.do(call_key, func, *args, **kwargs)
+
+        wrapper.flight = flight
+        return wrapper
+
+    return decorator
@@ -0,0 +1,417 @@
+"""
+Бэкенды хранения файлов документов
+BlobStore хранит файлы через бэкенд: локальный диск (LocalBackend) или
+S3-совместимое хранилище (S3Backend - AWS S3, MinIO, Yandex Object Storage).
+С S3 бот и webhook handler могут работать на разных машинах.
+Интерфейс у бэкендов общий: put (потоковая запись), get (чтение частями,
+в том числе диапазона байт), stat, list, delete, move, touch и presigned_url.
+Файлы никогда не читаются в память целиком.
+"""
+
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import tempfile
+import time
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, Optional
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+import aiohttp
+from yarl import URL
+import metrics
+from file_pool import FilePool, READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_DIR = '.partial'
+
+
+class ObjectInfo(NamedTuple):
+    """Файл в хранилище: ключ, размер, время изменения (unix time)"""
+    key: str
+    size: int
+    modified: float
+
+
+class StorageError(Exception):
+    """Ошибка хранилища (ответ S3 с ошибкой)"""
+
+
+class LocalBackend:
+    """Файлы в каталоге на локальном диске, все операции - через пул файловых операций"""
+
+    def __init__(self, root: str, pool: FilePool):
+        self.root = root
+        self.pool = pool
+        os.makedirs(f"{root}/{PARTIAL_DIR}", exist_ok=True)
+
+    def local_path(self, key: str) -> str:
+        return f"{self.root}/{key}"
+
+    def _open_partial(self):
+        fd, partial = tempfile.mkstemp(dir=f"{self.root}/{PARTIAL_DIR}")
+        return partial, os.fdopen(fd, 'wb')
+
+    def _finish(self, file, partial: str, key: str):
+        # Содержимое - на диск до переименования, иначе после сбоя питания
+        # под именем файла может оказаться пустой или недописанный файл
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(partial, path)
+        self._fsync_dir(os.path.dirname(path))
+
+    @staticmethod
+    def _fsync_dir(directory: str):
+        """Записать на диск сам каталог - переименование в нем"""
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _discard(file, partial: str):
+        file.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    async def put(self, key: str, chunks) -> int:
+        """Записать файл из асинхронного потока частей; файл появляется целиком (атомарно)"""
+        partial, file = await self.pool.run(self._open_partial)
+        size = 0
+        try:
+            async for chunk in chunks:
+                await self.pool.run(file.write, chunk)
+                size += len(chunk)
+            await self.pool.run(self._finish, file, partial, key)
+        except BaseException:
+            await self.pool.run(self._discard, file, partial)
+            raise
+        return size
+
+    async def get(self, key: str, start: int = 0, end: int = None):
+        """Читать файл частями, end - последний байт диапазона (включительно)"""
+        file = await self.pool.run(open, self.local_path(key), 'rb')
+        try:
+            await self.pool.run(file.seek, start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                size = READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining)
+                chunk = await self.pool.run(file.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            await self.pool.run(file.close)
+
+    def _stat(self, key: str) -> Optional[ObjectInfo]:
+        try:
+            stat = os.stat(self.local_path(key))
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(key, stat.st_size, stat.st_mtime)
+
+    async def stat(self, key: str) -> Optional[ObjectInfo]:
+        return await self.pool.run(self._stat, key)
+
+    def _list(self, prefix: str) -> list:
+        objects = []
+        for directory, dirs, names in os.walk(self.root):
+            dirs[:] = [name for name in dirs if name != PARTIAL_DIR]
+            for name in names:
+                key = os.path.relpath(f"{directory}/{name}", self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    info = self._stat(key)
+                    if info:
+                        objects.append(info)
+        return objects
+
+    async def list(self, prefix: str = '') -> list:
+        return await self.pool.run(self._list, prefix)
+
+    def _delete(self, key: str):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, key: str):
+        await self.pool.run(self._delete, key)
+
+    def _move(self, source: str, key: str):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.local_path(source), path)
+        self._fsync_dir(os.path.dirname(path))
+
+    async def move(self, source: str, key: str):
+        await self.pool.run(self._move, source, key)
+
+    async def touch(self, key: str):
+        """Обновить время изменения файла"""
+        await self.pool.run(os.utime, self.local_path(key))
+
+    def presigned_url(self, key: str, expires: int) -> Optional[str]:
+        """У локального диска нет ссылок - файл отправляется содержимым"""
+        return None
+
+    async def close(self):
+        pass
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _quote(value: str, safe: str = '-_.~') -> str:
+    return quote(value, safe=safe)
+
+
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+
+class S3Backend:
+    """
+    S3-совместимое хранилище поверх aiohttp (подпись запросов AWS Signature V4,
+    адресация path-style: endpoint/bucket/key - так работает MinIO).
+    Файлы больше part_size загружаются по частям (multipart upload).
+    """
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = 'us-east-1', part_size: int = 8 * 1024 * 1024, timeout: float = 300):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urlsplit(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        # S3 принимает части не меньше 5 МБ (кроме последней)
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Сессия создается при первом обращении (нужен запущенный event loop)"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+    # ---- подпись ----
+
+    def _path(self, key: str = '') -> str:
+        return _quote(f"/{self.bucket}/{key}" if key else f"/{self.bucket}", safe='/-_.~')
+
+    def _scope(self, now: datetime.datetime) -> tuple:
+        date = now.strftime('%Y%m%d')
+        return now.strftime('%Y%m%dT%H%M%SZ'), date, f"{date}/{self.region}/s3/aws4_request"
+
+    def _signature(self, date: str, string_to_sign: str) -> str:
+        key = _hmac(f"AWS4{self.secret_key}".encode('utf-8'), date)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        return hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def _canonical_query(query: dict) -> str:
+        return '&'.join(f"{_quote(k)}={_quote(str(v))}" for k, v in sorted(query.items()))
+
+    def sign(self, method: str, path: str, query: dict, headers: dict,
+             payload_hash: str = UNSIGNED_PAYLOAD, now: datetime.datetime = None) -> dict:
+        """Заголовки запроса с подписью Signature V4 (подписываются все переданные заголовки)"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amz_date, date, scope = self._scope(now)
+        headers = {
+            **{name.lower(): str(value).strip() for name, value in headers.items()},
+            'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash,
+        }
+        signed = ';'.join(sorted(headers))
+        canonical = '\n'.join([
+            method, path, self._canonical_query(query),
+            ''.join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            signed, payload_hash,
+        ])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, _sha256(canonical.encode('utf-8'))])
+        headers['authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, SignedHeaders={signed}, "
+            f"Signature={self._signature(date, string_to_sign)}"
+        )
+        del headers['host']
+        return headers
+
+    def presigned_url(self, key: str, expires: int, now: datetime.datetime = None) -> str:
+        """Ссылка на скачивание файла без ключей доступа, действует expires секунд"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amz_date, date, scope = self._scope(now)
+        path = self._path(key)
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f"{self.access_key}/{scope}",
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        canonical = '\n'.join([
+            'GET', path, self._canonical_query(query), f"host:{self.host}\n", 'host', UNSIGNED_PAYLOAD,
+        ])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, _sha256(canonical.encode('utf-8'))])
+        query['X-Amz-Signature'] = self._signature(date, string_to_sign)
+        return f"{self.endpoint}{path}?{self._canonical_query(query)}"
+
+    # ---- запросы ----
+
+    def _request(self, method: str, key: str = '', query: dict = None, headers: dict = None, data=None):
+        query = query or {}
+        path = self._path(key)
+        url = f"{self.endpoint}{path}"
+        if query:
+            url += f"?{self._canonical_query(query)}"
+        signed = self.sign(method, path, query, headers or {})
+        metrics.inc('storage.s3.requests')
+        return self.session.request(method, URL(url, encoded=True), headers=signed, data=data)
+
+    @staticmethod
+    async def _check(response, *ok_statuses):
+        if response.status not in (ok_statuses or (200,)):
+            text = await response.text()
+            raise StorageError(f"S3 {response.method} {response.url.path}: {response.status} {text[:300]}")
+
+    async def put(self, key: str, chunks) -> int:
+        """
+        Записать файл из асинхронного потока частей. Меньше part_size - одним
+        запросом, больше - multipart upload (в памяти не больше одной части).
+        """
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        size = 0
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                if len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = await self._create_upload(key)
+                    parts.append(await self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+                    buffer.clear()
+            if upload_id is None:
+                async with self._request('PUT', key, data=bytes(buffer)) as response:
+                    await self._check(response)
+                return size
+            if buffer:
+                parts.append(await self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            await self._complete_upload(key, upload_id, parts)
+        except BaseException:
+            if upload_id is not None:
+                await self._abort_upload(key, upload_id)
+            raise
+        return size
+
+    async def _create_upload(self, key: str) -> str:
+        async with self._request('POST', key, {'uploads': ''}) as response:
+            await self._check(response)
+            root = ElementTree.fromstring(await response.read())
+        return root.findtext(f"{S3_NAMESPACE}UploadId") or root.findtext('UploadId')
+
+    async def _upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> tuple:
+        query = {'partNumber': number, 'uploadId': upload_id}
+        async with self._request('PUT', key, query, data=data) as response:
+            await self._check(response)
+            metrics.inc('storage.s3.parts')
+            return number, response.headers['ETag']
+
+    async def _complete_upload(self, key: str, upload_id: str, parts: list):
+        body = '<CompleteMultipartUpload>' + ''.join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in parts
+        ) + '</CompleteMultipartUpload>'
+        async with self._request('POST', key, {'uploadId': upload_id}, data=body.encode('utf-8')) as response:
+            await self._check(response)
+            # S3 может вернуть 200 с ошибкой в теле
+            text = await response.text()
+            if '<Error>' in text:
+                raise StorageError(f"S3 complete multipart upload {key}: {text[:300]}")
+
+    async def _abort_upload(self, key: str, upload_id: str):
+        try:
+            async with self._request('DELETE', key, {'uploadId': upload_id}) as response:
+                await self._check(response, 204, 200)
+        except Exception as e:
+            logger.error(f"Не удалось отменить загрузку {key}: {e}")
+
+    async def get(self, key: str, start: int = 0, end: int = None):
+        """Читать файл частями, end - последний байт диапазона (включительно)"""
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+        async with self._request('GET', key, headers=headers) as response:
+            await self._check(response, 200, 206)
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                yield chunk
+
+    async def stat(self, key: str) -> Optional[ObjectInfo]:
+        async with self._request('HEAD', key) as response:
+            if response.status == 404:
+                return None
+            await self._check(response)
+            modified = parsedate_to_datetime(response.headers['Last-Modified']).timestamp()
+            return ObjectInfo(key, int(response.headers['Content-Length']), modified)
+
+    async def list(self, prefix: str = '') -> list:
+        objects = []
+        query = {'list-type': '2', 'prefix': prefix}
+        while True:
+            async with self._request('GET', query=query) as response:
+                await self._check(response)
+                root = ElementTree.fromstring(await response.read())
+            for item in root.iter(f"{S3_NAMESPACE}Contents"):
+                modified = datetime.datetime.fromisoformat(
+                    item.findtext(f"{S3_NAMESPACE}LastModified").replace('Z', '+00:00')
+                ).timestamp()
+                objects.append(ObjectInfo(
+                    item.findtext(f"{S3_NAMESPACE}Key"), int(item.findtext(f"{S3_NAMESPACE}Size")), modified
+                ))
+            token = root.findtext(f"{S3_NAMESPACE}NextContinuationToken")
+            if not token:
+                return objects
+            query = {**query, 'continuation-token': token}
+
+    async def delete(self, key: str):
+        async with self._request('DELETE', key) as response:
+            await self._check(response, 204, 200)
+
+    async def _copy(self, source: str, key: str, headers: dict = None):
+        headers = {'x-amz-copy-source': self._path(source), **(headers or {})}
+        async with self._request('PUT', key, headers=headers) as response:
+            await self._check(response)
+            text = await response.text()
+            if '<Error>' in text:
+                raise StorageError(f"S3 copy {source} -> {key}: {text[:300]}")
+
+    async def move(self, source: str, key: str):
+        """Копирование на стороне S3 и удаление источника"""
+        await self._copy(source, key)
+        await self.delete(source)
+
+    async def touch(self, key: str):
+        """Обновить время изменения (копирование объекта в себя с заменой метаданных)"""
+        await self._copy(key, key, {'x-amz-metadata-directive': 'REPLACE', 'x-amz-meta-touched': str(int(time.time()))})
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
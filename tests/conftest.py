@@ -0,0 +1,33 @@
+import asyncio
+import os
+import sys
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """Часы, которые идут только в asyncio.sleep"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """asyncio.sleep не ждет, а переводит часы вперед"""
+    clock = FakeClock()
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, result=None):
+        # Сначала отработают задачи, готовые к запуску сейчас, потом идут часы
+        await real_sleep(0)
+        clock.now += delay
+        return result
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    return clock
@@ -0,0 +1,34 @@
+"""Параметры команд batch в формате http_build_query"""
+
+from urllib.parse import unquote
+from bitrix_client import build_query
+
+
+def test_flat_params():
+    assert build_query({'id': 5, 'name': 'Иван Петров'}) == 'id=5&name=%D0%98%D0%B2%D0%B0%D0%BD%20%D0%9F%D0%B5%D1%82%D1%80%D0%BE%D0%B2'
+
+
+def test_nested_dicts_and_lists():
+    query = build_query({
+        'filter': {'CONTACT_ID': 7, '>ID': 100},
+        'select': ['ID', 'TITLE'],
+        'order': {'ID': 'DESC'},
+    })
+    assert unquote(query).split('&') == [
+        'filter[CONTACT_ID]=7', 'filter[>ID]=100', 'select[0]=ID', 'select[1]=TITLE', 'order[ID]=DESC',
+    ]
+    # Скобки в именах не экранируются, остальное - экранируется
+    assert 'filter[%3EID]=100' in query
+
+
+def test_bools_and_none():
+    assert build_query({'closed': True, 'halt': False, 'empty': None}) == 'closed=Y&halt=N&empty='
+
+
+def test_empty_nested_values_are_skipped():
+    assert build_query({'filter': {}, 'select': [], 'id': 1}) == 'id=1'
+
+
+def test_result_references_are_kept():
+    query = build_query({'id': '$result[deal][0][CONTACT_ID]', 'filter': {'ID': '$result[list][0][ID]'}})
+    assert query == 'id=$result[deal][0][CONTACT_ID]&filter[ID]=$result[list][0][ID]'
@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+import pytest
+
+from blob_store import BlobStore
+from file_pool import FilePool
+from storage_backends import LocalBackend, PARTIAL_DIR
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    pool = FilePool(2)
+    yield BlobStore(LocalBackend(str(tmp_path / 'blobs'), pool), gc_grace=60, pool=pool)
+    pool.shutdown()
+
+
+def files(root) -> list:
+    return sorted(os.path.relpath(os.path.join(directory, name), root)
+                  for directory, _, names in os.walk(root) for name in names)
+
+
+def test_same_content_is_stored_once(blobs, tmp_path):
+    async def main():
+        first = await blobs.put_bytes(b'invoice')
+        second = await blobs.put_bytes(b'invoice')
+        other = await blobs.put_bytes(b'photo')
+        assert first == second and first != other
+        assert await blobs.size(first[0]) == len(b'invoice')
+        async with blobs.local_copy(first[0]) as path:
+            with open(path, 'rb') as file:
+                assert file.read() == b'invoice'
+
+    asyncio.run(main())
+    # Два файла по содержимому, временные файлы убраны
+    root = tmp_path / 'blobs'
+    stored = files(root)
+    assert len(stored) == 2 and all(not name.startswith(('tmp', PARTIAL_DIR)) for name in stored)
+
+
+def test_interrupted_write_leaves_nothing(blobs, tmp_path):
+    async def chunks():
+        yield b'first part'
+        raise ConnectionError('обрыв')
+
+    async def main():
+        with pytest.raises(ConnectionError):
+            await blobs.receive(chunks())
+
+    asyncio.run(main())
+    assert files(tmp_path / 'blobs') == []
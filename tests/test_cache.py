@@ -0,0 +1,67 @@
+"""TTL/LRU кэш"""
+
+from types import SimpleNamespace
+import pytest
+import cache
+from cache import TTLCache
+
+
+@pytest.fixture
+def now(monkeypatch):
+    """Часы кэша, которые двигает тест"""
+    clock = SimpleNamespace(value=100.0)
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=lambda: clock.value))
+    return clock
+
+
+def test_entries_expire(now):
+    deals = TTLCache(10, ttl=60, name='test')
+    deals.set('1', 'deal')
+    now.value += 59
+    assert deals.get('1') == 'deal' and '1' in deals
+    now.value += 2
+    assert deals.get('1') is None and '1' not in deals
+    # Устаревшее значение доступно для работы без Битрикс
+    assert deals.get_stale('1') == 'deal'
+
+
+def test_per_entry_ttl(now):
+    deals = TTLCache(10, ttl=60, name='test')
+    deals.set('short', 1, ttl=5)
+    deals.set('long', 2)
+    now.value += 10
+    assert deals.get('short') is None and deals.get('long') == 2
+
+
+def test_least_recently_used_is_evicted(now):
+    deals = TTLCache(2, ttl=60, name='test')
+    deals.set('a', 1)
+    deals.set('b', 2)
+    deals.get('a')
+    deals.set('c', 3)
+    assert len(deals) == 2
+    assert deals.get('b') is None
+    assert deals.get('a') == 1 and deals.get('c') == 3
+
+
+def test_set_refreshes_position_and_ttl(now):
+    deals = TTLCache(2, ttl=60, name='test')
+    deals.set('a', 1)
+    deals.set('b', 2)
+    now.value += 50
+    deals.set('a', 10)
+    deals.set('c', 3)
+    assert deals.get('b') is None
+    now.value += 50
+    assert deals.get('a') == 10
+
+
+def test_invalidate_and_clear(now):
+    deals = TTLCache(10, ttl=60, name='test')
+    deals.set('a', 1)
+    deals.set('b', 2)
+    deals.invalidate('a')
+    deals.invalidate('missing')
+    assert deals.get_stale('a') is None and len(deals) == 1
+    deals.clear()
+    assert len(deals) == 0
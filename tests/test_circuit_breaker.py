@@ -0,0 +1,141 @@
+"""Состояния предохранителя и пробный запрос в half_open"""
+
+import asyncio
+import pytest
+from bitrix_client import BitrixClient
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from rate_limit import PriorityRateLimiter, TokenBucket
+
+
+def open_breaker(recovery: float = 0.0) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=recovery, slow_call_threshold=1.0, name='test')
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60, slow_call_threshold=1.0, name='test')
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60, slow_call_threshold=1.0, name='test')
+    breaker.record_failure()
+    breaker.record_success(0.1)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_slow_call_counts_as_failure():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60, slow_call_threshold=1.0, name='test')
+    breaker.record_success(2.0)
+    assert breaker.state == OPEN
+
+
+def test_half_open_allows_single_probe():
+    breaker = open_breaker()
+    assert breaker.allow_request()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow_request()
+
+
+def test_probe_success_closes():
+    breaker = open_breaker()
+    breaker.allow_request()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+    assert breaker.allow_request() and breaker.allow_request()
+
+
+def test_probe_failure_reopens():
+    breaker = open_breaker(recovery=60)
+    breaker.opened_at -= 60
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+
+def test_released_probe_can_be_retried():
+    breaker = open_breaker()
+    breaker.allow_request()
+    breaker.release()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow_request()
+
+
+class HangingSession:
+    """Сессия, запрос которой не завершается"""
+
+    closed = False
+
+    def post(self, *args, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        await asyncio.Event().wait()
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_rejects_does_not_claim_probe():
+    breaker = open_breaker(recovery=60)
+    assert breaker.rejects()
+    breaker.opened_at -= 60
+    assert not breaker.rejects()
+    assert breaker.state == OPEN and not breaker._probe_in_flight
+    assert breaker.allow_request()
+
+
+def test_open_breaker_spends_no_token(clock):
+    async def scenario():
+        client = BitrixClient('http://bitrix.test/rest/', max_retries=0)
+        client.limiter = PriorityRateLimiter(TokenBucket(1, 1, clock=clock))
+        client.breaker = open_breaker(recovery=60)
+        client._session = HangingSession()
+        assert await client.call('crm.deal.get', {'id': 1}) is None
+        assert client.limiter.bucket.tokens == 1
+        assert not client.breaker._probe_in_flight
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_is_released(clock):
+    async def scenario():
+        client = BitrixClient('http://bitrix.test/rest/', max_retries=0)
+        client.limiter = PriorityRateLimiter(TokenBucket(100, 10, clock=clock))
+        client.breaker = open_breaker()
+        client._session = HangingSession()
+        task = asyncio.create_task(client.call('crm.deal.get', {'id': 1}))
+        await asyncio.sleep(0.01)
+        assert client.breaker.state == HALF_OPEN and client.breaker._probe_in_flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not client.breaker._probe_in_flight
+        assert client.breaker.allow_request()
+
+    asyncio.run(scenario())
+
+
+def test_cancel_while_waiting_for_token_keeps_probe_free(clock):
+    async def scenario():
+        client = BitrixClient('http://bitrix.test/rest/', max_retries=0)
+        client.limiter = PriorityRateLimiter(TokenBucket(0.01, 1, clock=clock))
+        await client.limiter.acquire()
+        client.breaker = open_breaker()
+        client._session = HangingSession()
+        task = asyncio.create_task(client.call('crm.deal.get', {'id': 1}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert client.breaker.allow_request()
+
+    asyncio.run(scenario())
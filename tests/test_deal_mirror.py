@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+
+from deal_mirror import DealMirror
+
+
+def deal(deal_id, modified, contact='7', closed='N', title=''):
+    return {'ID': str(deal_id), 'CONTACT_ID': contact, 'CLOSED': closed,
+            'DATE_MODIFY': modified, 'TITLE': title}
+
+
+class FakeClient:
+    """iter_list отдает заранее заданные страницы и запоминает параметры"""
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+        self.calls = []
+
+    async def iter_list(self, method, params):
+        self.calls.append(params)
+        for page in self.batches.pop(0):
+            yield page
+
+
+def test_sync_from_checkpoint_and_upsert(tmp_path):
+    async def main():
+        mirror = DealMirror(str(tmp_path / 'mirror.db'))
+        client = FakeClient(
+            [[deal(1, '2024-01-01T10:00:00'), deal(2, '2024-01-02T10:00:00')],
+             [deal(3, '2024-01-01T12:00:00', closed='Y')]],
+            [[deal(2, '2024-01-03T09:00:00', closed='Y', title='Новое')]],
+        )
+        assert not await mirror.is_ready()
+
+        first = await mirror.sync_once(client)
+        assert len(first) == 3
+        assert '>=DATE_MODIFY' not in client.calls[0]['filter']
+        assert await mirror.checkpoint() == '2024-01-02T10:00:00'
+        assert await mirror.is_ready()
+
+        second = await mirror.sync_once(client)
+        assert [d['ID'] for d in second] == ['2']
+        assert client.calls[1]['filter']['>=DATE_MODIFY'] == '2024-01-02T10:00:00'
+        assert await mirror.checkpoint() == '2024-01-03T09:00:00'
+
+        # Повторная запись обновила сделку, а не добавила копию
+        assert (await mirror.get(2)).title == 'Новое'
+        assert await mirror.count(['7'], closed=False) == 1
+        assert await mirror.count(['7'], closed=True) == 2
+        assert await mirror.closed_ids([1, 2, 3]) == {2, 3}
+
+        page, cursor = await mirror.list_page(['7'], closed=True, limit=1)
+        assert [d.id for d in page] == ['3'] and cursor == '3'
+        page, cursor = await mirror.list_page(['7'], closed=True, before_id=cursor, limit=1)
+        assert [d.id for d in page] == ['2'] and cursor is None
+
+    asyncio.run(main())
+
+
+def test_failed_upsert_rolls_back(tmp_path):
+    async def main():
+        mirror = DealMirror(str(tmp_path / 'mirror.db'))
+        await mirror.upsert([deal(1, '2024-01-01T10:00:00')])
+
+        # Вторая сделка битая: пачка не записывается целиком
+        with pytest.raises(ValueError):
+            await mirror.upsert([deal(1, '2024-02-01T10:00:00', closed='Y'), deal('x', '')])
+        assert await mirror.closed_ids([1]) == set()
+
+        # Соединение не осталось в открытой транзакции
+        await mirror.upsert([deal(5, '2024-01-05T10:00:00')])
+        assert await mirror.count(['7'], closed=False) == 2
+
+    asyncio.run(main())
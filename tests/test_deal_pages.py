@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+import bot
+from bitrix_client import PAGE_SIZE
+from cache import TTLCache
+from models import Deal
+
+
+def raw_deals(ids):
+    return [{'ID': str(deal_id), 'TITLE': f'Заказ {deal_id}', 'CLOSED': 'N'} for deal_id in ids]
+
+
+class NotReadyMirror:
+    async def is_ready(self):
+        return False
+
+
+class ReadyMirror:
+    """Копия сделок с ID от count до 1, запоминает запрошенные курсоры"""
+
+    def __init__(self, count):
+        self.ids = list(range(count, 0, -1))
+        self.cursors = []
+
+    async def is_ready(self):
+        return True
+
+    async def list_page(self, contact_ids, closed, before_id, limit):
+        self.cursors.append(before_id)
+        ids = [i for i in self.ids if before_id is None or i < int(before_id)]
+        page = [Deal.from_bitrix(raw) for raw in raw_deals(ids[:limit])]
+        return page, page[-1].id if len(ids) > limit else None
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    monkeypatch.setattr(bot, 'deal_list_cache', TTLCache(100, 60, name='test_pages'))
+    return monkeypatch
+
+
+def test_bitrix_page_is_split_and_cached(pages):
+    calls = []
+
+    async def bitrix_request(method, params):
+        calls.append(params)
+        if '<ID' not in params['filter']:
+            return raw_deals(range(100, 100 - PAGE_SIZE, -1))
+        return raw_deals(range(int(params['filter']['<ID']) - 1, 47, -1))
+
+    pages.setattr(bot, 'deal_mirror', NotReadyMirror())
+    pages.setattr(bot, 'bitrix_request', bitrix_request)
+
+    async def main():
+        deals, cursor = await bot.get_deals_page(['7'], False)
+        assert [d.id for d in deals] == [str(i) for i in range(100, 90, -1)]
+        assert cursor == '91'
+        assert calls[0]['order'] == {'ID': 'DESC'} and calls[0]['start'] == -1
+
+        # Остальные страницы ответа уже в кэше: Битрикс не запрашивается
+        for expected in ('81', '71', '61', '51'):
+            deals, cursor = await bot.get_deals_page(['7'], False, cursor)
+            assert cursor == expected
+        assert len(calls) == 1
+
+        # Полный ответ (PAGE_SIZE) - дальше может быть еще: следующий запрос с <ID
+        deals, cursor = await bot.get_deals_page(['7'], False, cursor)
+        assert calls[1]['filter']['<ID'] == '51'
+        assert [d.id for d in deals] == ['50', '49', '48'] and cursor is None
+
+    asyncio.run(main())
+
+
+def test_next_page_is_prefetched(pages):
+    mirror = ReadyMirror(25)
+    pages.setattr(bot, 'deal_mirror', mirror)
+
+    async def main():
+        deals, cursor = await bot.get_deals_page(['7'], False)
+        assert cursor == '16'
+        await asyncio.gather(*bot.prefetch_tasks)
+        assert mirror.cursors == [None, '16']
+
+        deals, cursor = await bot.get_deals_page(['7'], False, cursor)
+        assert [d.id for d in deals][0] == '15' and cursor == '6'
+        await asyncio.gather(*bot.prefetch_tasks)
+        # Страница '16' взята из кэша, в фоне подгружена '6'
+        assert mirror.cursors == [None, '16', '6']
+
+        deals, cursor = await bot.get_deals_page(['7'], False, cursor)
+        assert len(deals) == 5 and cursor is None
+        assert not bot.prefetch_tasks and mirror.cursors == [None, '16', '6']
+
+    asyncio.run(main())
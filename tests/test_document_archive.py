@@ -0,0 +1,116 @@
+"""Архив документов: архивация -> сборка мусора -> восстановление"""
+
+import asyncio
+import os
+import pytest
+from blob_store import BlobStore
+from document_archive import DocumentArchive
+from document_manifest import DocumentManifest, INVOICE, PHOTO
+from file_pool import FilePool
+from storage_backends import LocalBackend
+
+
+@pytest.fixture
+def store(tmp_path):
+    pool = FilePool(2)
+    blobs = BlobStore(LocalBackend(str(tmp_path / 'blobs'), pool), 0, pool)
+    manifest = DocumentManifest(str(tmp_path / 'documents.db'), blobs)
+    yield manifest, DocumentArchive(manifest, idle=0)
+    pool.shutdown()
+
+
+async def read(blobs, digest) -> bytes:
+    return b''.join([chunk async for chunk in blobs.backend.get(blobs.key(digest))])
+
+
+async def closed_deal_1(deal_ids):
+    return {1}
+
+
+def test_round_trip(store):
+    manifest, archive = store
+    blobs = manifest.blobs
+    invoice = os.urandom(1000) + b'x' * 50000
+    photos = [os.urandom(3000) for _ in range(3)]
+
+    async def scenario():
+        invoice_digest, size = await blobs.put_bytes(invoice)
+        await manifest.add(1, INVOICE, size, digest=invoice_digest, file_id='invoice-file-id')
+        photo_digests = []
+        for photo in photos:
+            digest, size = await blobs.put_bytes(photo)
+            photo_digests.append(digest)
+            await manifest.add(1, PHOTO, size, digest=digest)
+        # Это же фото у активного заказа - его файл должен остаться
+        await manifest.add(2, PHOTO, len(photos[0]), digest=photo_digests[0])
+        await asyncio.sleep(0.01)
+
+        deals, reclaimed = await archive.archive_closed(closed_deal_1)
+        assert deals == 1
+        archived = manifest.get(1)
+        # Освобождено за вычетом места, которое занял сам архив
+        stored = await blobs.size(archived.invoice.archive)
+        assert 0 < stored < len(invoice)
+        assert reclaimed == len(invoice) + len(photos[1]) + len(photos[2]) - stored
+        assert archived.invoice.archive and all(entry.archive for entry in archived.photos.values())
+        assert manifest.get(2).photos['photo_001.jpg'].archive is None
+
+        await asyncio.sleep(0.01)
+        await manifest.reconcile()
+        assert not await blobs.exists(invoice_digest)
+        assert not await blobs.exists(photo_digests[1])
+        assert await blobs.exists(photo_digests[0])
+        assert await blobs.exists(archived.invoice.archive)
+        # Сверка не считает документы в архиве пропавшими
+        assert manifest.photo_count(1) == 3
+
+        # Одновременные обращения ждут одно восстановление
+        assert await asyncio.gather(archive.restore(1), archive.restore('1')) == [4, 4]
+        restored = manifest.get(1)
+        assert restored.invoice.archive is None
+        assert await read(blobs, invoice_digest) == invoice
+        for digest, photo in zip(photo_digests, photos):
+            assert await read(blobs, digest) == photo
+
+        await asyncio.sleep(0.01)
+        await manifest.reconcile()
+        assert not await blobs.exists(archived.invoice.archive)
+        assert await archive.restore(1) == 0
+
+    asyncio.run(scenario())
+
+
+def test_open_deals_and_pending_documents_stay(store):
+    manifest, archive = store
+
+    async def scenario():
+        digest, size = await manifest.blobs.put_bytes(b'photo')
+        await manifest.add(2, PHOTO, size, digest=digest)
+        # Документ закрытого заказа еще не скачан - заказ ждет следующего прохода
+        await manifest.add(1, PHOTO, 0, file_id='not-downloaded-yet')
+        await asyncio.sleep(0.01)
+        assert await archive.archive_closed(closed_deal_1) == (0, 0)
+        assert manifest.get(2).photos['photo_001.jpg'].archive is None
+        assert manifest.get(1).photos['photo_001.jpg'].archive is None
+
+    asyncio.run(scenario())
+
+
+def test_incompressible_deal_is_not_archived(store, monkeypatch):
+    manifest, archive = store
+    blobs = manifest.blobs
+
+    async def scenario():
+        digest, size = await blobs.put_bytes(os.urandom(3000))
+        await manifest.add(1, PHOTO, size, digest=digest)
+        await asyncio.sleep(0.01)
+        assert await archive.archive_closed(closed_deal_1) == (0, 0)
+        assert manifest.get(1).photos['photo_001.jpg'].archive is None
+        # Файл на месте, собранный архив удален сразу
+        assert [info.key for info in await blobs.backend.list()] == [blobs.key(digest)]
+
+        # Пока файлы заказа те же, архив повторно не собирается
+        monkeypatch.setattr(archive, '_open_tar', None)
+        assert await archive.archive_closed(closed_deal_1) == (0, 0)
+
+    asyncio.run(scenario())
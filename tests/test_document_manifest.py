@@ -0,0 +1,40 @@
+import asyncio
+
+from document_manifest import DocumentManifest, Document, PHOTO, INVOICE
+
+
+def test_other_process_changes_arrive_on_refresh(tmp_path):
+    async def main():
+        path = str(tmp_path / 'documents.db')
+        bot, webhook = DocumentManifest(path, None), DocumentManifest(path, None)
+        await webhook.add(42, INVOICE, 100, digest='a' * 64)
+        names, documents = await webhook.add_many(42, PHOTO, [
+            webhook.get(42).invoice._replace(digest='b' * 64),
+            webhook.get(42).invoice._replace(digest='c' * 64),
+        ])
+        assert names == ['photo_001.jpg', 'photo_002.jpg']
+
+        # Чтение не проверяет файл: до такта watch_loop - прежняя копия в памяти
+        bot.changed_elsewhere = None
+        assert not bot.get(42)
+        del bot.changed_elsewhere
+        bot.refresh()
+        assert bot.has_invoice(42) and bot.photo_names(42) == names
+
+    asyncio.run(main())
+
+
+def test_photo_numbers_continue_after_removal(tmp_path):
+    async def main():
+        manifest = DocumentManifest(str(tmp_path / 'documents.db'), None)
+        photo = Document(10, 'a' * 64, None)
+        names, _ = await manifest.add_many(1, PHOTO, [photo] * 3)
+        await manifest.remove(1, PHOTO, ['photo_002.jpg'])
+        names, _ = await manifest.add_many(1, PHOTO, [photo])
+        assert names == ['photo_004.jpg']
+        numbers = manifest._conn.execute(
+            "SELECT number FROM deal_documents WHERE deal_id = '1' ORDER BY number"
+        ).fetchall()
+        assert numbers == [(1,), (3,), (4,)]
+
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+import asyncio
+
+from download_queue import DownloadQueue
+
+
+class FakeBlobs:
+    """receive падает failures раз, потом отдает (digest, size)"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+
+    async def receive(self, chunks):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('обрыв')
+        return 'd' * 64, 10
+
+
+def run_queue(tmp_path, blobs, jobs, on_done, on_failed=None):
+    async def main():
+        queue = DownloadQueue(str(tmp_path / 'downloads.db'), blobs, 1, 3, 0)
+        queue.start(None, on_done, on_failed)
+        await queue.enqueue(42, 'photo', jobs)
+        await queue._queue.join()
+        queue.stop()
+        return queue
+    return asyncio.run(main())
+
+
+def test_job_is_kept_until_on_done_succeeds(tmp_path):
+    done = []
+
+    async def on_done(job, digest, size):
+        if not done:
+            done.append(None)
+            raise RuntimeError('манифест недоступен')
+        done.append(job['name'])
+
+    queue = run_queue(tmp_path, FakeBlobs(), [('photo_001.jpg', 'f1')], on_done)
+    assert [job['name'] for job in queue._pending()] == ['photo_001.jpg']
+
+    # После перезапуска задание скачивается заново и удаляется
+    queue = run_queue(tmp_path, FakeBlobs(), [], on_done)
+    assert done == [None, 'photo_001.jpg']
+    assert queue._pending() == []
+
+
+def test_exhausted_job_is_removed_and_reported(tmp_path):
+    failed = []
+
+    async def on_done(job, digest, size):
+        raise AssertionError('файл не скачан')
+
+    async def on_failed(job, error):
+        failed.append((job['name'], str(error)))
+
+    queue = run_queue(tmp_path, FakeBlobs(failures=3), [('photo_001.jpg', 'f1')], on_done, on_failed)
+    assert failed == [('photo_001.jpg', 'обрыв')]
+    assert queue._pending() == []
+
+
+def test_cancelled_key_is_pruned(tmp_path):
+    async def on_done(job, digest, size):
+        raise AssertionError('отмененный документ')
+
+    async def main():
+        queue = DownloadQueue(str(tmp_path / 'downloads.db'), FakeBlobs(), 1, 3, 0)
+        await queue.enqueue(42, 'photo', [('photo_001.jpg', 'f1'), ('photo_002.jpg', 'f2')])
+        await queue.cancel(42, 'photo')
+        assert len(queue._cancelled) == 2
+        queue.start(None, on_done, None)
+        await queue._queue.join()
+        queue.stop()
+        assert queue._cancelled == set()
+        assert queue._pending() == []
+
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+
+
+class Order(StatesGroup):
+    page = State()
+
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+OTHER = StorageKey(bot_id=1, chat_id=11, user_id=11)
+
+
+def test_state_and_data_survive_restart(tmp_path):
+    async def main():
+        path = str(tmp_path / 'fsm.db')
+        storage = SQLiteStorage(path)
+        await storage.set_state(KEY, Order.page)
+        await storage.set_data(KEY, {'deal_ids': [5, 4, 3], 'cursor': 3})
+        await storage.set_state(OTHER, Order.page)
+        await storage.set_state(OTHER, None)
+        await storage.close()
+
+        restored = SQLiteStorage(path)
+        assert await restored.get_state(KEY) == Order.page.state
+        assert await restored.get_data(KEY) == {'deal_ids': [5, 4, 3], 'cursor': 3}
+        # Сброшенное состояние без данных удаляется с диска
+        assert await restored.get_state(OTHER) is None
+        assert await restored.get_data(OTHER) == {}
+        assert restored._conn.execute("SELECT COUNT(*) FROM fsm").fetchone()[0] == 1
+
+        # Изменение полученного словаря не меняет сохраненные данные
+        (await restored.get_data(KEY))['cursor'] = None
+        assert (await restored.get_data(KEY))['cursor'] == 3
+
+    asyncio.run(main())
+
+
+def test_expired_states_are_dropped_on_load(tmp_path):
+    async def main():
+        path = str(tmp_path / 'fsm.db')
+        storage = SQLiteStorage(path, ttl=60)
+        await storage.set_state(KEY, Order.page)
+        await storage.set_data(OTHER, {'deal_ids': [1]})
+        storage._conn.execute("UPDATE fsm SET updated_at = ? WHERE key LIKE '%:10:%'", (time.time() - 120,))
+
+        restored = SQLiteStorage(path, ttl=60)
+        assert await restored.get_state(KEY) is None
+        assert await restored.get_data(OTHER) == {'deal_ids': [1]}
+
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import media_groups
+from media_groups import MediaGroupCollector
+
+real_sleep = asyncio.sleep
+
+
+class Ticks:
+    """Пауза сборщика заканчивается, только когда тест отсчитает такт"""
+
+    def __init__(self):
+        self.sleeping = []
+
+    async def sleep(self, delay):
+        future = asyncio.get_running_loop().create_future()
+        self.sleeping.append(future)
+        await future
+
+    async def tick(self):
+        sleeping, self.sleeping = self.sleeping, []
+        for future in sleeping:
+            future.set_result(None)
+        for _ in range(3):
+            await real_sleep(0)
+
+
+@pytest.fixture
+def ticks(monkeypatch):
+    ticks = Ticks()
+    monkeypatch.setattr(media_groups, 'asyncio', SimpleNamespace(sleep=ticks.sleep))
+    return ticks
+
+
+def message(message_id, group='album', chat=1):
+    return SimpleNamespace(message_id=message_id, media_group_id=group, chat=SimpleNamespace(id=chat))
+
+
+def test_album_waits_until_photos_stop(ticks):
+    async def main():
+        collector = MediaGroupCollector(delay=1.0)
+        first = asyncio.create_task(collector.collect(message(11)))
+        await real_sleep(0)
+        assert await collector.collect(message(13)) == []
+
+        # Пока приходят новые фото, ожидание продлевается
+        await ticks.tick()
+        assert await collector.collect(message(12)) == []
+        await ticks.tick()
+        assert not first.done()
+
+        # Альбом другого чата с тем же media_group_id собирается отдельно
+        other = asyncio.create_task(collector.collect(message(21, chat=2)))
+        await ticks.tick()
+        assert [m.message_id for m in await first] == [11, 12, 13]
+        await ticks.tick()
+        assert [m.message_id for m in await other] == [21]
+        assert collector._groups == {}
+
+    asyncio.run(main())
+
+
+def test_photo_after_album_starts_new_one(ticks):
+    async def main():
+        collector = MediaGroupCollector(delay=1.0)
+        single = message(3, group=None)
+        assert await collector.collect(single) == [single]
+
+        first = asyncio.create_task(collector.collect(message(1)))
+        await real_sleep(0)
+        await ticks.tick()
+        assert [m.message_id for m in await first] == [1]
+
+        late = asyncio.create_task(collector.collect(message(2)))
+        await real_sleep(0)
+        await ticks.tick()
+        assert [m.message_id for m in await late] == [2]
+
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""Token bucket, очередь по приоритетам и общий для процессов запас токенов"""
+
+import asyncio
+from rate_limit import (
+    PriorityRateLimiter, SharedTokenBucket, TokenBucket, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE,
+    background_priority,
+)
+
+
+def test_bucket_refills_at_rate(clock):
+    async def scenario():
+        bucket = TokenBucket(2, 2, clock)
+        assert await bucket.take() == 0 and await bucket.take() == 0
+        assert await bucket.take() == 0.5
+        clock.now += 0.5
+        assert await bucket.take() == 0
+        # Запас не растет выше burst
+        clock.now += 100
+        assert [await bucket.take() for _ in range(3)] == [0, 0, 0.5]
+
+    asyncio.run(scenario())
+
+
+def test_interactive_requests_go_first(clock):
+    async def scenario():
+        limiter = PriorityRateLimiter(TokenBucket(1, 1, clock), name='test')
+        await limiter.acquire()
+        order = []
+
+        async def request(priority, label):
+            await limiter.acquire(priority)
+            order.append((label, clock.now - 1000))
+
+        await asyncio.gather(
+            request(PRIORITY_BACKGROUND, 'sync-1'),
+            request(PRIORITY_BACKGROUND, 'sync-2'),
+            request(PRIORITY_INTERACTIVE, 'click-1'),
+            request(PRIORITY_INTERACTIVE, 'click-2'),
+        )
+        return order
+
+    assert asyncio.run(scenario()) == [('click-1', 1), ('click-2', 2), ('sync-1', 3), ('sync-2', 4)]
+
+
+def test_priority_from_context(clock):
+    async def scenario():
+        limiter = PriorityRateLimiter(TokenBucket(1, 1, clock), name='test')
+        await limiter.acquire()
+        order = []
+
+        async def background():
+            with background_priority():
+                await limiter.acquire()
+            order.append('background')
+
+        async def interactive():
+            await limiter.acquire()
+            order.append('interactive')
+
+        await asyncio.gather(background(), interactive())
+        return order
+
+    assert asyncio.run(scenario()) == ['interactive', 'background']
+
+
+def test_cancelled_waiter_does_not_take_token(clock):
+    async def scenario():
+        limiter = PriorityRateLimiter(TokenBucket(1, 1, clock), name='test')
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire(PRIORITY_INTERACTIVE))
+        waiting = asyncio.create_task(limiter.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await waiting
+        return clock.now - 1000
+
+    # Следующий токен - через 1 с, и он достается оставшемуся запросу
+    assert asyncio.run(scenario()) == 1
+
+
+def test_shared_bucket_limits_all_processes(tmp_path, clock):
+    path = str(tmp_path / 'shared.db')
+
+    async def scenario():
+        # Два "процесса" - два соединения с одним файлом
+        first = PriorityRateLimiter(SharedTokenBucket(path, 20, 2, clock=clock), name='test')
+        second = PriorityRateLimiter(SharedTokenBucket(path, 20, 2, clock=clock), name='test')
+        await asyncio.gather(*(limiter.acquire() for limiter in [first, second] * 5))
+        return clock.now - 1000
+
+    # 10 запросов при запасе 2 и 20 в секунду: 8 токенов ждут пополнения
+    assert round(asyncio.run(scenario()), 6) == 0.4
+
+
+def test_shared_bucket_opens_file_on_first_take(tmp_path):
+    path = tmp_path / 'shared.db'
+    bucket = SharedTokenBucket(str(path), 1, 1)
+    assert not path.exists()
+    assert asyncio.run(bucket.take()) == 0
+    assert path.exists()
@@ -0,0 +1,30 @@
+import asyncio
+
+from shared_state import DealStages
+
+
+def test_changes_from_other_process(tmp_path):
+    async def main():
+        path = str(tmp_path / 'shared.db')
+        bot, webhook = DealStages(path), DealStages(path)
+        assert await webhook.record(10, 7, 'NEW') is None
+        assert await webhook.record(10, 7, 'WON') == 'NEW'
+        assert not webhook.changed_elsewhere()
+
+        assert bot.changed_elsewhere()
+        assert not bot.changed_elsewhere()
+        assert await bot.changes(0) == [(2, 10, '7')]
+
+    asyncio.run(main())
+
+
+def test_version_check_does_not_wait_for_transaction(tmp_path):
+    path = str(tmp_path / 'shared.db')
+    bot, webhook = DealStages(path), DealStages(path)
+    asyncio.run(webhook.record(10, 7, 'NEW'))
+
+    # Соединение занято своей транзакцией: проверка отвечает сразу по копии в памяти
+    with bot._lock:
+        assert not bot.changed_elsewhere()
+    # Изменение не потерялось - его видит следующая проверка
+    assert bot.changed_elsewhere()
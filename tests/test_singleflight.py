@@ -0,0 +1,80 @@
+"""Объединение одновременных вызовов по ключу"""
+
+import asyncio
+import pytest
+from singleflight import SingleFlight, single_flight
+
+
+def test_concurrent_calls_share_one_request():
+    calls = []
+
+    @single_flight('test')
+    async def fetch(deal_id):
+        calls.append(deal_id)
+        await asyncio.sleep(0.01)
+        return {'ID': deal_id}
+
+    async def scenario():
+        results = await asyncio.gather(fetch(1), fetch(1), fetch(1), fetch(2))
+        assert fetch.flight.in_flight() == 0
+        return results
+
+    results = asyncio.run(scenario())
+    assert calls == [1, 2]
+    assert results[0] is results[1] is results[2]
+    assert results[3] == {'ID': 2}
+
+
+def test_key_function():
+    calls = []
+
+    @single_flight('test', key=lambda phone: phone.lstrip('+'))
+    async def resolve(phone):
+        calls.append(phone)
+        await asyncio.sleep(0.01)
+        return phone
+
+    async def scenario():
+        return await asyncio.gather(resolve('+7900'), resolve('7900'))
+
+    assert asyncio.run(scenario()) == ['+7900', '+7900']
+    assert calls == ['+7900']
+
+
+def test_error_reaches_every_waiter_and_is_not_cached():
+    flight = SingleFlight('test')
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError('portal down')
+
+    async def scenario():
+        results = await asyncio.gather(
+            flight.do('deal', failing), flight.do('deal', failing), return_exceptions=True
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        # Следующий вызов после ошибки - новый запрос
+        with pytest.raises(RuntimeError):
+            await flight.do('deal', failing)
+
+    asyncio.run(scenario())
+    assert len(attempts) == 2
+
+
+def test_cancelled_waiter_does_not_cancel_request():
+    flight = SingleFlight('test')
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    async def scenario():
+        first = asyncio.create_task(flight.do('key', slow))
+        second = asyncio.create_task(flight.do('key', slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == 'done'
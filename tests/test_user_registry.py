@@ -0,0 +1,39 @@
+import asyncio
+
+from user_registry import UserRegistry
+
+
+def test_contact_lookup_follows_registration(tmp_path):
+    async def main():
+        users = UserRegistry(str(tmp_path / 'users.db'))
+        await users.register(1, 70, '+7900', 'Анна', 'a@example.com')
+        await users.register(2, 70, '+7901', 'Борис', '')
+        await users.register(3, 71, '+7902', 'Вера', '')
+        assert users.telegram_ids(70) == {1, 2}
+        assert users.telegram_ids('71') == {3}
+
+        # Перепривязка к другому контакту убирает пользователя из старого
+        await users.register(2, 71, '+7901', 'Борис', '')
+        assert users.telegram_ids(70) == {1}
+        assert users.telegram_ids(71) == {2, 3}
+
+        await users.remove(1)
+        assert users.telegram_ids(70) == set()
+        assert 70 not in users._by_client
+        assert 1 not in users and len(users) == 2
+
+    asyncio.run(main())
+
+
+def test_registration_from_other_process_is_visible(tmp_path):
+    async def main():
+        path = str(tmp_path / 'users.db')
+        bot, webhook = UserRegistry(path), UserRegistry(path)
+        await bot.register(1, 70, '+7900', 'Анна', '')
+        assert webhook.telegram_ids(70) == {1}
+        assert webhook.get(1)['phone'] == '+7900'
+
+        # Новый процесс поднимает реестр с диска
+        assert UserRegistry(path).telegram_ids(70) == {1}
+
+    asyncio.run(main())
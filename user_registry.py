@@ -0,0 +1,118 @@
+"""
+Реестр пользователей бота
+Записи хранятся в SQLite (WAL) и целиком загружаются в память при старте:
+telegram_id -> запись и client_id -> набор telegram_id (у одного контакта
+может быть несколько пользователей Telegram). Чтение - обращение к словарю.
+Файл общий для бота и webhook handler: если пользователя зарегистрировал
+другой процесс, память перечитывается при следующем обращении.
+"""
+
+import asyncio
+import logging
+import time
+import metrics
+from shared_state import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('client_id', 'phone', 'name', 'email')
+
+
+class UserRegistry(SQLiteStore):
+    """Зарегистрированные пользователи с обратным индексом по контакту Битрикс"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id INTEGER PRIMARY KEY,
+        client_id TEXT NOT NULL,
+        phone TEXT,
+        name TEXT,
+        email TEXT,
+        registered_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS users_client ON users (client_id);
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._users = {}
+        self._by_client = {}
+        self.load()
+
+    def load(self):
+        """Загрузить всех пользователей в память"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT telegram_id, client_id, phone, name, email FROM users"
+            ).fetchall()
+        users = {}
+        by_client = {}
+        for telegram_id, *values in rows:
+            users[telegram_id] = dict(zip(FIELDS, values))
+            by_client.setdefault(values[0], set()).add(telegram_id)
+        self._users = users
+        self._by_client = by_client
+        metrics.set_gauge('users.registered', len(users))
+        logger.info(f"Реестр пользователей: {len(users)} записей")
+
+    def _sync(self):
+        """Перечитать реестр, если его изменил другой процесс"""
+        if self.changed_elsewhere():
+            self.load()
+
+    def get(self, telegram_id: int):
+        """Запись пользователя или None"""
+        self._sync()
+        return self._users.get(telegram_id)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        self._sync()
+        return telegram_id in self._users
+
+    def __len__(self):
+        self._sync()
+        return len(self._users)
+
+    def telegram_ids(self, client_id) -> set:
+        """Пользователи Telegram, привязанные к контакту Битрикс"""
+        self._sync()
+        return set(self._by_client.get(str(client_id), ()))
+
+    def _write(self, telegram_id: int, record: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO users (telegram_id, client_id, phone, name, email, registered_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(telegram_id) DO UPDATE SET "
+                "client_id = excluded.client_id, phone = excluded.phone, name = excluded.name, "
+                "email = excluded.email, registered_at = excluded.registered_at",
+                (telegram_id, *(record[field] for field in FIELDS), time.time())
+            )
+
+    def _delete(self, telegram_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
+
+    def _unindex(self, telegram_id: int):
+        old = self._users.pop(telegram_id, None)
+        if old:
+            owners = self._by_client.get(old['client_id'])
+            if owners:
+                owners.discard(telegram_id)
+                if not owners:
+                    del self._by_client[old['client_id']]
+
+    async def register(self, telegram_id: int, client_id, phone: str, name: str, email: str) -> dict:
+        """Сохранить пользователя (запись на диск, затем индекс в памяти)"""
+        record = {'client_id': str(client_id), 'phone': phone, 'name': name, 'email': email}
+        await asyncio.to_thread(self._write, telegram_id, record)
+        self._unindex(telegram_id)
+        self._users[telegram_id] = record
+        self._by_client.setdefault(record['client_id'], set()).add(telegram_id)
+        metrics.set_gauge('users.registered', len(self._users))
+        return record
+
+    async def remove(self, telegram_id: int):
+        """Удалить пользователя"""
+        await asyncio.to_thread(self._delete, telegram_id)
+        self._unindex(telegram_id)
+        metrics.set_gauge('users.registered', len(self._users))